@@ -1,3 +1,7 @@
+import time
+_import_start = time.perf_counter()
+"""When backupper started being imported (see backupper.cli --startup-profile)"""
+
 from . import utils
 #from . import connect
 
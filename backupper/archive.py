@@ -0,0 +1,670 @@
+"""
+    Artifact archiving routines used by backupper.cli.main.
+"""
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+import tarfile
+import threading
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+
+from . import compression
+from . import manifest
+from . import chunkstore
+from . import report
+from . import catalog
+from . import seekindex
+from . import filters
+
+__all__ = ["get_gpg", "backup_artifact"]
+
+_gpg_instances = {}
+"""gnupg.GPG objects already created in this process, indexed by GnuPG home"""
+
+def get_gpg(home):
+    """
+        Returns a gnupg.GPG object for the given GnuPG home.
+
+        The object is created on first use and then cached, so that a worker process archiving several artifacts only initialises it once.
+
+        :param home: GnuPG home.
+        :type home: str
+        :return: The GPG object.
+        :rtype: gnupg.GPG
+    """
+
+    if not home in _gpg_instances:
+        # gnupg is only imported by encrypted runs
+        import gnupg
+        _gpg_instances[home] = gnupg.GPG(gnupghome=home)
+    return _gpg_instances[home]
+
+def backup_artifact(artifact, actual_backup_dir, common_artifact_path, backup_datetime, configuration, previous_backup=None):
+    """
+        Archives (and if needed, encrypts) a single artifact.
+
+        This function doesn't write anything on the standard outputs nor exits: it returns the messages to display and the exit code, so that backupper.cli.main can display them in the artifacts order whether they have been archived serially or in a process pool.
+
+        :param artifact: Validated artifact node (its "path" must be absolute).
+        :type artifact: dict
+        :param actual_backup_dir: Timestampped backup directory.
+        :type actual_backup_dir: str
+        :param common_artifact_path: Common path of all artifacts, removed from the backup output structure.
+        :type common_artifact_path: str
+        :param backup_datetime: Formatted datetime of the current backup.
+        :type backup_datetime: str
+        :param configuration: Validated configuration.
+        :type configuration: dict
+        :param previous_backup: Most recent backup directory and its formatted datetime, incremental backups are based on it (None if there is no previous backup).
+        :type previous_backup: tuple
+        :return: A list of (stream name, message) tuples ("stdout" or "stderr"), an exit code (0 if the main loop can go on) and the artifact statistics (stages times, counters, output path and wall time).
+        :rtype: tuple
+
+        .. seealso:: backupper.cli.main
+    """
+
+    metrics = report.Metrics()
+    start = time.perf_counter()
+    messages, exit_code, output, members = _backup_artifact(artifact, actual_backup_dir, common_artifact_path, backup_datetime, configuration, previous_backup, metrics)
+    if members is not None:
+        members.close()
+
+    stats = metrics.as_dict()
+    stats.update({
+        "artifact": artifact["path"],
+        "mode": artifact["mode"],
+        "codec": artifact["compression"]["codec"],
+        "output": os.path.abspath(output) if output is not None else None,
+        "exit_code": exit_code,
+        "wall_time": time.perf_counter() - start,
+        "staging_catalog": members.path if members is not None else None,
+    })
+    return messages, exit_code, stats
+
+def _backup_artifact(artifact, actual_backup_dir, common_artifact_path, backup_datetime, configuration, previous_backup, metrics):
+    """
+        Actual backup_artifact, timing its stages in metrics.
+
+        :return: Messages, exit code, the output path (None if nothing was written) and the staging catalog of its members (None if the catalog is disabled).
+        :rtype: tuple
+    """
+
+    messages = []
+    members = None
+    compression_options = artifact["compression"]
+    artifact_mode = artifact["mode"]
+    matcher = filters.Matcher.create(artifact["filters"])
+    artifact = artifact["path"]
+
+    if not os.path.exists(artifact):
+        messages.append(("stderr", "Warning: backup: {} doesn't exist (skipping).\n".format(artifact)))
+        return messages, 0, None, members
+
+    # If our artifact is a directory we must remove the trailing slash so that os.path.basename can properly work
+    if os.path.isdir(artifact):
+        if artifact.endswith('/'):
+            artifact = artifact[:-1]
+
+    # Build the output tar path, its extension depends on the compression codec
+    relative_artifact = os.path.relpath(artifact, common_artifact_path)
+    output_base = "{}.{}".format(os.path.join(actual_backup_dir, relative_artifact), backup_datetime)
+    output_tar = "{}.{}".format(output_base, compression.CODECS[compression_options["codec"]]["extension"])
+    final_output = output_tar
+
+    # Create subdirectories
+    try:
+        os.makedirs(os.path.dirname(output_tar), exist_ok=True)
+    except OSError as e:
+        messages.append(("stderr", "Error: backup: {}\n".format(e)))
+        return messages, 4, None, members
+
+    # The members of the artifact are recorded for the catalog, with their checksums if needed
+    checksums = False
+    if configuration["catalog"]["enabled"]:
+        members = catalog.StagingWriter(catalog.staging_path(output_base))
+        checksums = configuration["catalog"]["checksums"]
+
+    # A snapshot is a plain copy of the artifact, whose unchanged files are hardlinked to the previous snapshot
+    if artifact_mode == "snapshot":
+        output_snapshot = os.path.join(actual_backup_dir, relative_artifact)
+        previous_snapshot = None
+        if previous_backup is not None:
+            previous_snapshot = os.path.join(previous_backup[0], relative_artifact)
+        try:
+            copied_count, linked_count = _take_snapshot(artifact, output_snapshot, previous_snapshot, metrics, members, matcher)
+        except OSError as e:
+            messages.append(("stderr", "Error: backup: snapshot: {}\n".format(e)))
+            return messages, 4, None, members
+        messages.append(("stdout", "{} done (snapshot: {} copied, {} linked){}.\n".format(output_snapshot, copied_count, linked_count, _skipped_details(metrics))))
+        return messages, 0, output_snapshot, members
+
+    # In incremental mode, the manifest tells which files must be archived
+    artifact_manifest = None
+    done_details = ""
+    if configuration["incremental"]["enabled"]:
+        try:
+            with metrics.stage("manifest"):
+                artifact_manifest, done_details = _build_manifest(artifact, output_base, relative_artifact, previous_backup, configuration["incremental"]["full_every"], metrics, matcher)
+        except Exception as e:
+            _remove_partial_output(manifest.manifest_path(output_base))
+            messages.append(("stderr", "Error: backup: manifest: {}\n".format(e)))
+            return messages, 4, None, members
+
+    try:
+        # If needed, the tar stream is encrypted on the fly, so that no plaintext archive is ever written on disk
+        if configuration["encrypt"]:
+            output_gpg = "{}.gpg".format(output_tar)
+            try:
+                encrypt_status = _write_encrypted_tar(artifact, output_gpg, compression_options, configuration["gnupg"], metrics, artifact_manifest, members, checksums, matcher)
+            except Exception as e:
+                _remove_partial_output(output_gpg)
+                _discard_manifest(artifact_manifest)
+                messages.append(("stderr", "Error: encrypt: {}\n".format(e)))
+                return messages, 5, None, members
+
+            if not encrypt_status.ok:
+                _remove_partial_output(output_gpg)
+                _discard_manifest(artifact_manifest)
+                messages.append(("stderr", "Grave: encrypt: gnupg returned a non ok status ({}).\n".format(encrypt_status.status)))
+                messages.append(("stderr", "                gpg stderr is: \n{}".format(encrypt_status.stderr)))
+                return messages, 5, None, members
+
+            final_output = output_gpg
+            with metrics.stage("fsync"):
+                _fsync_file(final_output)
+            metrics.counters["bytes_out"] += os.path.getsize(final_output)
+        # In dedup mode, the tar stream goes to the chunk store, and the backup directory only gets its recipe
+        elif artifact_mode == "dedup":
+            final_output = "{}.{}".format(output_base, chunkstore.RECIPE_EXTENSION)
+            try:
+                store = chunkstore.ChunkStore(configuration["backup_dir"])
+                try:
+                    chunk_writer = chunkstore.ChunkWriter(store, final_output)
+                    try:
+                        _write_tar(artifact, report.MeteredWriter(chunk_writer, metrics, "dedup", "bytes_tar"), None, metrics, artifact_manifest, members, checksums, matcher=matcher)
+                    except:
+                        chunk_writer.abort()
+                        raise
+                    with metrics.stage("dedup"):
+                        chunk_writer.close()
+                    try:
+                        with metrics.stage("fsync"):
+                            _fsync_file(final_output)
+                    except:
+                        # The complete recipe already references its chunks
+                        with store.locked(exclusive=True):
+                            store.remove_recipe(final_output)
+                        raise
+                finally:
+                    store.close()
+                metrics.counters["bytes_out"] += store.stored_size
+            except:
+                _remove_partial_output(final_output)
+                _discard_manifest(artifact_manifest)
+                raise
+        else:
+            # Archives of seekable codecs get a seek index, so that a single member can be extracted without decompressing what precedes it
+            index = None
+            if configuration["seek_index"] and compression.CODECS[compression_options["codec"]]["seekable"]:
+                index = seekindex.SeekIndexWriter(seekindex.index_path(output_tar), compression_options["codec"])
+            try:
+                with open(output_tar, "wb") as f:
+                    _write_tar(artifact, report.MeteredWriter(f, metrics, "write", "bytes_out"), compression_options, metrics, artifact_manifest, members, checksums, index, matcher)
+                    with metrics.stage("fsync"):
+                        f.flush()
+                        os.fsync(f.fileno())
+                if index is not None:
+                    with metrics.stage("index"):
+                        index.close()
+            except:
+                _discard_manifest(artifact_manifest)
+                if index is not None:
+                    index.close()
+                    _remove_partial_output(index.path)
+                raise
+    finally:
+        if artifact_manifest is not None:
+            artifact_manifest.close()
+
+    messages.append(("stdout", "{} done{}{}.\n".format(final_output, done_details, _skipped_details(metrics))))
+    return messages, 0, final_output, members
+
+def _skipped_details(metrics):
+    """
+        Describes the files the filters of an artifact skipped, for its done message.
+
+        :param metrics: Metrics of the artifact.
+        :type metrics: backupper.report.Metrics
+        :return: The details (empty if nothing was skipped).
+        :rtype: str
+    """
+
+    if metrics.counters["skipped_files"] == 0:
+        return ""
+    return " ({} files skipped, {:.1f} MiB)".format(metrics.counters["skipped_files"], metrics.counters["skipped_bytes"] / 1024 / 1024)
+
+def _walk_artifact(artifact, matcher=None, metrics=None):
+    """
+        Walks an artifact, without following symbolic links, in the same order as tarfile (depth first, entries sorted by name).
+
+        :param artifact: Path of the artifact.
+        :type artifact: str
+        :param matcher: If set, the files it skips aren't walked, nor the contents of the directories it skips.
+        :type matcher: backupper.filters.Matcher
+        :param metrics: Metrics of the artifact, counting the skipped_files and skipped_bytes (needed with a matcher).
+        :type metrics: backupper.report.Metrics
+        :return: (archive name, os.stat_result) tuples, the archive name being the path relative to the artifact parent directory.
+        :rtype: iterator
+    """
+
+    root = os.path.dirname(artifact)
+    yield os.path.basename(artifact), os.lstat(artifact)
+
+    # One iterator per directory being walked, so that only the listings of the current branch are in memory, along with whether the directory is included
+    directories = [(iter(_list_directory(artifact)), False)] if os.path.isdir(artifact) and not os.path.islink(artifact) else []
+    while len(directories) > 0:
+        entry = next(directories[-1][0], None)
+        if entry is None:
+            directories.pop()
+            continue
+        stat = entry.stat(follow_symlinks=False)
+        included = True
+        if matcher is not None:
+            included = matcher.check(os.path.relpath(entry.path, artifact).replace(os.sep, "/"), stat, directories[-1][1])
+            # Skipped directories are pruned, their contents are neither listed nor counted
+            if included is None:
+                metrics.counters["skipped_files"] += 1
+                if S_ISREG(stat.st_mode):
+                    metrics.counters["skipped_bytes"] += stat.st_size
+                continue
+        yield os.path.relpath(entry.path, root), stat
+        if entry.is_dir(follow_symlinks=False):
+            directories.append((iter(_list_directory(entry.path)), included))
+
+def _list_directory(path):
+    """
+        Lists a directory.
+
+        :param path: Directory path.
+        :type path: str
+        :return: os.DirEntry objects, sorted by name.
+        :rtype: list
+    """
+
+    with os.scandir(path) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
+
+def _take_snapshot(artifact, output_snapshot, previous_snapshot, metrics, members=None, matcher=None):
+    """
+        Copies an artifact, hardlinking the files which didn't change since the previous snapshot (like rsync --link-dest).
+
+        A file is considered unchanged if the previous snapshot has a regular file with the same size, mtime and mode.
+
+        :param artifact: Path of the artifact.
+        :type artifact: str
+        :param output_snapshot: Path of the copy.
+        :type output_snapshot: str
+        :param previous_snapshot: Path of the same artifact in the previous backup (or None).
+        :type previous_snapshot: str
+        :param metrics: Metrics of the artifact.
+        :type metrics: backupper.report.Metrics
+        :param members: If set, the copied files are recorded in it (without checksums).
+        :type members: backupper.catalog.StagingWriter
+        :param matcher: If set, only the files it keeps are copied.
+        :type matcher: backupper.filters.Matcher
+        :return: The number of copied files and the number of hardlinked files.
+        :rtype: tuple
+    """
+
+    copied_count = 0
+    linked_count = 0
+    root = os.path.dirname(artifact)
+    output_root = os.path.dirname(output_snapshot)
+    previous_root = os.path.dirname(previous_snapshot) if previous_snapshot is not None else None
+    directories = []
+
+    for arcname, stat in report.metered_iter(_walk_artifact(artifact, matcher, metrics), metrics, "walk"):
+        source = os.path.join(root, arcname)
+        destination = os.path.join(output_root, arcname)
+        metrics.counters["files"] += 1
+        if members is not None:
+            members.add(source, stat)
+
+        metrics.enter("copy")
+        try:
+            if S_ISDIR(stat.st_mode):
+                os.makedirs(destination, exist_ok=True)
+                directories.append((source, destination))
+            elif S_ISLNK(stat.st_mode):
+                os.symlink(os.readlink(source), destination)
+            elif S_ISREG(stat.st_mode):
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                linked = False
+                if previous_root is not None:
+                    previous = os.path.join(previous_root, arcname)
+                    try:
+                        with metrics.stage("link"):
+                            previous_stat = os.lstat(previous)
+                            if S_ISREG(previous_stat.st_mode) and (previous_stat.st_size, previous_stat.st_mtime_ns, previous_stat.st_mode) == (stat.st_size, stat.st_mtime_ns, stat.st_mode):
+                                os.link(previous, destination)
+                                linked = True
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        # Too many links to the previous file: we just make a new copy
+                        if e.errno != errno.EMLINK:
+                            raise
+                if linked:
+                    linked_count += 1
+                    metrics.counters["bytes_linked"] += stat.st_size
+                else:
+                    shutil.copy2(source, destination, follow_symlinks=False)
+                    copied_count += 1
+                    metrics.counters["bytes_in"] += stat.st_size
+                    metrics.counters["bytes_out"] += stat.st_size
+        finally:
+            metrics.exit()
+
+    # Directories timestamps are restored once their contents are written, deepest first
+    with metrics.stage("copy"):
+        for source, destination in reversed(directories):
+            shutil.copystat(source, destination, follow_symlinks=False)
+
+    return copied_count, linked_count
+
+def _build_manifest(artifact, output_base, relative_artifact, previous_backup, full_every, metrics, matcher=None):
+    """
+        Writes the manifest of an artifact, and compares it with the one of the previous backup.
+
+        :param artifact: Path of the artifact.
+        :type artifact: str
+        :param output_base: Archive path without its extension.
+        :type output_base: str
+        :param relative_artifact: Path of the artifact in the backup directory structure.
+        :type relative_artifact: str
+        :param previous_backup: Previous backup directory and its formatted datetime (or None).
+        :type previous_backup: tuple
+        :param full_every: A full backup is done every full_every backups.
+        :type full_every: int
+        :param metrics: Metrics of the artifact (the walk is timed as its own stage).
+        :type metrics: backupper.report.Metrics
+        :param matcher: If set, only the files it keeps are in the manifest.
+        :type matcher: backupper.filters.Matcher
+        :return: The new manifest, whose changed files must be archived, and details about the backup to display.
+        :rtype: tuple
+    """
+
+    # We base our backup on the previous one if it has a manifest for this artifact, unless it's time for a full backup
+    previous_manifest = None
+    if previous_backup is not None:
+        previous_backup_dir, previous_datetime = previous_backup
+        try:
+            previous_manifest = manifest.Manifest.open(manifest.manifest_path("{}.{}".format(os.path.join(previous_backup_dir, relative_artifact), previous_datetime)))
+            if previous_manifest.chain_length + 1 >= full_every:
+                previous_manifest.close()
+                previous_manifest = None
+        except FileNotFoundError:
+            pass
+
+    if previous_manifest is None:
+        artifact_manifest = manifest.Manifest.create(manifest.manifest_path(output_base))
+        artifact_manifest.add_files(report.metered_iter(_walk_artifact(artifact, matcher, metrics), metrics, "walk"))
+        artifact_manifest.diff(None)
+        return artifact_manifest, " (full)"
+
+    with previous_manifest:
+        artifact_manifest = manifest.Manifest.create(manifest.manifest_path(output_base), os.path.basename(previous_backup_dir), previous_manifest.chain_length + 1)
+        artifact_manifest.add_files(report.metered_iter(_walk_artifact(artifact, matcher, metrics), metrics, "walk"))
+        changed_count, deleted_count = artifact_manifest.diff(previous_manifest)
+    return artifact_manifest, " (incremental: {} changed, {} deleted)".format(changed_count, deleted_count)
+
+def _discard_manifest(artifact_manifest):
+    """
+        Removes the manifest of an artifact which couldn't be archived, so that no later backup is based on it.
+
+        :param artifact_manifest: The manifest (or None if the backup isn't incremental).
+        :type artifact_manifest: backupper.manifest.Manifest
+    """
+
+    if artifact_manifest is not None:
+        artifact_manifest.close()
+        _remove_partial_output(artifact_manifest.path)
+
+def _write_tar(artifact, fileobj, compression_options, metrics, artifact_manifest=None, members=None, checksums=False, index=None, matcher=None):
+    """
+        Writes the compressed tar stream of an artifact.
+
+        :param artifact: Path of the artifact.
+        :type artifact: str
+        :param fileobj: Binary file object the compressed stream is written to (it isn't closed).
+        :type fileobj: file object
+        :param compression_options: The "compression" node of the artifact (ignored if fileobj is a chunk writer).
+        :type compression_options: dict
+        :param metrics: Metrics of the artifact.
+        :type metrics: backupper.report.Metrics
+        :param artifact_manifest: If set, only the changed files of this manifest are archived.
+        :type artifact_manifest: backupper.manifest.Manifest
+        :param members: If set, the archived files are recorded in it.
+        :type members: backupper.catalog.StagingWriter
+        :param checksums: If True, the checksums of the archived files are recorded too.
+        :type checksums: bool
+        :param index: If set, the offsets of the members and the restart points of the compressed stream are recorded in it (the codec must be seekable).
+        :type index: backupper.seekindex.SeekIndexWriter
+        :param matcher: If set, only the files it keeps are archived (unused with a manifest, which has been built with it).
+        :type matcher: backupper.filters.Matcher
+    """
+
+    # A chunk writer gets an uncompressed tar, written without stream buffering so that it can cut a chunk exactly before each member
+    member_filter = None
+    if hasattr(fileobj, "cut"):
+        compressor = None
+        tar_fileobj, tar_mode = fileobj, "w"
+        def member_filter(tarinfo):
+            fileobj.cut()
+            return tarinfo
+    else:
+        compressor = compression.open_compressor(fileobj, compression_options["codec"], compression_options["level"], compression_options["threads"], index is not None)
+        tar_fileobj, tar_mode = report.MeteredWriter(compressor, metrics, "compress", "bytes_tar"), "w|"
+
+    if artifact_manifest is None:
+        arcnames = (arcname for arcname, _ in report.metered_iter(_walk_artifact(artifact, matcher, metrics), metrics, "walk"))
+    else:
+        arcnames = artifact_manifest.changed()
+
+    root = os.path.dirname(artifact)
+    metrics.enter("tar")
+    try:
+        # The stream buffer is the size of a parallel gzip block, so that the compressor gets few large writes
+        with tarfile.open(fileobj=tar_fileobj, mode=tar_mode, bufsize=compression.ParallelGzipWriter.BLOCK_SIZE) as tar:
+            for arcname in arcnames:
+                # tar.offset is where the header of the next member is written in the tar stream
+                offset = tar.offset
+                try:
+                    tarinfo = _add_member(tar, os.path.join(root, arcname), arcname, metrics, member_filter, members, checksums)
+                except FileNotFoundError:
+                    # The file has been deleted since the walk
+                    continue
+                if index is not None and tarinfo is not None:
+                    index.add_member(tarinfo.name, offset, tarinfo.size)
+    finally:
+        try:
+            if compressor is not None:
+                with metrics.stage("compress"):
+                    compressor.close()
+        finally:
+            metrics.exit()
+    if index is not None:
+        index.add_restart_points(compressor.restart_points)
+
+def _add_member(tar, path, arcname, metrics, member_filter=None, members=None, checksums=False):
+    """
+        Adds a single file (not its contents if it's a directory) to a tar archive, like tarfile.TarFile.add with recursive=False, timing its reads.
+
+        :param tar: Tar archive.
+        :type tar: tarfile.TarFile
+        :param path: Path of the file.
+        :type path: str
+        :param arcname: Name of the file in the archive.
+        :type arcname: str
+        :param metrics: Metrics of the artifact.
+        :type metrics: backupper.report.Metrics
+        :param member_filter: Called with each tarfile.TarInfo before it's added.
+        :type member_filter: function
+        :param members: If set, the file is recorded in it.
+        :type members: backupper.catalog.StagingWriter
+        :param checksums: If True, the checksum of the file is computed while it's read, and recorded too.
+        :type checksums: bool
+        :return: The added member (None if the file type isn't supported).
+        :rtype: tarfile.TarInfo
+    """
+
+    stat = os.lstat(path) if members is not None else None
+    tarinfo = tar.gettarinfo(path, arcname)
+    # Sockets and other unsupported files are skipped, like tarfile does
+    if tarinfo is None:
+        return None
+    if member_filter is not None:
+        tarinfo = member_filter(tarinfo)
+
+    metrics.counters["files"] += 1
+    digest = None
+    if tarinfo.isreg():
+        with open(path, "rb") as f:
+            reader = report.MeteredReader(f, metrics, "read", "bytes_in")
+            if checksums:
+                digest = hashlib.sha256()
+                reader = _ChecksumReader(reader, digest, metrics)
+            tar.addfile(tarinfo, reader)
+    else:
+        tar.addfile(tarinfo)
+
+    if members is not None:
+        members.add(path, stat, digest.hexdigest() if digest is not None else None)
+    return tarinfo
+
+class _ChecksumReader:
+    """
+        Readable file object wrapper, computing the checksum of what's read (timed as the "checksum" stage).
+    """
+
+    def __init__(self, fileobj, digest, metrics):
+        self._fileobj = fileobj
+        self._digest = digest
+        self._metrics = metrics
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._metrics.enter("checksum")
+        try:
+            self._digest.update(data)
+        finally:
+            self._metrics.exit()
+        return data
+
+def _write_encrypted_tar(artifact, output_gpg, compression_options, gnupg_configuration, metrics, artifact_manifest=None, members=None, checksums=False, matcher=None):
+    """
+        Writes the encrypted tar archive of an artifact.
+
+        The tar stream is written by a thread into a pipe which is directly fed to gpg, so the archive only hits the disk once, already encrypted.
+
+        :param artifact: Path of the artifact.
+        :type artifact: str
+        :param output_gpg: Path of the encrypted archive.
+        :type output_gpg: str
+        :param compression_options: The "compression" node of the artifact.
+        :type compression_options: dict
+        :param gnupg_configuration: The "gnupg" node of the configuration.
+        :type gnupg_configuration: dict
+        :param metrics: Metrics of the artifact. The writer thread times the tar stages, and the time spent waiting for gpg (writing into the pipe, then after the writer is done) is the "encrypt" stage.
+        :type metrics: backupper.report.Metrics
+        :param artifact_manifest: If set, only the changed files of this manifest are archived.
+        :type artifact_manifest: backupper.manifest.Manifest
+        :param members: If set, the archived files are recorded in it.
+        :type members: backupper.catalog.StagingWriter
+        :param checksums: If True, the checksums of the archived files are recorded too.
+        :type checksums: bool
+        :param matcher: If set, only the files it keeps are archived.
+        :type matcher: backupper.filters.Matcher
+        :return: The gnupg encryption status.
+        :rtype: gnupg.Crypt
+
+        :raises Exception: If gnupg or the tar writer failed.
+    """
+
+    gpg = get_gpg(gnupg_configuration["home"])
+    read_fd, write_fd = os.pipe()
+    tar_errors = []
+    writer_end = []
+
+    def write_tar():
+        try:
+            with os.fdopen(write_fd, "wb") as pipe:
+                _write_tar(artifact, report.MeteredWriter(pipe, metrics, "encrypt", "bytes_compressed"), compression_options, metrics, artifact_manifest, members, checksums, matcher=matcher)
+        except Exception as e:
+            tar_errors.append(e)
+        finally:
+            writer_end.append(time.perf_counter())
+
+    writer = threading.Thread(target=write_tar)
+    writer.start()
+    try:
+        with os.fdopen(read_fd, "rb") as pipe:
+            encrypt_status = gpg.encrypt_file(pipe, recipients=gnupg_configuration["keyid"], output=output_gpg)
+    finally:
+        # Once the read end is closed, a writer stuck on a dead gpg gets a broken pipe instead of blocking forever
+        writer.join()
+    metrics.add_time("encrypt", max(0.0, time.perf_counter() - writer_end[0]))
+
+    if tar_errors:
+        # A broken pipe only means gpg stopped reading, which its status already tells. The writer may notice it while cleaning up after it (e.g. closing the compressor), as another error caused by it.
+        if not encrypt_status.ok and _is_broken_pipe(tar_errors[0]):
+            return encrypt_status
+        raise tar_errors[0]
+
+    return encrypt_status
+
+def _is_broken_pipe(error):
+    """
+        Tells if an error is, or has been raised while handling, a broken pipe.
+
+        :param error: The error.
+        :type error: Exception
+        :return: True if a broken pipe is part of the error chain.
+        :rtype: bool
+    """
+
+    while error is not None:
+        if isinstance(error, BrokenPipeError):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def _fsync_file(path):
+    """
+        Flushes a file written by another process (or object) to disk.
+
+        :param path: File path.
+        :type path: str
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _remove_partial_output(path):
+    """
+        Removes an incomplete output file, if it exists.
+
+        :param path: File to remove.
+        :type path: str
+    """
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
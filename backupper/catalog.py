@@ -0,0 +1,239 @@
+"""
+    Catalog of the backups of a backup directory.
+
+    The catalog is a SQLite database in backup_dir. Each run records its backup, the statistics of its artifacts and their members (path, type, size, mtime, mode and SHA-256 checksum), so that finding which backups contain a file is an indexed lookup instead of a scan of the archives.
+
+    Artifacts may be archived by worker processes, which can't share a SQLite connection: each one writes its members in a staging database next to its output, which the main process merges into the catalog once the artifacts are done.
+"""
+
+import os
+import json
+import sqlite3
+from stat import S_ISDIR, S_ISLNK, S_ISREG, S_IMODE
+
+__all__ = ["CATALOG_NAME", "STAGING_EXTENSION", "Catalog", "StagingWriter", "staging_path", "member_type"]
+
+CATALOG_NAME = "catalog.sqlite"
+"""Name of the catalog, in backup_dir"""
+
+STAGING_EXTENSION = "catalog"
+"""Extension of staging databases"""
+
+_BATCH_SIZE = 10000
+"""Number of members inserted at once"""
+
+def staging_path(output_base):
+    """
+        Returns the staging database path of an artifact.
+
+        :param output_base: Archive path without its extension (<backup dir>/<artifact>.<datetime>).
+        :type output_base: str
+        :return: The staging database path.
+        :rtype: str
+    """
+
+    return "{}.{}".format(output_base, STAGING_EXTENSION)
+
+def member_type(mode):
+    """
+        Returns the type of a member from its stat mode.
+
+        :param mode: st_mode of the member.
+        :type mode: int
+        :return: "file", "directory", "symlink" or "other".
+        :rtype: str
+    """
+
+    if S_ISREG(mode):
+        return "file"
+    elif S_ISDIR(mode):
+        return "directory"
+    elif S_ISLNK(mode):
+        return "symlink"
+    return "other"
+
+class StagingWriter:
+    """
+        Members of an artifact, written by the process archiving it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        """Staging database path"""
+
+        # The members of an encrypted artifact are written by the tar writer thread
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = OFF")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS members (path TEXT, type TEXT, size INTEGER, mtime INTEGER, mode INTEGER, sha256 TEXT)")
+        self._batch = []
+
+    def add(self, path, stat, sha256=None):
+        """
+            Records a member.
+
+            :param path: Absolute path of the member in the artifact.
+            :type path: str
+            :param stat: Member stat (os.stat_result-like: st_mode, st_size and st_mtime are used).
+            :type stat: os.stat_result
+            :param sha256: Hexadecimal SHA-256 checksum of the member contents (None if unknown).
+            :type sha256: str
+        """
+
+        self._batch.append((path, member_type(stat.st_mode), stat.st_size if S_ISREG(stat.st_mode) else 0, int(stat.st_mtime), S_IMODE(stat.st_mode), sha256))
+        if len(self._batch) >= _BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._connection.executemany("INSERT INTO members VALUES (?, ?, ?, ?, ?, ?)", self._batch)
+        self._batch = []
+
+    def close(self):
+        if self._connection is None:
+            return
+        self._flush()
+        self._connection.commit()
+        self._connection.close()
+        self._connection = None
+
+class Catalog:
+    """
+        Catalog of a backup directory.
+    """
+
+    def __init__(self, backup_dir):
+        self.path = os.path.join(backup_dir, CATALOG_NAME)
+        """Catalog database path"""
+
+        self._backup_dir = backup_dir
+
+        self._connection = None
+
+    def _connect(self):
+        """
+            Opens the catalog, creating it if needed.
+
+            :return: The database connection.
+            :rtype: sqlite3.Connection
+        """
+
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS backups (id INTEGER PRIMARY KEY, name TEXT UNIQUE, datetime TEXT, wall_time REAL, complete INTEGER)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS artifacts (id INTEGER PRIMARY KEY, backup INTEGER, path TEXT, output TEXT, mode TEXT, codec TEXT, exit_code INTEGER, files INTEGER, bytes_in INTEGER, bytes_out INTEGER, wall_time REAL, stages TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS members (artifact INTEGER, path TEXT, type TEXT, size INTEGER, mtime INTEGER, mode INTEGER, sha256 TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS artifacts_backup ON artifacts (backup)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS members_path ON members (path)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS members_artifact ON members (artifact)")
+            self._connection.commit()
+        return self._connection
+
+    def add_backup(self, name, backup_datetime, wall_time, artifacts_stats, complete):
+        """
+            Records a backup, its artifacts and their members.
+
+            Outputs are recorded relative to backup_dir, so that the catalog stays valid if it's moved. The staging databases of the artifacts are merged, then removed (and their "staging_catalog" key too).
+
+            :param name: Backup directory name (backup_<datetime>).
+            :type name: str
+            :param backup_datetime: Formatted datetime of the backup.
+            :type backup_datetime: str
+            :param wall_time: Time spent backupping the artifacts.
+            :type wall_time: float
+            :param artifacts_stats: Artifacts statistics, as returned by backupper.archive.backup_artifact.
+            :type artifacts_stats: list
+            :param complete: True if every artifact has been backupped.
+            :type complete: bool
+        """
+
+        connection = self._connect()
+        self.remove_backup(name)
+
+        # The backup is only marked complete once all its members are merged
+        with connection:
+            backup_id = connection.execute("INSERT INTO backups (name, datetime, wall_time, complete) VALUES (?, ?, ?, 0)", (name, backup_datetime, wall_time)).lastrowid
+
+        for stats in artifacts_stats:
+            with connection:
+                artifact_id = connection.execute("INSERT INTO artifacts (backup, path, output, mode, codec, exit_code, files, bytes_in, bytes_out, wall_time, stages) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                    backup_id, stats["artifact"], os.path.relpath(stats["output"], self._backup_dir) if stats["output"] is not None else None, stats["mode"], stats["codec"], stats["exit_code"],
+                    stats["counters"].get("files", 0), stats["counters"].get("bytes_in", 0), stats["counters"].get("bytes_out", 0),
+                    stats["wall_time"], json.dumps(stats["stages"], sort_keys=True),
+                )).lastrowid
+
+            staging = stats.pop("staging_catalog", None)
+            if staging is None or not os.path.isfile(staging):
+                continue
+            try:
+                if stats["exit_code"] == 0:
+                    # ATTACH can't be run in a transaction
+                    connection.execute("ATTACH DATABASE ? AS staging", (staging,))
+                    try:
+                        with connection:
+                            connection.execute("INSERT INTO members SELECT ?, path, type, size, mtime, mode, sha256 FROM staging.members", (artifact_id,))
+                    finally:
+                        connection.execute("DETACH DATABASE staging")
+            finally:
+                os.remove(staging)
+
+        with connection:
+            connection.execute("UPDATE backups SET complete = ? WHERE id = ?", (1 if complete else 0, backup_id))
+
+    def remove_backup(self, name):
+        """
+            Forgets a backup.
+
+            :param name: Backup directory name (backup_<datetime>).
+            :type name: str
+        """
+
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM members WHERE artifact IN (SELECT a.id FROM artifacts AS a JOIN backups AS b ON a.backup = b.id WHERE b.name = ?)", (name,))
+            connection.execute("DELETE FROM artifacts WHERE backup IN (SELECT id FROM backups WHERE name = ?)", (name,))
+            connection.execute("DELETE FROM backups WHERE name = ?", (name,))
+
+    def backups(self):
+        """
+            Lists the recorded backups.
+
+            :return: Dicts with the backup name, datetime, wall time, completeness, number of artifacts and totals of their files, bytes_in and bytes_out, sorted by datetime.
+            :rtype: list
+        """
+
+        rows = self._connect().execute("""
+            SELECT b.name, b.datetime, b.wall_time, b.complete, COUNT(a.id), TOTAL(a.files), TOTAL(a.bytes_in), TOTAL(a.bytes_out)
+            FROM backups AS b LEFT JOIN artifacts AS a ON a.backup = b.id
+            GROUP BY b.id ORDER BY b.datetime
+        """)
+        return [{
+            "name": name, "datetime": backup_datetime, "wall_time": wall_time, "complete": bool(complete),
+            "artifacts": artifacts, "files": int(files), "bytes_in": int(bytes_in), "bytes_out": int(bytes_out),
+        } for name, backup_datetime, wall_time, complete, artifacts, files, bytes_in, bytes_out in rows]
+
+    def find(self, path):
+        """
+            Finds the backups containing a path.
+
+            :param path: Absolute path of the member. If it contains *, ? or [, it's matched as a glob pattern (like sqlite GLOB).
+            :type path: str
+            :return: Dicts with the backup name and datetime, the artifact output (joined to backup_dir), and the member path, type, size, mtime, mode and sha256, sorted by datetime and path.
+            :rtype: list
+        """
+
+        operator = "GLOB" if any(c in path for c in "*?[") else "="
+        rows = self._connect().execute("""
+            SELECT b.name, b.datetime, a.output, m.path, m.type, m.size, m.mtime, m.mode, m.sha256
+            FROM members AS m JOIN artifacts AS a ON m.artifact = a.id JOIN backups AS b ON a.backup = b.id
+            WHERE m.path {} ? ORDER BY b.datetime, m.path
+        """.format(operator), (path,))
+        keys = ["backup", "datetime", "output", "path", "type", "size", "mtime", "mode", "sha256"]
+        members = [dict(zip(keys, row)) for row in rows]
+        for member in members:
+            member["output"] = os.path.join(self._backup_dir, member["output"])
+        return members
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,510 @@
+"""
+    Content-defined chunking deduplication store.
+
+    In "dedup" mode, the tar stream of an artifact is split into chunks whose boundaries depend on their contents (a gear rolling hash), so that an insertion or a deletion only changes the chunks around it. Chunks are also cut at tar members boundaries, so that unchanged files give the same chunks. Chunks are addressed by their SHA-256 digest and stored once in the chunks directory of backup_dir, and the backup directory only contains a recipe (the ordered list of the chunks digests).
+
+    Chunks are reference counted: a chunk is deleted as soon as no recipe references it anymore. A recipe references its chunks as soon as it's complete, and the store is locked while recipes are written (shared) or released (exclusive), so that a cleanup running at the same time as a backup never deletes a chunk the backup found in the store. The chunks added by a recipe are journaled until it's complete, so that the cleanup deletes the ones of failed or interrupted backups (see ChunkStore.reclaim).
+"""
+
+import os
+import glob
+import zlib
+import sqlite3
+import hashlib
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ["CHUNKS_DIR", "RECIPE_EXTENSION", "ChunkStore", "ChunkWriter", "RecipeReader", "split_chunks"]
+
+CHUNKS_DIR = "chunks"
+"""Name of the chunk store, in backup_dir"""
+
+RECIPE_EXTENSION = "tar.recipe"
+"""Extension of recipe files"""
+
+_RECIPE_HEADER = "backupper-recipe 1\n"
+"""First line of a recipe"""
+
+_LOCK_FILE = "lock"
+"""Name of the lock file, in the chunk store"""
+
+_PENDING_DIR = "pending"
+"""Directory of the journals of the chunks added by unfinished recipes, in the chunk store"""
+
+MIN_CHUNK_SIZE = 16 * 1024
+"""Minimal size of a chunk (except the last one)"""
+
+MAX_CHUNK_SIZE = 256 * 1024
+"""Maximal size of a chunk"""
+
+_CUT_MASK = 0xFF0000FF
+"""A chunk ends where the bits of the gear hash selected by this mask are all zeros (about every 64 KiB past the minimal size)"""
+
+# The gear table is derived from a fixed hash so that chunk boundaries never change between versions, otherwise deduplication would be lost.
+_GEAR = [int.from_bytes(hashlib.sha256(b"backupper-gear" + bytes([b])).digest()[:4], "big") for b in range(256)]
+_GEAR_LOW = bytes(g & 0xFF for g in _GEAR)
+
+def split_chunks(data, final=False):
+    """
+        Finds the chunk boundaries of a buffer.
+
+        Boundaries are found with a gear rolling hash (h = (h << 1) + gear[byte], on 32 bits, so it covers the last 32 bytes): a chunk ends where h & _CUT_MASK == 0, and is kept between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE long. As hashing each byte in Python is slow, the low byte of the hash (the first 8 bits of _CUT_MASK) is computed for the whole buffer at once with integers arithmetic (see _gear_low_bytes), and the full hash is only computed where it's zero.
+
+        :param data: Data to split.
+        :type data: bytes
+        :param final: If True, the data tail is returned as a last chunk, otherwise it's left for the next call (it needs more data to find its boundary).
+        :type final: bool
+        :return: The chunks end offsets.
+        :rtype: list
+    """
+
+    low_bytes = _gear_low_bytes(data)
+    boundaries = []
+    start = 0
+    while len(data) - start > MIN_CHUNK_SIZE:
+        end = min(start + MAX_CHUNK_SIZE, len(data))
+        cut = -1
+        # position is the last byte of the chunk
+        position = low_bytes.find(b"\0", start + MIN_CHUNK_SIZE - 1, end)
+        while position >= 0:
+            if _gear_hash(data, position) & _CUT_MASK == 0:
+                cut = position + 1
+                break
+            position = low_bytes.find(b"\0", position + 1, end)
+        if cut >= 0:
+            start = cut
+        elif len(data) - start >= MAX_CHUNK_SIZE:
+            start += MAX_CHUNK_SIZE
+        else:
+            break
+        boundaries.append(start)
+    if final and start < len(data):
+        boundaries.append(len(data))
+    return boundaries
+
+def _gear_hash(data, position):
+    """
+        Computes the gear hash of a buffer after one of its bytes.
+
+        :param data: Data.
+        :type data: bytes
+        :param position: Offset of the byte (at least 31).
+        :type position: int
+        :return: The 32 bits hash.
+        :rtype: int
+    """
+
+    h = 0
+    for byte in data[position - 31:position + 1]:
+        h = ((h << 1) + _GEAR[byte]) & 0xFFFFFFFF
+    return h
+
+def _gear_low_bytes(data):
+    """
+        Computes the low byte of the gear hash after each byte of a buffer.
+
+        The low byte only depends on the low bytes of the last 8 gear values: sum(gear[data[i - j]] << j for j in range(8)) % 256. They're packed in 16 bits slots of an integer, and summed with shifted copies of it (each one doubling the number of summed values), which fits in the slots.
+
+        :param data: Data.
+        :type data: bytes
+        :return: The hash low bytes (the first 7 ones are partial).
+        :rtype: bytes
+    """
+
+    packed = bytearray(2 * len(data))
+    packed[::2] = data.translate(_GEAR_LOW)
+    sums = int.from_bytes(packed, "little")
+    for shift in (17, 34, 68):
+        sums += sums << shift
+    return sums.to_bytes(2 * len(data) + 16, "little")[:2 * len(data):2]
+
+class ChunkStore:
+    """
+        Chunk store of a backup directory.
+
+        Reference counts are kept in a SQLite database in the store, along with the recipes (relative to backup_dir) they come from, so that registering or releasing a recipe twice has no effect.
+    """
+
+    def __init__(self, backup_dir):
+        self.root = os.path.join(backup_dir, CHUNKS_DIR)
+        """Chunk store directory"""
+
+        self.stored_size = 0
+        """Size of the (compressed) chunks this object added to the store"""
+
+        self._backup_dir = backup_dir
+
+        self._connection = None
+
+    def chunk_path(self, digest):
+        """
+            Returns the path of a chunk.
+
+            :param digest: Hexadecimal SHA-256 digest of the chunk.
+            :type digest: str
+            :return: The chunk path.
+            :rtype: str
+        """
+
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data, journal=None):
+        """
+            Stores a chunk, unless it's already in the store.
+
+            Chunks are zlib-compressed, and written under a temporary name then renamed, so that concurrent writers never expose a partial chunk.
+
+            :param data: Chunk contents.
+            :type data: bytes
+            :param journal: If given, the digest of a new chunk is written to it before the chunk, so that it can be reclaimed if it's never referenced.
+            :type journal: file
+            :return: Hexadecimal SHA-256 digest of the chunk.
+            :rtype: str
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if not os.path.exists(path):
+            if journal is not None:
+                journal.write("{}\n".format(digest))
+                journal.flush()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(temporary_path, "wb") as f:
+                self.stored_size += f.write(zlib.compress(data))
+            os.replace(temporary_path, path)
+        return digest
+
+    def get(self, digest):
+        """
+            Reads a chunk.
+
+            :param digest: Hexadecimal SHA-256 digest of the chunk.
+            :type digest: str
+            :return: Chunk contents.
+            :rtype: bytes
+        """
+
+        with open(self.chunk_path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def read_recipe(self, recipe_path):
+        """
+            Iterates over the chunks of a recipe.
+
+            :param recipe_path: Recipe file path.
+            :type recipe_path: str
+            :return: Chunks contents, in order.
+            :rtype: iterator
+        """
+
+        for digest in _read_digests(recipe_path):
+            yield self.get(digest)
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        """
+            Locks the store, waiting for the lock.
+
+            Writers share the lock, so that backups run at once, and the cleanup takes it alone.
+
+            :param exclusive: If True, the lock is taken alone.
+            :type exclusive: bool
+        """
+
+        os.makedirs(self.root, exist_ok=True)
+        # The lock is held by the open file, so that it's released even if the process dies
+        with open(os.path.join(self.root, _LOCK_FILE), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def add_recipe(self, recipe):
+        """
+            References the chunks used by a recipe (the store must be locked).
+
+            :param recipe: Recipe file path.
+            :type recipe: str
+        """
+
+        connection = self._connect()
+        with connection:
+            recipe_name = os.path.relpath(recipe, self._backup_dir)
+            if connection.execute("SELECT 1 FROM recipes WHERE recipe = ?", (recipe_name,)).fetchone() is None:
+                connection.execute("INSERT INTO recipes VALUES (?)", (recipe_name,))
+                for digest in _read_digests(recipe):
+                    connection.execute("INSERT OR IGNORE INTO refs VALUES (?, 0)", (digest,))
+                    connection.execute("UPDATE refs SET count = count + 1 WHERE digest = ?", (digest,))
+
+    def remove_recipe(self, recipe):
+        """
+            Releases the chunks used by a recipe, and deletes the ones which aren't referenced anymore (the store must be locked exclusively).
+
+            It must be called before deleting the recipe.
+
+            :param recipe: Recipe file path.
+            :type recipe: str
+            :return: The number of deleted chunks.
+            :rtype: int
+        """
+
+        connection = self._connect()
+        deleted_chunks = 0
+        with connection:
+            if connection.execute("DELETE FROM recipes WHERE recipe = ?", (os.path.relpath(recipe, self._backup_dir),)).rowcount == 0:
+                return 0
+            for digest in _read_digests(recipe):
+                connection.execute("UPDATE refs SET count = count - 1 WHERE digest = ?", (digest,))
+                if connection.execute("DELETE FROM refs WHERE digest = ? AND count <= 0", (digest,)).rowcount > 0:
+                    try:
+                        os.remove(self.chunk_path(digest))
+                        deleted_chunks += 1
+                    except FileNotFoundError:
+                        pass
+        return deleted_chunks
+
+    def add_backup(self, backup_dir):
+        """
+            References the chunks used by the recipes of a backup directory (the ones ChunkWriter didn't reference already).
+
+            :param backup_dir: Backup directory (backup_<datetime>).
+            :type backup_dir: str
+        """
+
+        with self.locked():
+            for recipe in _list_recipes(backup_dir):
+                self.add_recipe(recipe)
+
+    def remove_backup(self, backup_dir):
+        """
+            Releases the chunks used by the recipes of a backup directory, and deletes the ones which aren't referenced anymore.
+
+            It must be called before deleting the backup directory.
+
+            :param backup_dir: Backup directory (backup_<datetime>).
+            :type backup_dir: str
+            :return: The number of deleted chunks.
+            :rtype: int
+        """
+
+        with self.locked(exclusive=True):
+            return sum(self.remove_recipe(recipe) for recipe in _list_recipes(backup_dir))
+
+    def reclaim(self):
+        """
+            Deletes the chunks added by unfinished recipes (failed or interrupted backups) which aren't referenced.
+
+            Their writers may have shared them with other backups, so they can only be deleted once no backup is running, with the store locked exclusively.
+
+            :return: The number of deleted chunks.
+            :rtype: int
+        """
+
+        pending_dir = os.path.join(self.root, _PENDING_DIR)
+        deleted_chunks = 0
+        with self.locked(exclusive=True):
+            if not os.path.isdir(pending_dir):
+                return 0
+            connection = self._connect()
+            for journal in os.listdir(pending_dir):
+                journal = os.path.join(pending_dir, journal)
+                with open(journal, "r") as f:
+                    digests = [line.strip() for line in f if line.endswith("\n")]
+                for digest in digests:
+                    if connection.execute("SELECT 1 FROM refs WHERE digest = ?", (digest,)).fetchone() is not None:
+                        continue
+                    try:
+                        os.remove(self.chunk_path(digest))
+                        deleted_chunks += 1
+                    except FileNotFoundError:
+                        pass
+                    # A writer killed while writing the chunk leaves its temporary file
+                    for temporary_path in glob.glob("{}.*.tmp".format(glob.escape(self.chunk_path(digest)))):
+                        os.remove(temporary_path)
+                os.remove(journal)
+        return deleted_chunks
+
+    def _connect(self):
+        """
+            Opens the reference counts database.
+
+            :return: The database connection.
+            :rtype: sqlite3.Connection
+        """
+
+        if self._connection is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._connection = sqlite3.connect(os.path.join(self.root, "refcounts.sqlite"))
+            self._connection.execute("CREATE TABLE IF NOT EXISTS recipes (recipe TEXT PRIMARY KEY)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS refs (digest TEXT PRIMARY KEY, count INTEGER) WITHOUT ROWID")
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+class ChunkWriter:
+    """
+        Writable file object splitting its input into chunks, storing them and writing the corresponding recipe.
+
+        The store is locked (shared) until the recipe is complete and references its chunks, as chunks found in the store aren't referenced before. The chunks it adds are journaled until then.
+    """
+
+    _BUFFER_SIZE = 16 * MAX_CHUNK_SIZE
+    """Amount of data accumulated before looking for boundaries"""
+
+    def __init__(self, store, recipe_path):
+        self._store = store
+        self._lock = store.locked()
+        self._lock.__enter__()
+        try:
+            self._recipe = open(recipe_path, "x")
+            try:
+                pending_dir = os.path.join(store.root, _PENDING_DIR)
+                os.makedirs(pending_dir, exist_ok=True)
+                journal_descriptor, self._journal_path = tempfile.mkstemp(dir=pending_dir)
+                self._journal = os.fdopen(journal_descriptor, "w")
+            except:
+                self._recipe.close()
+                os.remove(recipe_path)
+                raise
+        except:
+            self._lock.__exit__(None, None, None)
+            raise
+        self._recipe.write(_RECIPE_HEADER)
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data):
+        self._position += len(data)
+        self._buffer.extend(data)
+        if len(self._buffer) >= self._BUFFER_SIZE:
+            self._flush_chunks(False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self._position
+
+    def cut(self):
+        """
+            Ends the current chunk here, if it's at least MIN_CHUNK_SIZE long.
+
+            Called before each tar member, so that an unchanged file gives the same chunks whatever the size changes of the files before it.
+        """
+
+        if len(self._buffer) >= MIN_CHUNK_SIZE:
+            self._flush_chunks(True)
+
+    def close(self):
+        """
+            Stores the last chunk, and references the chunks of the complete recipe.
+        """
+
+        if self._recipe.closed:
+            return
+        try:
+            self._flush_chunks(True)
+            self._recipe.close()
+            self._store.add_recipe(self._recipe.name)
+            self._journal.close()
+            os.remove(self._journal_path)
+        finally:
+            self._recipe.close()
+            self._journal.close()
+            self._lock.__exit__(None, None, None)
+
+    def abort(self):
+        """
+            Closes an incomplete recipe, without referencing its chunks (the caller deletes it).
+
+            The chunks it added stay in the store until the next cleanup (see ChunkStore.reclaim), as other backups may have found them in the store meanwhile.
+        """
+
+        if self._recipe.closed:
+            return
+        try:
+            self._recipe.close()
+            self._journal.close()
+        finally:
+            self._lock.__exit__(None, None, None)
+
+    def _flush_chunks(self, final):
+        """
+            Stores the complete chunks of the buffer.
+
+            :param final: If True, the buffer tail is stored as a last chunk.
+            :type final: bool
+        """
+
+        data = bytes(self._buffer)
+        start = 0
+        for end in split_chunks(data, final):
+            self._recipe.write("{}\n".format(self._store.put(data[start:end], self._journal)))
+            start = end
+        self._buffer = bytearray(data[start:])
+
+class RecipeReader:
+    """
+        Readable file object over the tar stream of a recipe.
+
+        Chunks are read from the store one at a time, as they're needed.
+    """
+
+    def __init__(self, store, recipe_path):
+        self._chunks = store.read_recipe(recipe_path)
+        self._buffer = b""
+        self._offset = 0
+
+    def read(self, size=-1):
+        data = []
+        while size < 0 or size > 0:
+            if self._offset == len(self._buffer):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer = chunk
+                self._offset = 0
+                continue
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._offset + size)
+            data.append(self._buffer[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b"".join(data)
+
+def _read_digests(recipe_path):
+    """
+        Iterates over the digests of a recipe.
+
+        :param recipe_path: Recipe file path.
+        :type recipe_path: str
+        :return: Hexadecimal digests, in order.
+        :rtype: iterator
+    """
+
+    with open(recipe_path, "r") as f:
+        if f.readline() != _RECIPE_HEADER:
+            raise ValueError("{} isn't a recipe.".format(recipe_path))
+        for line in f:
+            yield line.strip()
+
+def _list_recipes(backup_dir):
+    """
+        Lists the recipes of a backup directory.
+
+        :param backup_dir: Backup directory (backup_<datetime>).
+        :type backup_dir: str
+        :return: Paths of the recipes.
+        :rtype: list
+    """
+
+    return [os.path.join(root, f) for root, _, files in os.walk(backup_dir) for f in files if f.endswith(".{}".format(RECIPE_EXTENSION))]
@@ -1,46 +1,78 @@
 """
     backupper entrypoint.
+
+    Modules that are slow to import (yaml, gnupg, sqlite3, tarfile, concurrent.futures, the storages...) are imported by the functions needing them, so that a run only imports what its command uses, and -h or -V import nearly nothing.
 """
 
 import sys
 import os
-import shutil
 import getopt
-import re
-import yaml
-import tarfile
+import time
 import datetime
-import gnupg
 
 import backupper
 from . import utils
 
-__all__ = []
+__all__ = ["run_backup"]
+
+_COMMANDS = {
+    "backup": [],
+    "list": [],
+    "find": ["<path>"],
+    "extract": ["<archive>", "<member>"],
+    "restore": ["<backup>"],
+    "daemon": ["<daemon config>"],
+}
+"""Commands, with the arguments they expect"""
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+"""Format of the backups datetimes"""
+
+_BACKUP_FORMAT = r'backup_(?P<datetime_str>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2})$'
+"""Backup pattern: a backup created by this script should look like this"""
+
+_OVERRIDE_OPTIONS = ("-b", "--backup_dir", "-d", "--delete_old_backups", "-j", "--jobs")
+"""Command line options overriding the configuration file"""
 
 def main():
     """
         Main entrypoint.
     """
 
-    # Configuration variables
+    imports_time = time.perf_counter() - backupper._import_start
     configuration_file = "backupfile.yml"
-    configuration = None
+    configuration_files = []
     command_name = os.path.basename(sys.argv[0])
-    datetime_format = "%Y-%m-%dT%H:%M:%S"
-    backup_format = r'backup_(?P<datetime_str>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2})$'
-    backup_datetime = datetime.datetime.utcnow().strftime(datetime_format)
-    overrides = {}
+    report_file = None
+    profile_file = None
+    startup_profile = False
+    dry_run = False
+    target = os.getcwd()
 
     ## Initialisation ##
 
     # Fetch command line arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "f:hVb:d:", ["config-file=", "help", "version", "backup_dir=", "delete_old_backups="])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "f:hVb:d:j:nt:", ["config-file=", "help", "version", "backup_dir=", "delete_old_backups=", "jobs=", "dry-run", "target=", "report=", "profile=", "startup-profile"])
     except getopt.GetoptError as e:
         sys.stderr.write("Error: command line arguments: {}\n".format(e))
         sys.stderr.write("Try {} -h for help.\n".format(command_name))
         sys.exit(1)
 
+    # The command is the first argument, followed by its own arguments
+    command = args[0] if len(args) > 0 else "backup"
+    if not command in _COMMANDS or len(args[1:]) != len(_COMMANDS[command]):
+        sys.stderr.write("Error: command line arguments: expected one of {}.\n".format(", ".join(" ".join([c] + _COMMANDS[c]) for c in sorted(_COMMANDS))))
+        sys.stderr.write("Try {} -h for help.\n".format(command_name))
+        sys.exit(1)
+
+    # Paths given to find are relative to the current directory (which changes once the configuration is loaded), members are recorded with absolute paths
+    if command in ("find", "extract"):
+        args[1] = os.path.abspath(args[1])
+    # A backup to restore is either a path or a name in backup_dir
+    if command == "restore" and os.path.exists(args[1]):
+        args[1] = os.path.abspath(args[1])
+
     # Command line options that need to be treated before loading the configuration file
     for opt, arg in opts:
         if opt in ("-h", "--help"):
@@ -50,51 +82,421 @@ def main():
             sys.stdout.write("{}\n".format(utils.get_version()))
             sys.exit(0)
         if opt in ("-f", "--config-file"):
-            configuration_file = str(arg)
+            configuration_files.append(str(arg))
+        if opt in ("-n", "--dry-run"):
+            dry_run = True
+        if opt in ("-t", "--target"):
+            target = os.path.abspath(arg)
+        if opt == "--report":
+            report_file = os.path.abspath(arg)
+        if opt == "--profile":
+            profile_file = os.path.abspath(arg)
+        if opt == "--startup-profile":
+            startup_profile = True
+
+    if len(configuration_files) == 0:
+        configuration_files.append(configuration_file)
+
+    # The daemon runs the configurations of its jobs, each one with its own report
+    if command == "daemon":
+        from . import daemon
+        daemon.main(args[1])
+
+    # The run report is written whatever the way the run ends, with its exit code (report imports json, which -h and -V don't need)
+    from . import report
+    run_metrics = report.Metrics()
+    run_metrics.add_time("imports", imports_time)
+    run_report = {
+        "version": backupper.__version__,
+        "configuration_file": os.path.abspath(configuration_files[0]) if len(configuration_files) == 1 else [os.path.abspath(f) for f in configuration_files],
+        "start": datetime.datetime.utcnow().isoformat(),
+        "exit_code": None,
+        "dry_run": dry_run,
+        "artifacts": [],
+    }
+    profiler = None
+    if profile_file is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+
+    try:
+        _run(opts, configuration_files, command, args[1:], dry_run, target, startup_profile, run_metrics, run_report)
+    except SystemExit as e:
+        run_report["exit_code"] = e.code
+        raise
+    finally:
+        run_metrics.exit_all()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if report_file is not None:
+            run_report["wall_time"] = time.perf_counter() - start
+            run_report.update(run_metrics.as_dict())
+            run_report["totals"] = report.total(run_report["artifacts"])
+            try:
+                report.write_report(report_file, run_report)
+            except OSError as e:
+                sys.stderr.write("Error: report: {}\n".format(e))
+
+def _run(opts, configuration_files, command, command_args, dry_run, target, startup_profile, run_metrics, run_report):
+    """
+        Loads the configuration, then backups the artifacts and cleans the old backups, or runs another command.
+
+        :param opts: Command line options.
+        :type opts: list
+        :param configuration_files: Configuration file paths (several ones make a multi-job run, see _run_jobs).
+        :type configuration_files: list
+        :param command: Command to run (a _COMMANDS key).
+        :type command: str
+        :param command_args: Arguments of the command.
+        :type command_args: list
+        :param dry_run: If True, no backup is made and no old backup is deleted: the cleaning plan is only displayed.
+        :type dry_run: bool
+        :param target: Directory the extract and restore commands write to.
+        :type target: str
+        :param startup_profile: If True, the time spent importing backupper and loading the configuration is displayed.
+        :type startup_profile: bool
+        :param run_metrics: Metrics of the run (time spent outside of the artifacts, deleted backups...).
+        :type run_metrics: backupper.report.Metrics
+        :param run_report: Run report, the statistics of each artifact are added to its "artifacts" list.
+        :type run_report: dict
+    """
+
+    # Configuration variables
+    configuration = None
+    backup_datetime = datetime.datetime.utcnow().strftime(_DATETIME_FORMAT)
+
+    # Extracting from an archive doesn't need the configuration
+    if command == "extract":
+        _extract(command_args[0], command_args[1], target, run_metrics)
+        sys.exit(0)
+
+    # Several configuration files are run as the backups of a multi-job run
+    run_metrics.enter("configuration")
+    if len(configuration_files) > 1:
+        _run_jobs(opts, {"backups": [os.path.abspath(f) for f in configuration_files]}, os.getcwd(), command, backup_datetime, dry_run, startup_profile, run_metrics, run_report)
+    configuration_file = configuration_files[0]
+
+    # Parse and validate the configuration file, with the command line options overriding it
+    configuration, overrides = _load_configuration(configuration_file, opts, run_metrics)
+
+    # A configuration listing backups is a multi-job run
+    if "backups" in configuration:
+        _run_jobs(opts, configuration, os.path.dirname(os.path.abspath(configuration_file)), command, backup_datetime, dry_run, startup_profile, run_metrics, run_report)
+    run_metrics.exit()
+    if startup_profile:
+        _display_startup_profile(run_metrics)
+
+    # Display info about overridden parameters
+    for override in overrides:
+        sys.stderr.write("Warning: command line argument overrides \"{}\" (value: {}).\n".format(override, overrides[override]))
+
+    # The configuration file directory sets the backup context, so if it's not in the current directory, let's change the working directory
+    if os.path.dirname(configuration_file) != "":
+        os.chdir(os.path.dirname(configuration_file))
+
+    # Catalog queries
+    if command in ("list", "find"):
+        _query_catalog(configuration, command, command_args)
+        sys.exit(0)
+
+    ## Actual backups ##
+
+    if command == "restore":
+        import re
+        _restore(configuration, command_args[0], re.compile(_BACKUP_FORMAT), target, run_metrics, run_report)
+        sys.exit(0)
+
+    run_backup(configuration, backup_datetime, dry_run, run_metrics, run_report)
+    sys.exit(0)
+
+def _load_configuration(configuration_file, opts, run_metrics):
+    """
+        Parses a configuration file, applies the command line options overriding it and validates it, or reads it from the configuration cache (see backupper.configcache). Errors are displayed, then exit.
+
+        :param configuration_file: Configuration file path.
+        :type configuration_file: str
+        :param opts: Command line options.
+        :type opts: list
+        :param run_metrics: Metrics of the run, getting the time spent in the "cache", "yaml" and "validation" stages.
+        :type run_metrics: backupper.report.Metrics
+        :return: The validated configuration and its overridden values (by configuration key). A configuration listing backups isn't validated, as a multi-job run validates its backups (see _run_jobs).
+        :rtype: tuple
+    """
+
+    from . import configcache
 
-    # Parse the configuration file
     print("Loading {}.".format(configuration_file))
+
+    # Overridden configurations aren't cached
+    cached = not any(opt in _OVERRIDE_OPTIONS for opt, _ in opts)
+    if cached:
+        with run_metrics.stage("cache"):
+            configuration = configcache.get(configuration_file)
+        if configuration is not None:
+            run_metrics.counters["configuration_cache_hits"] += 1
+            try:
+                utils.validate_environment(configuration)
+            except Exception as e:
+                sys.stderr.write("Error: configuration validation: {}\n".format(e))
+                sys.exit(3)
+            return configuration, {}
+
     try:
-        with open(configuration_file, "r") as f:
-            configuration = yaml.load(f)
+        with open(configuration_file, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        with run_metrics.stage("yaml"):
+            configuration = utils.load_yaml(data)
     except Exception as e:
         sys.stderr.write("Error: yaml parsing: {}\n".format(e))
         sys.exit(2)
 
-    # Command line options overriding the configuration file
-    for opt, arg, in opts:
+    if isinstance(configuration, dict) and "backups" in configuration:
+        return configuration, {}
+
+    overrides = _override_configuration(configuration, opts)
+    try:
+        with run_metrics.stage("validation"):
+            utils.validate_configuration(configuration)
+    except Exception as e:
+        sys.stderr.write("Error: configuration validation: {}\n".format(e))
+        sys.exit(3)
+
+    if cached:
+        configcache.put(configuration_file, st, data, configuration)
+    return configuration, overrides
+
+def _display_startup_profile(run_metrics):
+    """
+        Displays the time spent importing backupper and loading the configuration.
+
+        :param run_metrics: Metrics of the run.
+        :type run_metrics: backupper.report.Metrics
+    """
+
+    stages = run_metrics.stages
+    sys.stderr.write("Startup profile:\n")
+    sys.stderr.write("  imports: {:.1f} ms\n".format(stages.get("imports", 0.0) * 1000))
+    sys.stderr.write("  configuration cache: {:.1f} ms (hits: {})\n".format(stages.get("cache", 0.0) * 1000, run_metrics.counters["configuration_cache_hits"]))
+    # Cached configurations don't import yaml at all
+    if "yaml" in stages:
+        sys.stderr.write("  yaml import and parsing ({} parser): {:.1f} ms\n".format(utils.yaml_parser(), stages["yaml"] * 1000))
+    sys.stderr.write("  validation: {:.1f} ms\n".format(stages.get("validation", 0.0) * 1000))
+    sys.stderr.write("  other configuration loading: {:.1f} ms\n".format(stages.get("configuration", 0.0) * 1000))
+
+def _override_configuration(configuration, opts):
+    """
+        Applies the command line options overriding a configuration (before its validation).
+
+        :param configuration: Configuration loaded from the configuration file.
+        :type configuration: dict
+        :param opts: Command line options.
+        :type opts: list
+        :return: The overridden values, by configuration key.
+        :rtype: dict
+    """
+
+    overrides = {}
+    if not isinstance(configuration, dict):
+        return overrides
+    for opt, arg in opts:
         if opt in ("-b", "--backup_dir"):
             configuration["backup_dir"] = str(arg)
             overrides["backup_dir"] = configuration["backup_dir"]
         if opt in ("-d", "--delete_old_backups"):
             configuration["delete_old_backups"] = not arg.lower() in ("false", "no", "f", "0", "")
             overrides["delete_old_backups"] = configuration["delete_old_backups"]
+        if opt in ("-j", "--jobs"):
+            try:
+                configuration["jobs"] = int(arg)
+            except ValueError:
+                configuration["jobs"] = arg
+            overrides["jobs"] = configuration["jobs"]
+    return overrides
+
+def _run_jobs(opts, jobs_configuration, base_dir, command, backup_datetime, dry_run, startup_profile, run_metrics, run_report):
+    """
+        Runs the backups of a multi-job run at once, within the resource budget (see backupper.scheduler), then exits.
+
+        Each backup runs in a thread, once the budget allows it. The run exits with the exit code of the first backup that failed, and its report gets the report of each backup in "jobs".
+
+        :param opts: Command line options.
+        :type opts: list
+        :param jobs_configuration: Configuration with a "backups" node, listing configuration files or nodes, and an optional "budget".
+        :type jobs_configuration: dict
+        :param base_dir: Directory the configuration files listed in "backups" and the paths of the configuration nodes are relative to.
+        :type base_dir: str
+        :param command: Command to run (only backup can run several backups).
+        :type command: str
+        :param backup_datetime: Formatted datetime of the backups.
+        :type backup_datetime: str
+        :param dry_run: If True, no backup is made and no old backup is deleted: the cleaning plan of each backup is only displayed.
+        :type dry_run: bool
+        :param startup_profile: If True, the time spent importing backupper and loading the configurations is displayed.
+        :type startup_profile: bool
+        :param run_metrics: Metrics of the run (time spent loading the configurations and running the backups).
+        :type run_metrics: backupper.report.Metrics
+        :param run_report: Run report.
+        :type run_report: dict
+    """
+
+    if command != "backup":
+        sys.stderr.write("Error: command line arguments: {} needs a single backup configuration.\n".format(command))
+        sys.exit(1)
+    if any(opt in ("-b", "--backup_dir") for opt, _ in opts):
+        sys.stderr.write("Error: command line arguments: -b can't override the backup directory of several backups.\n")
+        sys.exit(1)
 
-    # Validate the configuration file
     try:
-        utils.validate_configuration(configuration)
+        utils.validate_jobs_configuration(jobs_configuration)
     except Exception as e:
         sys.stderr.write("Error: configuration validation: {}\n".format(e))
         sys.exit(3)
 
-    # Display info about overridden parameters
-    for override in overrides:
-        sys.stderr.write("Warning: command line argument overrides \"{}\" (value: {}).\n".format(override, overrides[override]))
+    # Each backup is loaded and validated like a single configuration, its relative paths being relative to its own file
+    jobs = []
+    for index, backup in enumerate(jobs_configuration["backups"]):
+        if isinstance(backup, str):
+            name = os.path.abspath(os.path.join(base_dir, backup))
+            configuration, overrides = _load_configuration(name, opts, run_metrics)
+            if "backups" in configuration:
+                sys.stderr.write("Error: configuration validation: {}: \"backups\" can't list configurations listing backups.\n".format(name))
+                sys.exit(3)
+            configuration_dir = os.path.dirname(name)
+        else:
+            name = "backups[{}]".format(index)
+            configuration = backup
+            configuration_dir = base_dir
+            overrides = _override_configuration(configuration, opts)
+            try:
+                with run_metrics.stage("validation"):
+                    utils.validate_configuration(configuration)
+            except Exception as e:
+                sys.stderr.write("Error: configuration validation: {}: {}\n".format(name, e))
+                sys.exit(3)
+
+        for override in overrides:
+            sys.stderr.write("Warning: command line argument overrides \"{}\" of {} (value: {}).\n".format(override, name, overrides[override]))
+        utils.resolve_paths(configuration, configuration_dir)
+        jobs.append((name, configuration))
+
+    # Backups of the same second would share their backup directory
+    backup_dirs = [configuration["backup_dir"] for _, configuration in jobs]
+    if len(set(backup_dirs)) != len(backup_dirs):
+        sys.stderr.write("Error: configuration validation: several backups share the same \"backup_dir\".\n")
+        sys.exit(3)
+    run_metrics.exit()
+    if startup_profile:
+        _display_startup_profile(run_metrics)
+
+    if dry_run:
+        for name, configuration in jobs:
+            print("{}:".format(name))
+            run_backup(configuration, backup_datetime, True, run_metrics, run_report)
+        sys.exit(0)
+
+    import concurrent.futures
+    from . import report
+    from . import scheduler
+    budget = scheduler.ResourceBudget(**jobs_configuration["budget"])
+    run_report["jobs"] = [None] * len(jobs)
+
+    def run_job(index):
+        name, configuration = jobs[index]
+        job_metrics = report.Metrics()
+        job_report = {"configuration_file": name, "exit_code": None, "artifacts": []}
+        jobs_before = configuration["jobs"]
+        needs = budget.needs(configuration)
+        if configuration["jobs"] != jobs_before:
+            sys.stderr.write("Warning: {}: \"jobs\" lowered to {} to fit in the budget.\n".format(name, configuration["jobs"]))
+
+        budget.acquire(needs)
+        start = time.perf_counter()
+        try:
+            print("{}: starting.".format(name))
+            # A failed backup exits, which only ends its thread
+            try:
+                run_backup(configuration, backup_datetime, False, job_metrics, job_report)
+                job_report["exit_code"] = 0
+            except SystemExit as e:
+                job_report["exit_code"] = e.code
+            except Exception as e:
+                sys.stderr.write("Error: {}: {}\n".format(name, e))
+                job_report["exit_code"] = 1
+        finally:
+            budget.release(needs)
+            job_metrics.exit_all()
+            job_report["wall_time"] = time.perf_counter() - start
+            job_report.update(job_metrics.as_dict())
+            job_report["totals"] = report.total(job_report["artifacts"])
+            run_report["jobs"][index] = job_report
+        print("{}: done (exit code {}, {:.1f}s).".format(name, job_report["exit_code"], job_report["wall_time"]))
+
+    with run_metrics.stage("jobs"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            for _ in executor.map(run_job, range(len(jobs))):
+                pass
+
+    for job_report in run_report["jobs"]:
+        run_report["artifacts"].extend(job_report["artifacts"])
+    for job_report in run_report["jobs"]:
+        if job_report["exit_code"] != 0:
+            sys.exit(job_report["exit_code"])
+    sys.exit(0)
 
-    # The configuration file directory sets the backup context, so if it's not in the current directory, let's change the working directory
-    if os.path.dirname(configuration_file) != "":
-        os.chdir(os.path.dirname(configuration_file))
+def run_backup(configuration, backup_datetime, dry_run, run_metrics, run_report, storage=None):
+    """
+        Backups the artifacts of a configuration, then cleans the old backups.
+
+        Relative paths of the configuration are relative to the current directory. Errors are displayed, then exit with their exit code (sys.exit), so that a caller running several backups in the same process catches SystemExit (see backupper.daemon).
+
+        :param configuration: Validated configuration.
+        :type configuration: dict
+        :param backup_datetime: Formatted datetime of the backup.
+        :type backup_datetime: str
+        :param dry_run: If True, no backup is made and no old backup is deleted: the cleaning plan is only displayed.
+        :type dry_run: bool
+        :param run_metrics: Metrics of the run (time spent outside of the artifacts, deleted backups...).
+        :type run_metrics: backupper.report.Metrics
+        :param run_report: Run report, the statistics of each artifact are added to its "artifacts" list.
+        :type run_report: dict
+        :param storage: Storage to upload the backup to, instead of instantiating the "storage" of the configuration. It's connected if needed, and stays connected to be reused by the next backups.
+        :type storage: backupper.connect.AbstractStorageContext
+        :return: The process emptying the trash in the background, if one has been started (the caller may have to wait for it).
+        :rtype: subprocess.Popen
+    """
 
-    # If needed, we initialize our gpg object
-    gpg = None
-    if configuration["encrypt"]:
-        gpg = gnupg.GPG(gnupghome=configuration["gnupg"]["home"])
+    import re
+    from . import archive
+    from . import chunkstore
+    from . import catalog
+    from . import trash
 
-    ## Actual backups ##
+    backup_pattern = re.compile(_BACKUP_FORMAT)
+
+    # Incremental backups and snapshots are based on the most recent backup
+    previous_backup = None
+    if (configuration["incremental"]["enabled"] or any(artifact["mode"] == "snapshot" for artifact in configuration["artifacts"])) and os.path.isdir(configuration["backup_dir"]):
+        previous_backups = _list_backups(configuration["backup_dir"], backup_pattern)
+        if len(previous_backups) > 0:
+            previous_backup_dir = max(previous_backups)
+            previous_backup = (previous_backup_dir, backup_pattern.search(previous_backup_dir).group("datetime_str"))
 
     # Our actual backup will take place in a timestampped subdir
     actual_backup_dir = os.path.join(configuration["backup_dir"], "backup_{}".format(backup_datetime))
 
+    # A dry run only tells what the cleaning policy would delete after a backup made now
+    if dry_run:
+        if configuration["delete_old_backups"]:
+            with run_metrics.stage("cleanup"):
+                _clean_backups(configuration, backup_pattern, _DATETIME_FORMAT, actual_backup_dir, run_metrics, True)
+        else:
+            sys.stdout.write("Old backups cleaning is disabled (delete_old_backups).\n")
+        return None
+
     # We create our backup dir
     try:
         os.makedirs(actual_backup_dir)
@@ -103,121 +505,403 @@ def main():
         sys.exit(4)
 
     # As we allow absolute path, we must absolutize all of them so that os.path.commonpath can work (but also to have a coherent backup dir structure)
-    configuration["artifacts"] = [os.path.abspath(artifact) for artifact in configuration["artifacts"]]
+    for artifact in configuration["artifacts"]:
+        artifact["path"] = os.path.abspath(artifact["path"])
 
     # We need to know the common path for artifacts to remove it from the backup output structure
-    common_artifact_path = os.path.commonpath(configuration["artifacts"])
+    common_artifact_path = os.path.commonpath([artifact["path"] for artifact in configuration["artifacts"]])
+
+    # Artifacts are uploaded to the storage as soon as they're archived, while the next ones are being archived
+    uploader = None
+    on_result = None
+    if configuration["storage"] is not None:
+        from . import upload
+        try:
+            if storage is None:
+                uploader = upload.Uploader(upload.open_storage(configuration["storage"]), actual_backup_dir, configuration["storage"]["path"], configuration["storage"]["queue_size"])
+            else:
+                uploader = upload.Uploader(storage, actual_backup_dir, configuration["storage"]["path"], configuration["storage"]["queue_size"], keep_connected=True)
+        except Exception as e:
+            sys.stderr.write("Error: storage: {}\n".format(e))
+            sys.exit(8)
+        uploader.start()
+
+        def on_result(stats):
+            # Waiting for a free slot in the queue is time lost to the upload
+            with run_metrics.stage("upload"):
+                uploader.put(upload.artifact_outputs(stats))
 
     # Backup each artifact
     print("Backupping artifacts.")
-    for artifact in configuration["artifacts"]:
-        if not os.path.exists(artifact):
-            sys.stderr.write("Warning: backup: {} doesn't exist (skipping).\n".format(artifact))
-            continue
+    run_report["backup"] = os.path.abspath(actual_backup_dir)
+    backup_args = (actual_backup_dir, common_artifact_path, backup_datetime, configuration, previous_backup)
+    run_metrics.enter("backup")
+    backup_start = time.perf_counter()
+    backup_done = False
+    try:
+        _map_artifacts(archive.backup_artifact, configuration["artifacts"], backup_args, configuration["jobs"], run_report["artifacts"], on_result)
+        backup_done = True
+    finally:
+        run_metrics.exit()
+        # A failed backup isn't uploaded any further
+        if uploader is not None and not backup_done:
+            uploader.close(abort=True)
+        backup_wall_time = time.perf_counter() - backup_start
+        # Chunks written by dedup artifacts are referenced even if we exit on an error, as their recipes stay in the backup directory
+        if any(artifact["mode"] == "dedup" for artifact in configuration["artifacts"]):
+            with run_metrics.stage("register"):
+                store = chunkstore.ChunkStore(configuration["backup_dir"])
+                store.add_backup(actual_backup_dir)
+                store.close()
+        # The backup is cataloged even if we exit on an error, marked as incomplete
+        if configuration["catalog"]["enabled"]:
+            with run_metrics.stage("catalog"):
+                complete = len(run_report["artifacts"]) == len(configuration["artifacts"]) and all(stats["exit_code"] == 0 for stats in run_report["artifacts"])
+                backup_catalog = catalog.Catalog(configuration["backup_dir"])
+                backup_catalog.add_backup(os.path.basename(actual_backup_dir), backup_datetime, backup_wall_time, run_report["artifacts"], complete)
+                backup_catalog.close()
+
+    # Old backups are only deleted once the new one is safe on the storage
+    if uploader is not None:
+        with run_metrics.stage("upload"):
+            uploader.close()
+        run_metrics.counters.update(uploader.counters)
+        if len(uploader.errors) > 0:
+            for error in uploader.errors:
+                sys.stderr.write("Error: storage: {}\n".format(error))
+            sys.exit(8)
+        print("{} outputs uploaded ({:.1f} MiB).".format(uploader.counters["uploaded_outputs"], uploader.counters["bytes_uploaded"] / 1024 / 1024))
 
-        # If our artifact is a directory we must remove the trailing slash so that os.path.basename can properly work
-        if os.path.isdir(artifact):
-            if artifact.endswith('/'):
-                artifact = artifact[:-1]
+    ## Old backups cleaning ##
 
-        # Build the output tar path
-        output_tar = "{}.{}.tar.gz".format(os.path.join(actual_backup_dir, os.path.relpath(artifact, common_artifact_path)), backup_datetime)
-        final_output = output_tar
+    if configuration["delete_old_backups"]:
+        with run_metrics.stage("cleanup"):
+            _clean_backups(configuration, backup_pattern, _DATETIME_FORMAT, actual_backup_dir, run_metrics)
 
-        # Create subdirectories
-        try:
-            os.makedirs(os.path.dirname(output_tar))
-        except OSError as e:
-            if e.errno != os.errno.EEXIST:
-                sys.stderr.write("Error: backup: {}\n".format(e))
-                sys.exit(4)
-
-        # Write the actual tar file
-        with tarfile.open(output_tar, "w:gz") as tar:
-            tar.add(artifact, arcname=os.path.basename(artifact))
-
-        # If needed, encrypt the file
-        if configuration["encrypt"]:
-            try:
-                output_gpg = "{}.gpg".format(output_tar)
-                with open(output_tar, "rb") as f:
-                    encrypt_status = gpg.encrypt_file(f, recipients=configuration["gnupg"]["keyid"], output=output_gpg)
-
-                if not encrypt_status.ok:
-                    sys.stderr.write("Grave: encrypt: gnupg returned a non ok status ({}).\n".format(encrypt_status.status))
-                    sys.stderr.write("                gpg stderr is: \n{}".format(encrypt_status.stderr))
-                else:
-                    final_output = output_gpg
-            except Exception as e:
-                sys.stderr.write("Error: encrypt: {}\n".format(e))
-                sys.exit(5)
+    # The trash holds the backups deleted by this run, and the ones an interrupted emptier left
+    emptier = None
+    if trash.has_entries(configuration["backup_dir"]):
+        with run_metrics.stage("trash"):
+            emptier = _empty_trash(configuration, run_metrics)
 
-            try:
-                os.remove(output_tar)
-            except OSError as e:
-                sys.stderr.write("Grave: encrypt: unable to delete {}, non encrypted backup ({}).\n".format(output_tar, e))
+    return emptier
 
-        sys.stdout.write("{} done.\n".format(final_output))
+def _clean_backups(configuration, backup_pattern, datetime_format, current_backup, run_metrics, dry_run=False):
+    """
+        Applies the cleaning policy to the old backups.
+
+        :param configuration: Validated configuration.
+        :type configuration: dict
+        :param backup_pattern: Compiled backup_format.
+        :type backup_pattern: re.Pattern
+        :param datetime_format: Format of the backups datetimes.
+        :type datetime_format: str
+        :param current_backup: Path of the current backup, which is always kept (in a dry run, it doesn't exist yet).
+        :type current_backup: str
+        :param run_metrics: Metrics of the run, counting the deleted backups and chunks.
+        :type run_metrics: backupper.report.Metrics
+        :param dry_run: If True, nothing is deleted: each old backup is displayed with the rules keeping it, or as "would be deleted".
+        :type dry_run: bool
+    """
 
-    ## Old backups cleaning ##
+    import shutil
+    from . import manifest
+    from . import chunkstore
+    from . import retention
+    from . import catalog
+    from . import trash
+
+    policy = configuration["cleaning_policy"]
+    has_cleaning_policy = not (all(policy[key] == 0 for key in policy))
+    sys.stdout.write("Cleaning old backups{}. Strategy:".format(" (dry run)" if dry_run else ""))
+
+    if has_cleaning_policy:
+        sys.stdout.write("\n")
+        for rule in sorted(policy):
+            sys.stdout.write("    {}: {}\n".format(rule, policy[rule]))
+    else:
+        sys.stdout.write("all.\n")
+
+    # We always keep the current backup so we remove it from the old ones
+    if not os.path.isdir(configuration["backup_dir"]):
+        return
+    # Chunks added by failed or interrupted backups are deleted, unless other backups use them
+    if not dry_run and os.path.isdir(os.path.join(configuration["backup_dir"], chunkstore.CHUNKS_DIR)):
+        store = chunkstore.ChunkStore(configuration["backup_dir"])
+        run_metrics.counters["deleted_chunks"] += store.reclaim()
+        store.close()
+    old_backups = [backup for backup in _list_backups(configuration["backup_dir"], backup_pattern) if backup != current_backup]
+    if len(old_backups) == 0:
+        return
+
+    def backup_time(backup):
+        return datetime.datetime.strptime(backup_pattern.search(backup).group("datetime_str"), datetime_format)
+
+    index = retention.BackupIndex((backup_time(backup), backup) for backup in old_backups)
+    kept_by = retention.select(index, policy, backup_time(current_backup))
+    backups_to_keep = set().union(*kept_by.values())
+
+    # Incremental backups can't be restored without the backups they're based on. The current backup of a dry run doesn't exist, but unless it's due for a full backup it would be based on the most recent one, which is kept as its parent.
+    kept_by["incremental parent"] = set()
+    backups_to_check = [] if dry_run else [current_backup]
+    if dry_run and configuration["incremental"]["enabled"] and manifest.continues_chain(index.backups[-1], configuration["incremental"]["full_every"]):
+        if not index.backups[-1] in backups_to_keep:
+            backups_to_keep.add(index.backups[-1])
+            kept_by["incremental parent"].add(index.backups[-1])
+        backups_to_check.append(index.backups[-1])
+    backups_to_check.extend(backups_to_keep)
+    old_backups = set(old_backups)
+    while len(backups_to_check) > 0:
+        for parent in manifest.parent_backups(backups_to_check.pop()):
+            parent = os.path.join(configuration["backup_dir"], parent)
+            if parent in old_backups and not parent in backups_to_keep:
+                backups_to_keep.add(parent)
+                kept_by["incremental parent"].add(parent)
+                backups_to_check.append(parent)
+
+    store = chunkstore.ChunkStore(configuration["backup_dir"])
+    backup_catalog = catalog.Catalog(configuration["backup_dir"])
+    for backup in index.backups:
+        if backup in backups_to_keep:
+            if dry_run:
+                sys.stdout.write("{} kept ({}).\n".format(backup, ", ".join(rule for rule in retention.POLICY_RULES + ["incremental parent"] if backup in kept_by[rule])))
+        elif dry_run:
+            sys.stdout.write("{} would be deleted.\n".format(backup))
+        else:
+            # Chunks must be released while the recipes still exist
+            if os.path.isdir(store.root):
+                run_metrics.counters["deleted_chunks"] += store.remove_backup(backup)
+            if os.path.isfile(backup_catalog.path):
+                backup_catalog.remove_backup(os.path.basename(backup))
+            run_metrics.counters["deleted_backups"] += 1
+            if configuration["trash"]["enabled"]:
+                trash.move_to_trash(configuration["backup_dir"], backup)
+                sys.stdout.write("{} moved to the trash.\n".format(backup))
+            else:
+                shutil.rmtree(backup)
+                sys.stdout.write("{} deleted.\n".format(backup))
+    store.close()
+    backup_catalog.close()
 
-    if configuration["delete_old_backups"]:
-        has_cleaning_policy = not (all(configuration["cleaning_policy"][key] == 0 for key in configuration["cleaning_policy"]))
-        sys.stdout.write("Cleaning old backups. Strategy:")
+def _empty_trash(configuration, run_metrics):
+    """
+        Empties the trash of backup_dir, in the background or not depending on the "trash" configuration.
+
+        :param configuration: Validated configuration.
+        :type configuration: dict
+        :param run_metrics: Metrics of the run, counting the deleted trash entries and the files that couldn't be deleted.
+        :type run_metrics: backupper.report.Metrics
+        :return: The background process emptying the trash (None if it has been emptied).
+        :rtype: subprocess.Popen
+    """
 
-        if has_cleaning_policy:
-            sys.stdout.write("\n")
-            for policy in sorted(configuration["cleaning_policy"]):
-                sys.stdout.write("    {}: {}\n".format(policy, configuration["cleaning_policy"][policy]))
+    from . import trash
+
+    trash_options = configuration["trash"]
+    if trash_options["background"]:
+        emptier = trash.spawn_emptier(configuration["backup_dir"], trash_options["jobs"])
+        sys.stdout.write("Emptying the trash in the background (pid {}, errors are logged in {}).\n".format(emptier.pid, os.path.join(configuration["backup_dir"], trash.TRASH_LOG)))
+        return emptier
+    entry_count, error_count = trash.empty_trash(configuration["backup_dir"], trash_options["jobs"])
+    run_metrics.counters["trash_entries"] += entry_count
+    if error_count > 0:
+        run_metrics.counters["trash_errors"] += error_count
+        sys.stderr.write("Warning: trash: {} files couldn't be deleted, they're left in {}.\n".format(error_count, trash.trash_path(configuration["backup_dir"])))
+    else:
+        sys.stdout.write("Trash emptied.\n")
+    return None
+
+def _query_catalog(configuration, command, command_args):
+    """
+        Runs the list and find commands, which answer from the catalog.
+
+        :param configuration: Validated configuration.
+        :type configuration: dict
+        :param command: "list" (lists the backups) or "find" (lists the backups containing a path).
+        :type command: str
+        :param command_args: Arguments of the command.
+        :type command_args: list
+    """
+
+    import sqlite3
+    from . import catalog
+
+    backup_catalog = catalog.Catalog(configuration["backup_dir"])
+    if not os.path.isfile(backup_catalog.path):
+        sys.stderr.write("Error: catalog: {} doesn't exist (is \"catalog\" enabled?).\n".format(backup_catalog.path))
+        sys.exit(6)
+
+    try:
+        if command == "list":
+            for backup in backup_catalog.backups():
+                sys.stdout.write("{}\t{}\t{} artifacts\t{} files\t{} bytes\t{:.1f}s\n".format(backup["name"], "complete" if backup["complete"] else "incomplete", backup["artifacts"], backup["files"], backup["bytes_out"], backup["wall_time"]))
         else:
-            sys.stdout.write("all.\n")
+            for member in backup_catalog.find(command_args[0]):
+                sys.stdout.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(member["backup"], member["output"], member["path"], member["size"], datetime.datetime.utcfromtimestamp(member["mtime"]).strftime("%Y-%m-%dT%H:%M:%S"), member["sha256"] or "-"))
+    except sqlite3.Error as e:
+        sys.stderr.write("Error: catalog: {}\n".format(e))
+        sys.exit(6)
+    finally:
+        backup_catalog.close()
+
+def _extract(archive, member, target, run_metrics):
+    """
+        Runs the extract command.
+
+        :param archive: Archive path.
+        :type archive: str
+        :param member: Name of the member in the archive.
+        :type member: str
+        :param target: Directory the member is extracted to.
+        :type target: str
+        :param run_metrics: Metrics of the run.
+        :type run_metrics: backupper.report.Metrics
+    """
 
-        # Backup pattern: a backup created by this script should look like this
-        backup_pattern = re.compile(backup_format)
+    import sqlite3
+    import tarfile
+    from . import restore
 
-        # We discard regular files and directories that don't match the expected backup pattern
-        directories = [os.path.join(configuration["backup_dir"], f) for f in os.listdir(configuration["backup_dir"]) if os.path.isdir(os.path.join(configuration["backup_dir"], f))]
-        backups_list = list(filter(backup_pattern.search, directories))
+    print("Extracting {} from {}.".format(member, archive))
+    start = time.perf_counter()
+    try:
+        os.makedirs(target, exist_ok=True)
+        extracted_count, indexed = restore.extract(archive, member, target, run_metrics)
+    except KeyError as e:
+        sys.stderr.write("Error: extract: {}\n".format(e.args[0]))
+        sys.exit(7)
+    except (OSError, tarfile.TarError, sqlite3.Error) as e:
+        sys.stderr.write("Error: extract: {}\n".format(e))
+        sys.exit(7)
+
+    if indexed:
+        details = "seek index: {} bytes decompressed to reach the members".format(run_metrics.counters["bytes_skipped"])
+    else:
+        details = "no seek index: the whole archive has been read"
+    sys.stdout.write("{} members extracted to {} in {:.2f}s ({}).\n".format(extracted_count, target, time.perf_counter() - start, details))
+
+def _restore(configuration, backup, backup_pattern, target, run_metrics, run_report):
+    """
+        Runs the restore command.
+
+        :param configuration: Validated configuration.
+        :type configuration: dict
+        :param backup: Backup directory, or its name in backup_dir.
+        :type backup: str
+        :param backup_pattern: Compiled backup_format.
+        :type backup_pattern: re.Pattern
+        :param target: Directory the backup is restored to.
+        :type target: str
+        :param run_metrics: Metrics of the run.
+        :type run_metrics: backupper.report.Metrics
+        :param run_report: Run report, the statistics of each artifact are added to its "artifacts" list.
+        :type run_report: dict
+    """
 
-        # We always keep the current backup so we remove it from this list
-        backups_list.remove(actual_backup_dir)
+    from . import report
+    from . import restore
 
-        # We can terminate the program if we have no old backup
-        if len(backups_list) == 0:
-            sys.exit(0)
+    if not os.path.isabs(backup):
+        backup = os.path.abspath(os.path.join(configuration["backup_dir"], backup))
+    backup = os.path.normpath(backup)
+    match = backup_pattern.search(os.path.basename(backup))
+    if match is None or not os.path.isdir(backup):
+        sys.stderr.write("Error: restore: {} isn't a backup.\n".format(backup))
+        sys.exit(7)
 
-        backups_to_keep = []
+    artifacts = restore.list_artifacts(backup, match.group("datetime_str"))
+    if len(artifacts) == 0:
+        sys.stderr.write("Error: restore: {} is empty.\n".format(backup))
+        sys.exit(7)
 
-        # Skip some calculation if all cleaning policies are equal to 0
-        if has_cleaning_policy:
-            # We associate to each backup its corresponding datetime
-            backups_datetime = [datetime.datetime.strptime(backup_pattern.search(elem).group("datetime_str"), datetime_format) for elem in backups_list]
+    # Without encryption in the configuration, encrypted archives are decrypted with the gpg default home
+    gnupg_home = configuration["gnupg"]["home"] if configuration["encrypt"] else None
 
-            # We sort files_datetime and selected_files accordingly
-            backups_datetime, backups_list = (list(t) for t in zip(*sorted(zip(backups_datetime, backups_list))))
+    print("Restoring {} to {}.".format(backup, target))
+    run_report["restore"] = backup
+    start = time.perf_counter()
+    with run_metrics.stage("restore"):
+        _map_artifacts(restore.restore_artifact, artifacts, (backup, target, gnupg_home), configuration["jobs"], run_report["artifacts"])
 
-            # We also need the date of our current backup
-            curr_backup_date = datetime.datetime.strptime(backup_pattern.search(actual_backup_dir).group("datetime_str"), datetime_format).date()
+    wall_time = time.perf_counter() - start
+    restored_size = report.total(run_report["artifacts"])["counters"].get("bytes_out", 0)
+    sys.stdout.write("{} artifacts restored ({:.1f} MiB in {:.2f}s, {:.1f} MiB/s).\n".format(len(artifacts), restored_size / 1024 / 1024, wall_time, restored_size / 1024 / 1024 / wall_time if wall_time > 0 else 0.0))
 
-            # Most recent backups
-            most_recent_backups = backups_list[-configuration["cleaning_policy"]["most_recents"]:]
-            backups_to_keep.extend(most_recent_backups)
+def _map_artifacts(function, artifacts, args, jobs, artifacts_stats, on_result=None):
+    """
+        Runs a function on each artifact, and displays the results.
+
+        Artifacts are independent, so with more than one job they're processed in a process pool; results are displayed in the artifacts order anyway, as in a serial run.
+
+        :param function: Called with each artifact followed by args, returns (messages, exit code, statistics) (e.g. backupper.archive.backup_artifact).
+        :type function: function
+        :param artifacts: Artifacts nodes.
+        :type artifacts: list
+        :param args: Other arguments of function.
+        :type args: tuple
+        :param jobs: Number of processes.
+        :type jobs: int
+        :param artifacts_stats: List the artifacts statistics are appended to.
+        :type artifacts_stats: list
+        :param on_result: Called with the statistics of each successful artifact, in the artifacts order (e.g. to upload it). In a serial run, the next artifact isn't processed until it returns.
+        :type on_result: function
+    """
 
-            # First daily files
-            backups_of_the_day = [backups_list[i] for i in range(0, len(backups_list)) if backups_datetime[i].date() == curr_backup_date][0:configuration["cleaning_policy"]["first_daily"]]
-            backups_to_keep.extend(backups_of_the_day)
+    import threading
+    import concurrent.futures
 
-            # First weekly files
-            backups_of_the_week = [backups_list[i] for i in range(0, len(backups_list)) if (abs(backups_datetime[i].date() - curr_backup_date) < datetime.timedelta(days=7) and backups_datetime[i].weekday() <= curr_backup_date.weekday())][0:configuration["cleaning_policy"]["first_weekly"]]
-            backups_to_keep.extend(backups_of_the_week)
+    if jobs == 1:
+        _display_results((function(artifact, *args) for artifact in artifacts), artifacts_stats, on_result)
+        return
 
-            # First monthly files
-            backups_of_the_month = [backups_list[i] for i in range(0, len(backups_list)) if backups_datetime[i].date().replace(day=1) == curr_backup_date.replace(day=1)][0:configuration["cleaning_policy"]["first_monthly"]]
-            backups_to_keep.extend(backups_of_the_month)
+    # A process forked while other threads run (multi-job runs, the daemon, the uploader) inherits the locks they hold, and may deadlock on them: it's then forked by a fork server instead, which has a single thread
+    mp_context = None
+    if threading.active_count() > 1:
+        import multiprocessing
+        mp_context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
 
-        for backup in backups_list:
-            if backup not in backups_to_keep:
-                shutil.rmtree(backup)
-                sys.stdout.write("{} deleted.\n".format(backup))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context) as executor:
+        futures = [executor.submit(function, artifact, *args) for artifact in artifacts]
+        try:
+            _display_results((future.result() for future in futures), artifacts_stats, on_result)
+        finally:
+            # If an artifact failed, we don't start the pending ones
+            for future in futures:
+                future.cancel()
 
-    sys.exit(0)
+def _list_backups(backup_dir, backup_pattern):
+    """
+        Lists the backups of a backup directory.
+
+        :param backup_dir: Directory containing the backups.
+        :type backup_dir: str
+        :param backup_pattern: Compiled backup_format.
+        :type backup_pattern: re.Pattern
+        :return: Paths of the backups.
+        :rtype: list
+    """
+
+    # We discard regular files and directories that don't match the expected backup pattern
+    directories = [os.path.join(backup_dir, f) for f in os.listdir(backup_dir) if os.path.isdir(os.path.join(backup_dir, f))]
+    return list(filter(backup_pattern.search, directories))
+
+def _display_results(results, artifacts_stats, on_result=None):
+    """
+        Displays the artifacts backup results, and exits on the first failing artifact.
+
+        :param results: (messages, exit code, statistics) tuples, as returned by backupper.archive.backup_artifact.
+        :type results: iterable
+        :param artifacts_stats: List the artifacts statistics are appended to.
+        :type artifacts_stats: list
+        :param on_result: Called with the statistics of each successful artifact.
+        :type on_result: function
+    """
+
+    for messages, exit_code, stats in results:
+        artifacts_stats.append(stats)
+        for stream, message in messages:
+            getattr(sys, stream).write(message)
+        if exit_code != 0:
+            sys.exit(exit_code)
+        if on_result is not None:
+            on_result(stats)
@@ -0,0 +1,284 @@
+"""
+    Compression codecs used to write artifacts archives.
+
+    zstd and lz4 rely on optional modules (zstandard and lz4): they're only needed if you use these codecs, and only imported once used.
+"""
+
+import gzip
+import bz2
+import lzma
+import zlib
+import struct
+import time
+import importlib
+import collections
+
+__all__ = ["CODECS", "DEFAULT_CODEC", "ParallelGzipWriter", "open_compressor", "open_decompressor", "is_available"]
+
+DEFAULT_CODEC = "gzip"
+"""Codec used when the configuration doesn't specify one"""
+
+CODECS = {
+    "none": {"extension": "tar", "levels": None, "default_level": None, "module": None, "threads": False, "seekable": True},
+    "gzip": {"extension": "tar.gz", "levels": (1, 9), "default_level": 9, "module": None, "threads": True, "seekable": True},
+    "bzip2": {"extension": "tar.bz2", "levels": (1, 9), "default_level": 9, "module": None, "threads": False, "seekable": False},
+    "xz": {"extension": "tar.xz", "levels": (0, 9), "default_level": 6, "module": None, "threads": False, "seekable": False},
+    "zstd": {"extension": "tar.zst", "levels": (1, 22), "default_level": 3, "module": "zstandard", "threads": True, "seekable": False},
+    "lz4": {"extension": "tar.lz4", "levels": (0, 16), "default_level": 0, "module": "lz4", "threads": False, "seekable": False},
+}
+"""Supported codecs: archive extension, valid levels range (None if the codec has no level), default level, optional module it depends on, whether it can compress on several threads and whether its writer can provide restart points"""
+
+class _Uncompressed:
+    """
+        Pass-through writer used by the "none" codec.
+
+        Closing it doesn't close the underlying file object, just like other compressors.
+    """
+
+    restart_points = [(0, 0)]
+    """Any offset is a restart point, as offsets are the same in the tar stream and in the file"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        return self._fileobj.write(data)
+
+    def close(self):
+        self._fileobj.flush()
+
+class ParallelGzipWriter:
+    """
+        Multi-threaded gzip writer (pigz-like).
+
+        The input is split into blocks that are deflated independently on a thread pool (zlib releases the GIL while compressing), then written in order as a single standard gzip member, readable by gunzip or the gzip module.
+
+        Each block starts with an empty dictionary, so decompression can also be restarted at any block boundary: restart_points lists them.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+    """Uncompressed size of a block"""
+
+    def __init__(self, fileobj, level=9, threads=2, block_size=BLOCK_SIZE):
+        # concurrent.futures is slow to import, and only needed once archiving
+        import concurrent.futures
+
+        self._fileobj = fileobj
+        self._level = level
+        self._block_size = block_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = 2 * threads
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._crc = 0
+        self._size = 0
+        self._submitted_size = 0
+        self._compressed_size = 0
+        self._closed = False
+
+        self.restart_points = []
+        """(uncompressed offset, compressed offset) of each block, offsets being relative to the beginning of the tar stream and of the gzip file"""
+
+        # gzip header: no file name, current mtime, "unix" OS
+        extra_flags = 2 if level == 9 else (4 if level == 1 else 0)
+        self._write_output(struct.pack("<BBBBLBB", 0x1f, 0x8b, zlib.DEFLATED, 0, int(time.time()), extra_flags, 3))
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError("write: writer is closed.")
+
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+
+        # Blocks are cut from a view of data, to avoid shifting a big buffer on each block
+        view = memoryview(data)
+        position = 0
+        if self._buffer:
+            position = self._block_size - len(self._buffer)
+            self._buffer.extend(view[:position])
+            if len(self._buffer) < self._block_size:
+                return len(data)
+            self._submit(bytes(self._buffer), False)
+            self._buffer = bytearray()
+        while len(view) - position >= self._block_size:
+            self._submit(bytes(view[position:position + self._block_size]), False)
+            position += self._block_size
+        self._buffer.extend(view[position:])
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            # The last block is the only one with the final bit set (it may be empty)
+            self._submit(bytes(self._buffer), True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._write_block(self._pending.popleft())
+        finally:
+            self._executor.shutdown()
+
+        self._write_output(struct.pack("<LL", self._crc & 0xffffffff, self._size & 0xffffffff))
+        self._fileobj.flush()
+
+    def _submit(self, block, last):
+        """
+            Queues a block for compression, and writes the oldest compressed blocks if too many are pending (so that memory usage stays bounded).
+
+            :param block: Uncompressed block.
+            :type block: bytes
+            :param last: True if it's the last block of the stream.
+            :type last: bool
+        """
+
+        self._pending.append((self._submitted_size, self._executor.submit(_deflate_block, block, self._level, last)))
+        self._submitted_size += len(block)
+        while len(self._pending) > self._max_pending:
+            self._write_block(self._pending.popleft())
+
+    def _write_block(self, pending_block):
+        """
+            Writes a compressed block once it's ready.
+
+            :param pending_block: (uncompressed offset, future) tuple.
+            :type pending_block: tuple
+        """
+
+        uncompressed_offset, future = pending_block
+        self.restart_points.append((uncompressed_offset, self._compressed_size))
+        self._write_output(future.result())
+
+    def _write_output(self, data):
+        self._fileobj.write(data)
+        self._compressed_size += len(data)
+
+def _deflate_block(block, level, last):
+    """
+        Deflates a block with a fresh raw deflate stream.
+
+        Non final blocks end with a sync flush (byte aligned, no final bit) so that they can be concatenated.
+
+        :param block: Uncompressed block.
+        :type block: bytes
+        :param level: Compression level.
+        :type level: int
+        :param last: True if it's the last block of the stream.
+        :type last: bool
+        :return: Raw deflate data.
+        :rtype: bytes
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+_MODULE_IMPORTS = {"zstandard": "zstandard", "lz4": "lz4.frame"}
+"""Module actually imported for each optional module of CODECS"""
+
+_imported_modules = {}
+"""Optional modules already imported (None if not installed), by CODECS module name"""
+
+def _codec_module(codec):
+    """
+        Imports the optional module of a codec, on first use.
+
+        :param codec: Codec name (a CODECS key).
+        :type codec: str
+        :return: The module (None if it isn't installed).
+        :rtype: module
+    """
+
+    module = CODECS[codec]["module"]
+    if not module in _imported_modules:
+        try:
+            _imported_modules[module] = importlib.import_module(_MODULE_IMPORTS[module])
+        except ImportError:
+            _imported_modules[module] = None
+    return _imported_modules[module]
+
+def is_available(codec):
+    """
+        Tests if the module a codec depends on is installed.
+
+        :param codec: Codec name (a CODECS key).
+        :type codec: str
+        :return: True if the codec can be used.
+        :rtype: bool
+    """
+
+    return CODECS[codec]["module"] is None or _codec_module(codec) is not None
+
+def open_compressor(fileobj, codec, level=None, threads=1, seekable=False):
+    """
+        Wraps a binary file object in a compressing writer.
+
+        Closing the returned writer flushes the compressed stream but doesn't close fileobj.
+
+        :param fileobj: Binary file object the compressed stream is written to.
+        :type fileobj: file object
+        :param codec: Codec name (a CODECS key).
+        :type codec: str
+        :param level: Compression level (if None, the codec default level is used).
+        :type level: int
+        :param threads: Number of compression threads, for codecs supporting it.
+        :type threads: int
+        :param seekable: If True, the returned writer has a restart_points attribute, listing where decompression can be restarted (only seekable codecs support it).
+        :type seekable: bool
+        :return: A writable file object.
+        :rtype: file object
+    """
+
+    if level is None:
+        level = CODECS[codec]["default_level"]
+    if seekable and not CODECS[codec]["seekable"]:
+        raise ValueError("open_compressor: the {} codec isn't seekable.".format(codec))
+
+    if codec == "none":
+        return _Uncompressed(fileobj)
+    elif codec == "gzip" and (threads > 1 or seekable):
+        return ParallelGzipWriter(fileobj, level=level, threads=threads)
+    elif codec == "gzip":
+        return gzip.GzipFile(filename="", mode="wb", compresslevel=level, fileobj=fileobj)
+    elif codec == "bzip2":
+        return bz2.BZ2File(fileobj, mode="wb", compresslevel=level)
+    elif codec == "xz":
+        return lzma.LZMAFile(fileobj, mode="wb", preset=level)
+    elif codec == "zstd":
+        return _codec_module(codec).ZstdCompressor(level=level, threads=threads if threads > 1 else 0).stream_writer(fileobj, closefd=False)
+    elif codec == "lz4":
+        return _codec_module(codec).LZ4FrameFile(fileobj, mode="wb", compression_level=level)
+    else:
+        raise ValueError("open_compressor: unknown codec {}.".format(codec))
+
+def open_decompressor(fileobj, codec):
+    """
+        Wraps a binary file object in a decompressing reader.
+
+        The compressed stream is only read forward, so fileobj can be a pipe.
+
+        :param fileobj: Binary file object the compressed stream is read from.
+        :type fileobj: file object
+        :param codec: Codec name (a CODECS key).
+        :type codec: str
+        :return: A readable file object.
+        :rtype: file object
+    """
+
+    if codec == "none":
+        return fileobj
+    elif codec == "gzip":
+        return gzip.GzipFile(filename="", mode="rb", fileobj=fileobj)
+    elif codec == "bzip2":
+        return bz2.BZ2File(fileobj, mode="rb")
+    elif codec == "xz":
+        return lzma.LZMAFile(fileobj, mode="rb")
+    elif codec == "zstd":
+        return _codec_module(codec).ZstdDecompressor().stream_reader(fileobj, closefd=False)
+    elif codec == "lz4":
+        return _codec_module(codec).LZ4FrameFile(fileobj, mode="rb")
+    else:
+        raise ValueError("open_decompressor: unknown codec {}.".format(codec))
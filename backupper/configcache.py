@@ -0,0 +1,166 @@
+"""
+    Cache of the validated configurations.
+
+    Importing yaml, parsing and validating a configuration file takes a noticeable share of a short run. Once validated, a configuration is stored as JSON in the user cache directory, and reused until its file changes: a file with the same mtime and size is trusted without being read, a file with another mtime (e.g. only touched) is reused if its contents hash is the same.
+
+    Validation depends on the environment (the default backup_dir is the working directory, the default GnuPG home is in the user home directory) and on the validation code itself (the modules of _VALIDATION_MODULES), which are part of the cache key. The modules it needs (the compression codecs) may be uninstalled since, so they're checked again on each hit (see backupper.utils.validate_environment).
+
+    hashlib and tempfile are only imported when a file has to be hashed or an entry written, as a cache hit must stay cheaper than parsing.
+"""
+
+import os
+import json
+import zlib
+
+import backupper
+from . import utils
+
+__all__ = ["cache_dir", "digest", "get", "put"]
+
+_VALIDATION_MODULES = ["utils.py", "filters.py", "compression.py", "upload.py", "connect"]
+"""Modules and packages of backupper the validation uses (the storages check their options), relative to the package directory"""
+
+def cache_dir():
+    """
+        Returns the directory of the cache ($XDG_CACHE_HOME/backupper).
+
+        :return: The directory path.
+        :rtype: str
+    """
+
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache")), "backupper")
+
+def digest(data):
+    """
+        Hashes the contents of a configuration file.
+
+        :param data: File contents.
+        :type data: bytes
+        :return: The hexadecimal SHA-256.
+        :rtype: str
+    """
+
+    import hashlib
+    return hashlib.sha256(data).hexdigest()
+
+def _entry_path(configuration_file):
+    """
+        Returns the path of the cache entry of a configuration file.
+
+        :param configuration_file: Absolute configuration file path.
+        :type configuration_file: str
+        :return: The entry path.
+        :rtype: str
+    """
+
+    # Entries of different files with the same name and checksum replace each other, the path being part of the key
+    return os.path.join(cache_dir(), "{}.{:08x}.json".format(os.path.basename(configuration_file), zlib.crc32(configuration_file.encode("utf-8", "surrogateescape"))))
+
+def _key(configuration_file):
+    """
+        Returns what, besides the file contents, a validated configuration depends on.
+
+        :param configuration_file: Absolute configuration file path.
+        :type configuration_file: str
+        :return: The key.
+        :rtype: dict
+    """
+
+    return {"version": backupper.__version__, "validator": _validator(), "path": configuration_file, "cwd": os.getcwd(), "home": os.path.expanduser("~")}
+
+def _validator():
+    """
+        Returns the modification times of the validation modules, which change more often than the version (e.g. a new option with a default value).
+
+        The files are only stat'ed, as importing the modules would cost more than the cache saves.
+
+        :return: [path relative to the package directory, mtime in ns (None if it's missing)] lists.
+        :rtype: list
+    """
+
+    package_dir = os.path.dirname(utils.__file__)
+    paths = []
+    for module in _VALIDATION_MODULES:
+        path = os.path.join(package_dir, module)
+        if module.endswith(".py"):
+            paths.append(path)
+        elif os.path.isdir(path):
+            paths.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".py"))
+    validator = []
+    for path in paths:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        validator.append([os.path.relpath(path, package_dir), mtime])
+    return validator
+
+def get(configuration_file):
+    """
+        Returns the cached validated configuration of a file, if it hasn't changed.
+
+        :param configuration_file: Configuration file path.
+        :type configuration_file: str
+        :return: The validated configuration (None if it isn't cached, or if the file changed).
+        :rtype: dict
+    """
+
+    configuration_file = os.path.abspath(configuration_file)
+    try:
+        st = os.stat(configuration_file)
+        with open(_entry_path(configuration_file), "r") as f:
+            entry = json.load(f)
+        if entry["key"] != _key(configuration_file):
+            return None
+        if entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            return entry["configuration"]
+        with open(configuration_file, "rb") as f:
+            data = f.read()
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    if digest(data) != entry["sha256"]:
+        return None
+    # Same contents: the next runs won't have to read it
+    put(configuration_file, st, data, entry["configuration"])
+    return entry["configuration"]
+
+def put(configuration_file, st, data, configuration):
+    """
+        Caches a validated configuration.
+
+        Errors are ignored: the cache is only an optimisation.
+
+        :param configuration_file: Configuration file path.
+        :type configuration_file: str
+        :param st: Stat of the file, taken before reading it.
+        :type st: os.stat_result
+        :param data: Contents of the file the configuration was parsed from.
+        :type data: bytes
+        :param configuration: The validated configuration.
+        :type configuration: dict
+    """
+
+    import tempfile
+
+    configuration_file = os.path.abspath(configuration_file)
+    entry = {
+        "key": _key(configuration_file),
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "sha256": digest(data),
+        "configuration": configuration,
+    }
+    try:
+        os.makedirs(cache_dir(), mode=0o700, exist_ok=True)
+        # Written under a temporary name, so that a concurrent run never reads a partial entry
+        fd, temporary = tempfile.mkstemp(prefix=".", suffix=".part", dir=cache_dir())
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(temporary, _entry_path(configuration_file))
+        except:
+            os.remove(temporary)
+            raise
+    except (OSError, TypeError, ValueError):
+        pass
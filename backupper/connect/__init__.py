@@ -1,5 +1,7 @@
 from .utils import *
 from .dummystorage import DummyStorage
 from .ftpstorage import FTPStorage
+from .localstorage import LocalStorage
+from .asyncstorage import *
 
-# For now, this submodule is very experimental and shouldn't be used at all! rclone can do the job to send backups on a distant storage, so I'll see if I have the faith to get back to work on it.
+# Storages are used by the "storage" option to upload backups (see backupper.upload).
@@ -0,0 +1,341 @@
+"""
+    asyncio counterpart of backupper.connect.AbstractStorageContext.
+
+    Storages are driven from an event loop, so that a single thread can run transfers to several storages at once while doing local work. The implementations run blocking storages in threads: each operation borrows a session (a blocking storage object) for its duration, so that the number of sessions bounds the number of concurrent operations, however many are awaited.
+"""
+
+import asyncio
+import posixpath
+import threading
+import concurrent.futures
+from abc import ABC, abstractmethod
+
+from .utils import *
+from .dummystorage import DummyStorage
+from .ftpstorage import FTPStorage
+
+__all__ = ["AsyncStorageContext", "AsyncStorageAdapter", "AsyncFTPStorage", "AsyncDummyStorage"]
+
+class AsyncStorageContext(ABC):
+    """
+        Abstract asynchronous connection model.
+
+        Same operations as backupper.connect.AbstractStorageContext, as coroutines. It's also an asynchronous context manager, connected inside the async with block.
+    """
+
+    @abstractmethod
+    async def connect(self):
+        """
+            Opens a connection with the storage.
+        """
+
+    @abstractmethod
+    async def disconnect(self):
+        """
+            Closes the connection with the storage.
+        """
+
+    @abstractmethod
+    async def upload(self, src, dest="."):
+        """
+            Uploads a file to the storage.
+
+            :param src: Local path of the file or directory to upload.
+            :type src: str
+            :param dest: Distant destination path.
+            :type dest: str
+        """
+
+    @abstractmethod
+    async def download(self, src, dest="."):
+        """
+            Retrieves a file from the storage.
+
+            :param src: Distant path of the file or directory to retrieve.
+            :type src: str
+            :param dest: Local destination path.
+            :type dest: str
+        """
+
+    @abstractmethod
+    async def listdir(self, path="."):
+        """
+            Lists the contents of the storage.
+
+            :param path: resource to list.
+            :type path: str
+            :return: a list of contents.
+            :rtype: list
+        """
+
+    @abstractmethod
+    async def remove(self, path):
+        """
+            Removes a file or directory from the storage.
+
+            :param path: Resource to remove.
+            :type path: str
+        """
+
+    @abstractmethod
+    async def mkdir(self, path):
+        """
+            Creates a directory on the storage.
+
+            :param path: Directory to create.
+            :type path: str
+        """
+
+    @abstractmethod
+    async def rename(self, path, new_path):
+        """
+            Moves a directory or file in the storage. It can be used to rename a resource.
+
+            :param path: Resource to rename.
+            :type path: str
+            :param new_path: New name of the resource.
+            :type new_path: str
+        """
+
+    @abstractmethod
+    async def chdir(self, path="/"):
+        """
+            Changes the storage working directory.
+
+            :param path: New distant working directory.
+            :type path: str
+        """
+
+    @abstractmethod
+    async def getcwd(self):
+        """
+            Returns the storage working directory.
+
+            :return: Current distant working directory.
+            :rtype: str
+        """
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.disconnect()
+
+class AsyncStorageAdapter(AsyncStorageContext):
+    """
+        Asynchronous storage running blocking storages in threads.
+
+        Each operation runs on a session, in a thread of the adapter's own pool. Sessions never change their working directory: the adapter keeps its own, and gives them absolute paths. When a session modifies a path, the other sessions forget what they cached about it before their next operation.
+    """
+
+    def __init__(self, sessions):
+        """
+            :param sessions: Blocking storages (backupper.connect.AbstractStorageContext), each one used by one operation at a time. Different objects must be independent connections to the same storage (e.g. several FTPStorage on the same host). A storage which can be used by several threads at once can be given several times.
+            :type sessions: list
+        """
+
+        if len(sessions) == 0:
+            raise ValueError("__init__: please provide at least one session.")
+        self._sessions = sessions
+
+        self._distinct_sessions = list({id(session): session for session in sessions}.values())
+
+        self._idle_sessions = None
+        """asyncio.Queue of the idle sessions (None if not connected)"""
+
+        self._executor = None
+
+        self._cwd = None
+        """Working directory"""
+
+        self._forgotten = {id(session): [] for session in self._distinct_sessions}
+        """Paths each session must forget before its next operation"""
+
+        self._forgotten_lock = threading.Lock()
+
+    async def connect(self):
+        if not self._idle_sessions is None:
+            raise AlreadyConnectedError("connect: Already connected.")
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self._sessions))
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(self._executor, session.connect) for session in self._distinct_sessions], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if len(errors) > 0:
+            await self._disconnect_sessions([session for session, result in zip(self._distinct_sessions, results) if not isinstance(result, Exception)])
+            self._executor.shutdown()
+            self._executor = None
+            raise errors[0]
+
+        # Sessions don't chdir: they stay in the initial working directory
+        self._cwd = self._distinct_sessions[0].getcwd()
+        self._idle_sessions = asyncio.Queue()
+        for session in self._sessions:
+            self._idle_sessions.put_nowait(session)
+
+    async def disconnect(self):
+        if self._idle_sessions is None:
+            raise NotConnectedError("disconnect: Not connected.")
+
+        # Running operations are waited for
+        for _ in self._sessions:
+            await self._idle_sessions.get()
+        self._idle_sessions = None
+        try:
+            await self._disconnect_sessions(self._distinct_sessions)
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+            self._cwd = None
+
+    async def _disconnect_sessions(self, sessions):
+        """
+            Disconnects sessions, ignoring their errors.
+
+            :param sessions: Connected sessions.
+            :type sessions: list
+        """
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self._executor, session.disconnect) for session in sessions], return_exceptions=True)
+
+    def _absolute(self, path):
+        """
+            Returns the absolute (normalized) distant path of a path relative to the working directory.
+
+            :param path: Distant path.
+            :type path: str
+            :return: The absolute path.
+            :rtype: str
+        """
+
+        return posixpath.normpath(posixpath.join(self._cwd, path))
+
+    async def _run(self, operation, *args, modified=()):
+        """
+            Runs an operation of a session, in a thread, once a session is idle.
+
+            :param operation: Name of the session method.
+            :type operation: str
+            :param args: Arguments of the method.
+            :type args: tuple
+            :param modified: Absolute distant paths the operation modifies, for the other sessions to forget.
+            :type modified: tuple
+            :return: What the method returns.
+        """
+
+        if self._idle_sessions is None:
+            raise NotConnectedError("{}: Not connected.".format(operation))
+
+        session = await self._idle_sessions.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, session, operation, args)
+        finally:
+            self._idle_sessions.put_nowait(session)
+            # Even a failed operation may have modified something
+            if len(modified) > 0 and len(self._distinct_sessions) > 1:
+                with self._forgotten_lock:
+                    for other in self._distinct_sessions:
+                        if not other is session:
+                            self._forgotten[id(other)].extend(modified)
+
+    def _call(self, session, operation, args):
+        """
+            Calls a session method (in a thread of the pool).
+
+            :param session: The session.
+            :type session: backupper.connect.AbstractStorageContext
+            :param operation: Name of the method.
+            :type operation: str
+            :param args: Arguments of the method.
+            :type args: tuple
+            :return: What the method returns.
+        """
+
+        with self._forgotten_lock:
+            forgotten, self._forgotten[id(session)] = self._forgotten[id(session)], []
+        for path in forgotten:
+            session.forget(path)
+        return getattr(session, operation)(*args)
+
+    async def upload(self, src, dest="."):
+        dest = self._absolute(dest)
+        await self._run("upload", src, dest, modified=(dest,))
+
+    async def download(self, src, dest="."):
+        await self._run("download", self._absolute(src), dest)
+
+    async def listdir(self, path="."):
+        return await self._run("listdir", self._absolute(path))
+
+    async def remove(self, path):
+        path = self._absolute(path)
+        await self._run("remove", path, modified=(path,))
+
+    async def mkdir(self, path):
+        path = self._absolute(path)
+        await self._run("mkdir", path, modified=(path,))
+
+    async def rename(self, path, new_path):
+        path, new_path = self._absolute(path), self._absolute(new_path)
+        await self._run("rename", path, new_path, modified=(path, new_path))
+
+    async def chdir(self, path="/"):
+        # The working directory only has to exist
+        new_cwd = self._absolute(path)
+        try:
+            await self._run("listdir", new_cwd)
+        except UnpermittedOperationError:
+            raise UnpermittedOperationError("chdir: {} isn't a directory.".format(path))
+        except NotFoundError:
+            raise NotFoundError("chdir: {} doesn't exist.".format(path))
+        self._cwd = new_cwd
+
+    async def getcwd(self):
+        if self._idle_sessions is None:
+            raise NotConnectedError("getcwd: Not connected.")
+        return self._cwd
+
+class AsyncFTPStorage(AsyncStorageAdapter):
+    """
+        Asynchronous FTP storage system.
+
+        Runs `sessions` FTPStorage objects, i.e. up to `sessions` operations on as many connections at once.
+    """
+
+    def __init__(self, host, user="anonymous", passwd="", sessions=4, **options):
+        """
+            :param host: FTP server.
+            :type host: str
+            :param user: User name.
+            :type user: str
+            :param passwd: Password.
+            :type passwd: str
+            :param sessions: Number of concurrent operations (and FTP sessions).
+            :type sessions: int
+            :param options: Other backupper.connect.FTPStorage options (block_size, retries...).
+            :type options: dict
+        """
+
+        super().__init__([FTPStorage(host, user, passwd, **options) for _ in range(sessions)])
+
+class AsyncDummyStorage(AsyncStorageAdapter):
+    """
+        Asynchronous dummy storage system.
+
+        A single DummyStorage, used by up to `sessions` operations at once (it locks its tree and counters).
+    """
+
+    def __init__(self, sessions=4, **options):
+        """
+            :param sessions: Number of concurrent operations.
+            :type sessions: int
+            :param options: backupper.connect.DummyStorage options (spill_dir, latency, bandwidth...).
+            :type options: dict
+        """
+
+        self.storage = DummyStorage(**options)
+        """The dummy storage (e.g. to read its counters)"""
+
+        super().__init__([self.storage] * sessions)
@@ -1,22 +1,76 @@
 import os
+import time
+import shutil
+import tempfile
+import weakref
+import threading
+import itertools
+import collections
 
 from .utils import *
 
 _all_ = ["DummyStorage"]
 
+class _SpilledFile:
+    """
+        Contents of a dummy file, stored on disk.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        """Spill file path"""
+
+        self.size = size
+        """Contents size"""
+
 class DummyStorage(AbstractStorageContext):
     """
         Dummy storage system.
 
         Just a demo implementation of backupper.connect.AbstractStorageContext. It will only store a non-persistent tree.
+
+        To exercise storage-facing code with realistic backup sizes, file contents can be spilled to disk (only the tree stays in memory), and the storage can simulate the latency and bandwidth of a distant one. Files are then streamed by chunks, and the transferred bytes and files, and the round trips, are counted in counters.
+
+        The tree and the counters are locked while they're checked and modified (not during simulated transfers), so that a storage can be used by several threads at once, which all share its working directory.
     """
 
     CONNEXION_TYPE = "dummy"
 
-    def __init__(self):
+    def __init__(self, spill_dir=None, chunk_size=1024 * 1024, latency=0, bandwidth=None):
+        """
+            :param spill_dir: Directory where file contents are stored (in a temporary directory, removed with the storage). If None, contents are kept in memory.
+            :type spill_dir: str
+            :param chunk_size: Size of the chunks files are streamed by.
+            :type chunk_size: int
+            :param latency: Simulated duration of a round trip (each operation does one), in seconds.
+            :type latency: float
+            :param bandwidth: Simulated bandwidth, in bytes per second (None for no limit).
+            :type bandwidth: float
+        """
+
         self._tree = {}
         """Dummy file structure"""
 
+        self._lock = threading.RLock()
+        """Lock of the tree and the counters"""
+
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self.counters = collections.Counter()
+        """Number of round_trips, files_uploaded, bytes_uploaded, files_downloaded and bytes_downloaded"""
+
+        self._spill_dir = None
+        """Directory of the spill files (None if contents are kept in memory)"""
+
+        if not spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="dummystorage.", dir=spill_dir)
+            # Spill files don't outlive the tree
+            weakref.finalize(self, shutil.rmtree, self._spill_dir, True)
+
+        self._spill_ids = itertools.count()
+
         self._cwd = "/"
         """Dummy current working directory"""
 
@@ -25,6 +79,7 @@ class DummyStorage(AbstractStorageContext):
 
     def connect(self):
         # Does nothing else but toggling a boolean
+        self._round_trip()
         if not self._connected:
             self._connected = True
         else:
@@ -45,47 +100,68 @@ class DummyStorage(AbstractStorageContext):
                 raise NotFoundError("upload: {} doesn't exist.".format(src))
             src = os.path.abspath(src)
 
-            # Try to access the destination
-            dest_tree = {}
-            dest_filename = ""
-            # dest exists?
-            try:
-                # If so,
-                dest_tree = self._walk(dest)
-                # ...Is it a file? If yes, we raise an exception because we can't copy a tree in a file.
-                if not isinstance(dest_tree, dict):
-                    raise UnpermittedOperationError("upload: {} is a file.".format(dest))
-                # ...Otherwise dest/basename(src) exists?
-                if os.path.basename(src) in dest_tree:
-                    # If so we raise an error
-                    raise UnpermittedOperationError("upload: {} already exists.".format(src))
-                else:
-                    # Otherwise that's ok
-                    dest_filename = os.path.basename(src)
-            except NotFoundError:
-                # Otherwise, dirname(dest) exists?
-                try:
-                    # If so...
-                    dest_tree = self._walk(os.path.dirname(dest))
-                    # ...Is it a file? If yes, we raise an exception because we can't copy a tree in a file.
-                    if not isinstance(dest_tree, dict):
-                        raise UnpermittedOperationError("upload: {} is a file.".format(os.path.normpath(os.path.dirname(dest))))
-                    # ...Otherwise that's ok
-                    dest_filename = os.path.basename(dest)
-                except NotFoundError:
-                    # Otherwise, it's an error
-                    raise NotFoundError("upload: {} doesn't exist.".format(os.path.normpath(os.path.dirname(dest))))
+            with self._lock:
+                dest_tree, dest_filename = self._upload_destination(src, dest)
+            self._round_trip()
 
-            # We create the according root node
+            # The uploaded tree is only added once complete
             if os.path.isdir(src):
-                dest_tree[dest_filename] = {}
-                self._recursive_upload(src, dest_tree[dest_filename])
+                node = {}
+                self._recursive_upload(src, node)
             else:
-                with open(src, "rb") as f:
-                    dest_tree[dest_filename] = f.read()
+                node = self._store(src)
+            with self._lock:
+                if dest_filename in dest_tree:
+                    self._discard(node)
+                    raise UnpermittedOperationError("upload: {} already exists.".format(src))
+                dest_tree[dest_filename] = node
         else:
             raise NotConnectedError("upload: Not connected.")
 
+    def _upload_destination(self, src, dest):
+        """
+            Finds where an upload goes.
+
+            :param src: Absolute local path of the uploaded file or directory.
+            :type src: str
+            :param dest: Distant destination path.
+            :type dest: str
+            :return: The destination directory tree, and the uploaded name in it.
+            :rtype: tuple
+        """
+
+        # Try to access the destination
+        dest_tree = {}
+        dest_filename = ""
+        # dest exists?
+        try:
+            # If so,
+            dest_tree = self._walk(dest)
+            # ...Is it a file? If yes, we raise an exception because we can't copy a tree in a file.
+            if not isinstance(dest_tree, dict):
+                raise UnpermittedOperationError("upload: {} is a file.".format(dest))
+            # ...Otherwise dest/basename(src) exists?
+            if os.path.basename(src) in dest_tree:
+                # If so we raise an error
+                raise UnpermittedOperationError("upload: {} already exists.".format(src))
+            else:
+                # Otherwise that's ok
+                dest_filename = os.path.basename(src)
+        except NotFoundError:
+            # Otherwise, dirname(dest) exists?
+            try:
+                # If so...
+                dest_tree = self._walk(os.path.dirname(dest))
+                # ...Is it a file? If yes, we raise an exception because we can't copy a tree in a file.
+                if not isinstance(dest_tree, dict):
+                    raise UnpermittedOperationError("upload: {} is a file.".format(os.path.normpath(os.path.dirname(dest))))
+                # ...Otherwise that's ok
+                dest_filename = os.path.basename(dest)
+            except NotFoundError:
+                # Otherwise, it's an error
+                raise NotFoundError("upload: {} doesn't exist.".format(os.path.normpath(os.path.dirname(dest))))
+        return dest_tree, dest_filename
+
     def _recursive_upload(self, current_file, dest_tree):
         """
             Internal recursive upload subroutine.
@@ -103,8 +179,88 @@ class DummyStorage(AbstractStorageContext):
                 dest_tree[dest_filename] = {}
                 self._recursive_upload(item, dest_tree[dest_filename])
             else:
-                with open(item, "rb") as f:
-                    dest_tree[dest_filename] = f.read()
+                dest_tree[dest_filename] = self._store(item)
+
+    def _store(self, src):
+        """
+            Reads a file to upload, by chunks.
+
+            :param src: Local file path.
+            :type src: str
+            :return: The file contents (bytes, or backupper.connect.dummystorage._SpilledFile if they're spilled to disk).
+            :rtype: bytes or backupper.connect.dummystorage._SpilledFile
+        """
+
+        if self._spill_dir is None:
+            chunks = []
+            with open(src, "rb") as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                    self._send(chunk, "bytes_uploaded")
+                    chunks.append(chunk)
+            self._count("files_uploaded", 1)
+            return b"".join(chunks)
+
+        spilled = _SpilledFile(os.path.join(self._spill_dir, str(next(self._spill_ids))), 0)
+        with open(src, "rb") as f, open(spilled.path, "xb") as spill:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                self._send(chunk, "bytes_uploaded")
+                spill.write(chunk)
+                spilled.size += len(chunk)
+        self._count("files_uploaded", 1)
+        return spilled
+
+    def _count(self, counter, value):
+        """
+            Increments a counter.
+
+            :param counter: Counter name.
+            :type counter: str
+            :param value: Increment.
+            :type value: int
+        """
+
+        with self._lock:
+            self.counters[counter] += value
+
+    def _round_trip(self):
+        """
+            Simulates a round trip to the storage.
+        """
+
+        self._count("round_trips", 1)
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _send(self, chunk, counter):
+        """
+            Simulates the transfer of a chunk.
+
+            :param chunk: Transferred data.
+            :type chunk: bytes
+            :param counter: Counter of the transferred bytes.
+            :type counter: str
+        """
+
+        self._count(counter, len(chunk))
+        if not self.bandwidth is None:
+            time.sleep(len(chunk) / self.bandwidth)
+
+    def _discard(self, node):
+        """
+            Deletes the spill files of a removed file or tree.
+
+            :param node: Removed file contents or tree.
+            :type node: dict, bytes or backupper.connect.dummystorage._SpilledFile
+        """
+
+        if isinstance(node, dict):
+            for child in node.values():
+                self._discard(child)
+        elif isinstance(node, _SpilledFile):
+            try:
+                os.remove(node.path)
+            except FileNotFoundError:
+                pass
 
     def download(self, src, dest="."):
         if self._connected:
@@ -131,6 +287,7 @@ class DummyStorage(AbstractStorageContext):
                     except FileExistsError:
                         pass
 
+                self._round_trip()
                 self._recursive_download(file_to_download, canonical_dest)
             except NotFoundError:
                 raise NotFoundError("download: {} doesn't exist.".format(src))
@@ -150,114 +307,135 @@ class DummyStorage(AbstractStorageContext):
             :type canonical_dest: str
         """
 
+        # Other threads may modify the tree meanwhile
+        with self._lock:
+            source_tree = dict(source_tree)
         for item in source_tree:
             if isinstance(source_tree[item], dict):
                 next_canonical_dest = os.path.join(canonical_dest, item)
                 os.mkdir(next_canonical_dest)
                 self._recursive_download(source_tree[item], next_canonical_dest)
+            elif isinstance(source_tree[item], _SpilledFile):
+                with open(source_tree[item].path, "rb") as spill, open(os.path.join(canonical_dest, item), "xb") as f:
+                    for chunk in iter(lambda: spill.read(self.chunk_size), b""):
+                        self._send(chunk, "bytes_downloaded")
+                        f.write(chunk)
+                self._count("files_downloaded", 1)
             else:
                 opening_mode = "x"
                 if not isinstance(source_tree[item], str):
                     opening_mode+= "b"
                 with open(os.path.join(canonical_dest, item), opening_mode) as f:
-                    f.write(source_tree[item])
+                    for i in range(0, len(source_tree[item]), self.chunk_size):
+                        chunk = source_tree[item][i:i + self.chunk_size]
+                        self._send(chunk, "bytes_downloaded")
+                        f.write(chunk)
+                self._count("files_downloaded", 1)
 
     def listdir(self, path="."):
         if self._connected:
             # Try to walk to the target directory
-            try:
-                result = self._walk(path)
+            self._round_trip()
+            with self._lock:
+                try:
+                    result = self._walk(path)
 
-                # If the target was a file we raise an exception
-                if isinstance(result, dict):
-                    return list(result.keys())
-                else:
-                    raise UnpermittedOperationError("listdir: {} isn't a directory.".format(path))
-            except NotFoundError:
-                raise NotFoundError("listdir: {} doesn't exist".format(path))
+                    # If the target was a file we raise an exception
+                    if isinstance(result, dict):
+                        return list(result.keys())
+                    else:
+                        raise UnpermittedOperationError("listdir: {} isn't a directory.".format(path))
+                except NotFoundError:
+                    raise NotFoundError("listdir: {} doesn't exist".format(path))
         else:
             raise NotConnectedError("listdir: Not connected.")
 
 
     def remove(self, path):
         if self._connected:
-            basefile, to_remove = os.path.split(os.path.normpath(os.path.join(self._cwd, path)))
+            self._round_trip()
+            with self._lock:
+                basefile, to_remove = os.path.split(os.path.normpath(os.path.join(self._cwd, path)))
 
-            # Try to walk to the base directory
-            try:
-                base = self._walk(basefile)
+                # Try to walk to the base directory
+                try:
+                    base = self._walk(basefile)
 
-                # If the target resource doesn't exist we raise an exception
-                if not to_remove in base:
-                    raise NotFoundError("remove: {} doesn't exist.".format(path))
+                    # If the target resource doesn't exist we raise an exception
+                    if not to_remove in base:
+                        raise NotFoundError("remove: {} doesn't exist.".format(path))
 
-                del base[to_remove]
-            except NotFoundError:
-                raise NotFoundError("remove: {} doesn't exist".format(basefile))
+                    self._discard(base.pop(to_remove))
+                except NotFoundError:
+                    raise NotFoundError("remove: {} doesn't exist".format(basefile))
         else:
             raise NotConnectedError("remove: Not connected.")
 
     def mkdir(self, path):
         if self._connected:
-            basefile, new_dir = os.path.split(os.path.normpath(os.path.join(self._cwd, path)))
+            self._round_trip()
+            with self._lock:
+                basefile, new_dir = os.path.split(os.path.normpath(os.path.join(self._cwd, path)))
 
-            # Try to walk to the base directory
-            try:
-                base = self._walk(basefile)
+                # Try to walk to the base directory
+                try:
+                    base = self._walk(basefile)
 
-                # If the basefile is a regular file we raise an exception
-                if not isinstance(base, dict):
-                    raise UnpermittedOperationError("mkdir: {} is a file.".format(basefile))
+                    # If the basefile is a regular file we raise an exception
+                    if not isinstance(base, dict):
+                        raise UnpermittedOperationError("mkdir: {} is a file.".format(basefile))
 
-                # If the target directory already exists we raise an exception
-                if new_dir in base:
-                    raise UnpermittedOperationError("mkdir: {} already exists.".format(path))
+                    # If the target directory already exists we raise an exception
+                    if new_dir in base:
+                        raise UnpermittedOperationError("mkdir: {} already exists.".format(path))
 
-                # A dict is mutable so self._walk returns a reference we can directly modify
-                base[new_dir] = {}
-            except NotFoundError:
-                raise NotFoundError("mkdir: {} doesn't exist.".format(basefile))
+                    # A dict is mutable so self._walk returns a reference we can directly modify
+                    base[new_dir] = {}
+                except NotFoundError:
+                    raise NotFoundError("mkdir: {} doesn't exist.".format(basefile))
         else:
             raise NotConnectedError("mkdir: Not connected.")
 
     def rename(self, path, new_path):
         if self._connected:
-            canonical_path = os.path.normpath(os.path.join(self._cwd, path))
-            basefile, old_file = os.path.split(canonical_path)
+            self._round_trip()
+            with self._lock:
+                canonical_path = os.path.normpath(os.path.join(self._cwd, path))
+                basefile, old_file = os.path.split(canonical_path)
 
-            # Try to walk to the old base directory
-            base = {}
-            try:
-                base = self._walk(basefile)
-            except NotFoundError:
-                raise NotFoundError("rename: {} doesn't exist.".format(basefile))
+                # Try to walk to the old base directory
+                base = {}
+                try:
+                    base = self._walk(basefile)
+                except NotFoundError:
+                    raise NotFoundError("rename: {} doesn't exist.".format(basefile))
 
-            # If the old file doesn't exist, we raise an exception
-            if not old_file in base:
-                raise NotFoundError("rename: {} doesn't exist.".format(path))
+                # If the old file doesn't exist, we raise an exception
+                if not old_file in base:
+                    raise NotFoundError("rename: {} doesn't exist.".format(path))
 
-            # Try to walk to the new base directory
-            new_canonical_path = os.path.normpath(os.path.join(self._cwd, new_path))
-            new_basefile, new_name = os.path.split(new_canonical_path)
-            try:
-                new_base = self._walk(new_basefile)
+                # Try to walk to the new base directory
+                new_canonical_path = os.path.normpath(os.path.join(self._cwd, new_path))
+                new_basefile, new_name = os.path.split(new_canonical_path)
+                try:
+                    new_base = self._walk(new_basefile)
 
-                # If the new basefile is a regular file we raise an exception
-                if not isinstance(new_base, dict):
-                    raise UnpermittedOperationError("rename: {} is a file.".format(new_basefile))
+                    # If the new basefile is a regular file we raise an exception
+                    if not isinstance(new_base, dict):
+                        raise UnpermittedOperationError("rename: {} is a file.".format(new_basefile))
 
-                # If the destination is in the source, we raise an exception (you can't copy a directory in itself)
-                if os.path.basename(os.path.commonpath([canonical_path, new_canonical_path])) == os.path.basename(canonical_path):
-                    raise UnpermittedOperationError("rename: can't rename {} into itself.".format(path))
+                    # If the destination is in the source, we raise an exception (you can't copy a directory in itself)
+                    if os.path.basename(os.path.commonpath([canonical_path, new_canonical_path])) == os.path.basename(canonical_path):
+                        raise UnpermittedOperationError("rename: can't rename {} into itself.".format(path))
 
-                # If the new file name already exists, we raise an exception
-                if new_name in new_base:
-                    raise UnpermittedOperationError("rename: {} already exists.".format(new_path))
+                    # If the new file name already exists, we raise an exception
+                    if new_name in new_base:
+                        raise UnpermittedOperationError("rename: {} already exists.".format(new_path))
 
 
-                new_base[new_name] = base.pop(old_file)
-            except NotFoundError:
-                raise NotFoundError("rename:  {} doesn't exist.".format(new_basefile))
+                    new_base[new_name] = base.pop(old_file)
+                except NotFoundError:
+                    raise NotFoundError("rename:  {} doesn't exist.".format(new_basefile))
         else:
             raise NotConnectedError("rename: Not connected.")
 
@@ -272,6 +450,7 @@ class DummyStorage(AbstractStorageContext):
                 raise NotFoundError("chdir: {} doesn't exist.".format(path))
 
             # Set the new path
+            self._round_trip()
             new_path = os.path.normpath(os.path.join(self._cwd, path))
             self._cwd = new_path
         else:
@@ -1,49 +1,389 @@
 import os
-from ftplib import FTP
+import time
+import errno
+import queue
+import socket
+import threading
+import concurrent.futures
+import posixpath
+from ftplib import FTP, error_perm, error_temp, error_reply
 
 from .utils import *
 
 _all_ = ["FTPStorage"]
 
+_RETRY_DELAY = 1
+"""Seconds before retrying a failed transfer (doubled at each retry)"""
+
+_PARTIAL_SUFFIX = ".part"
+"""Suffix of the files being downloaded, renamed once complete"""
+
+_NETWORK_ERRNOS = {errno.ENETDOWN, errno.ENETUNREACH, errno.ENETRESET, errno.ECONNABORTED, errno.ECONNRESET, errno.ECONNREFUSED, errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ETIMEDOUT}
+"""Error numbers of the connection failures"""
+
+def _is_transient(error):
+    """
+        Tells if a transfer error is a connection failure, worth retrying on another connection.
+
+        Local errors (e.g. a full disk) and permanent error replies aren't.
+
+        :param error: The error.
+        :type error: Exception
+        :return: True if the transfer can be retried.
+        :rtype: bool
+    """
+
+    if isinstance(error, (EOFError, error_temp, error_reply, socket.timeout, socket.herror, socket.gaierror, ConnectionError)):
+        return True
+    return isinstance(error, OSError) and error.errno in _NETWORK_ERRNOS
+
 class FTPStorage(AbstractStorageContext):
     """
         FTP storage system.
 
         A handy wrapper for ftplib.FTP methods.
+
+        Files are transferred through a pool of up to `connections` authenticated connections, so that the files of a directory are sent concurrently instead of paying a round trip per file one after the other. The pool is kept across calls, until disconnect. Navigation (chdir, listdir, etc.) only uses the main connection, which is part of the pool; like ftplib.FTP, an FTPStorage object mustn't be shared between threads.
+
+        Directory listings are cached for the lifetime of the connection, so that isdir, listdir and exists are answered without round trips once a directory has been listed (with MLSD, or LIST on servers which don't support it). The cache is invalidated by the methods modifying the storage: changes made by someone else while connected aren't seen.
+
+        Files are streamed by blocks of `block_size` bytes. When a connection fails during a transfer, the transfer is retried on another connection, resuming (with REST) where the partial file stops instead of from the beginning. Transferred files are checked against the size of their source (with SIZE, if the server supports it). Downloaded files are written next to their destination with a .part suffix, and renamed once complete: a local file is never overwritten, nor a partial file resumed unless the download created it.
     """
 
     CONNEXION_TYPE = "ftp"
 
-    def __init__(self, host, user="anonymous", passwd=""):
+    def __init__(self, host, user="anonymous", passwd="", connections=1, block_size=1024 * 1024, retries=3):
+        """
+            :param host: FTP server.
+            :type host: str
+            :param user: User name.
+            :type user: str
+            :param passwd: Password.
+            :type passwd: str
+            :param connections: Maximum number of connections opened to transfer files in parallel.
+            :type connections: int
+            :param block_size: Size of the blocks files are sent and received by.
+            :type block_size: int
+            :param retries: Number of times a transfer is resumed after a connection failure.
+            :type retries: int
+        """
+
         if not host:
             raise ValueError("__init__: please provide a host.")
+        if connections < 1:
+            raise ValueError("__init__: connections must be at least 1.")
+        if block_size < 1:
+            raise ValueError("__init__: block_size must be at least 1.")
+        if retries < 0:
+            raise ValueError("__init__: retries must be positive.")
         self.host = host
         self.user = user
         self.passwd = passwd
+        self.connections = connections
+        self.block_size = block_size
+        self.retries = retries
         self._connection = None
 
+        self._pool = None
+        """Idle connections (the main connection included)"""
+
+        self._opened = 0
+        """Number of connections of the pool, idle or not"""
+
+        self._pool_lock = threading.Lock()
+
+        self._cwd = None
+        """Working directory of the main connection"""
+
+        self._listings = {}
+        """Cached directory listings: {name: True if it's a directory} dicts, indexed by absolute directory path"""
+
+        self._mlsd = True
+        """False once the server refused MLSD"""
+
+    def _open(self):
+        """
+            Opens an authenticated connection.
+
+            :return: The connection.
+            :rtype: ftplib.FTP
+        """
+
+        connection = FTP(host=self.host)
+        try:
+            connection.login(user=self.user, passwd=self.passwd)
+        except:
+            connection.close()
+            raise
+        return connection
+
     def connect(self):
         if not self._connection is None:
             raise AlreadyConnectedError("connect: you're already connected to {}.".format(self._connection.host)) # We use self._connection.host because the user could modify the host after the connection was opened
 
         try:
-            self._connection = FTP(host=self.host)
-            self._connection.login(user=self.user, passwd=self.passwd)
+            self._connection = self._open()
+        except Exception as e:
+            raise UnableToConnectError("connect: FTP module returned an error ({}).".format(e))
+
+        # Last in, first out: the main connection is preferred, and extra connections are only opened when transfers overlap
+        self._pool = queue.LifoQueue()
+        self._pool.put(self._connection)
+        self._opened = 1
+
+        self._listings = {}
+        self._mlsd = True
+        try:
+            self._cwd = self._connection.pwd()
         except Exception as e:
-            if not self._connection is None:
-                self._connection.close()
+            self.disconnect()
             raise UnableToConnectError("connect: FTP module returned an error ({}).".format(e))
 
     def disconnect(self):
         if self._connection is None:
             raise NotConnectedError("disconnect: you're not connected to {}.".format(self.host))
 
+        connections = []
+        while not self._pool.empty():
+            connections.append(self._pool.get_nowait())
+        if not self._connection in connections:
+            connections.append(self._connection)
+
+        for connection in connections:
+            try:
+                connection.quit()
+            except:
+                connection.close()
+        self._connection = None
+        self._pool = None
+        self._opened = 0
+        self._cwd = None
+        self._listings = {}
+
+    def _acquire(self):
+        """
+            Takes a connection from the pool, opening a new one if all of them are busy and the pool isn't full.
+
+            :return: The connection.
+            :rtype: ftplib.FTP
+        """
+
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._pool_lock:
+            opening = self._opened < self.connections
+            if opening:
+                self._opened += 1
+        if not opening:
+            return self._pool.get()
+
+        try:
+            return self._open()
+        except:
+            with self._pool_lock:
+                self._opened -= 1
+            raise
+
+    def _release(self, connection, broken=False):
+        """
+            Gives a connection back to the pool.
+
+            :param connection: The connection.
+            :type connection: ftplib.FTP
+            :param broken: True if the connection failed (other than by a permanent error reply): it's closed and will be replaced by a new one when needed. The main connection is replaced at once, in the same working directory (if it can't be, it's kept and the next command will fail).
+            :type broken: bool
+        """
+
+        if broken and not connection is self._connection:
+            connection.close()
+            with self._pool_lock:
+                self._opened -= 1
+            return
+
+        if broken:
+            try:
+                main_connection = self._open()
+                main_connection.cwd(self._cwd)
+                connection.close()
+                self._connection = connection = main_connection
+            except Exception:
+                pass
+        self._pool.put(connection)
+
+    def _resumable(self, attempt, src, dest):
+        """
+            Runs a transfer on a connection of the pool, and resumes it on another one if the connection fails (error replies and local errors aren't retried).
+
+            :param attempt: Transfer attempt function (_store_attempt or _retrieve_attempt).
+            :type attempt: function
+            :param src: Source: open local file, or distant path.
+            :type src: str
+            :param dest: Destination: distant path, or open local file.
+            :type dest: str
+        """
+
+        for retry in range(self.retries + 1):
+            connection = self._acquire()
+            broken = False
+            try:
+                attempt(connection, src, dest, retry > 0)
+                return
+            except (error_perm, StorageError):
+                # The server answered: the connection can still be used
+                raise
+            except Exception as e:
+                # Even a local error leaves the connection in the middle of a transfer
+                broken = True
+                if not _is_transient(e) or retry == self.retries:
+                    raise
+            finally:
+                self._release(connection, broken)
+            time.sleep(_RETRY_DELAY * 2 ** retry)
+
+    def _remote_size(self, connection, path):
+        """
+            Returns the size of a distant file.
+
+            :param connection: Connection to use.
+            :type connection: ftplib.FTP
+            :param path: Absolute distant path.
+            :type path: str
+            :return: The size, or None if the file doesn't exist or the server doesn't support SIZE.
+            :rtype: int
+        """
+
+        try:
+            # SIZE is only meaningful in binary mode
+            connection.voidcmd("TYPE I")
+            return connection.size(path)
+        except error_perm:
+            return None
+
+    def _store(self, src, dest):
+        """
+            Sends a file on a connection of the pool.
+
+            :param src: Local file path.
+            :type src: str
+            :param dest: Absolute distant path.
+            :type dest: str
+        """
+
+        # Opened before any connection is used, so that a local error doesn't affect the pool
+        with open(src, "rb") as f:
+            self._resumable(self._store_attempt, f, dest)
+
+    def _store_attempt(self, connection, src, dest, resume):
+        """
+            Sends a file, or the rest of a partially sent file.
+
+            :param connection: Connection to use.
+            :type connection: ftplib.FTP
+            :param src: Local file, open in binary mode.
+            :type src: io.BufferedReader
+            :param dest: Absolute distant path.
+            :type dest: str
+            :param resume: True to resume the transfer after the partial distant file.
+            :type resume: bool
+        """
+
+        size = os.fstat(src.fileno()).st_size
+        offset = (self._remote_size(connection, dest) or 0) if resume else 0
+        if offset > size:
+            offset = 0
+
+        src.seek(offset)
+        connection.storbinary("STOR {}".format(dest), src, self.block_size, rest=offset if offset > 0 else None)
+
+        stored_size = self._remote_size(connection, dest)
+        if not stored_size is None and stored_size != size:
+            raise StorageError("_store: {} is {} bytes long instead of {}.".format(dest, stored_size, size))
+
+    def _retrieve(self, src, dest):
+        """
+            Receives a file on a connection of the pool.
+
+            :param src: Absolute distant path.
+            :type src: str
+            :param dest: Local file path.
+            :type dest: str
+
+            :raises UnpermittedOperationError: If the local file, or its partial file, already exists.
+        """
+
+        if os.path.lexists(dest):
+            raise UnpermittedOperationError("_retrieve: {} already exists.".format(dest))
+        partial = dest + _PARTIAL_SUFFIX
         try:
-            self._connection.quit()
+            # Created here, so that only a partial file of this download is resumed
+            f = open(partial, "xb")
+        except FileExistsError:
+            raise UnpermittedOperationError("_retrieve: {} already exists.".format(partial))
+
+        try:
+            with f:
+                self._resumable(self._retrieve_attempt, src, f)
+            if os.path.lexists(dest):
+                raise UnpermittedOperationError("_retrieve: {} already exists.".format(dest))
+            os.rename(partial, dest)
         except:
-            self._connection.close()
-        finally:
-            self._connection = None
+            os.remove(partial)
+            raise
+
+    def _retrieve_attempt(self, connection, src, dest, resume):
+        """
+            Receives a file, or the rest of a partially received file.
+
+            :param connection: Connection to use.
+            :type connection: ftplib.FTP
+            :param src: Absolute distant path.
+            :type src: str
+            :param dest: Partial local file, open in binary mode.
+            :type dest: io.BufferedRandom
+            :param resume: True to resume the transfer after what previous attempts wrote.
+            :type resume: bool
+        """
+
+        size = self._remote_size(connection, src)
+        offset = dest.seek(0, os.SEEK_END) if resume else 0
+        if not size is None and offset > size:
+            offset = 0
+
+        dest.seek(offset)
+        dest.truncate()
+        connection.retrbinary("RETR {}".format(src), dest.write, self.block_size, rest=offset if offset > 0 else None)
+        dest.flush()
+
+        retrieved_size = dest.tell()
+        if not size is None and retrieved_size != size:
+            raise StorageError("_retrieve: {} is {} bytes long instead of {}.".format(dest.name, retrieved_size, size))
+
+    def _transfer(self, function, transfers):
+        """
+            Runs transfers concurrently, on up to `connections` threads (each one using its own connection).
+
+            :param function: Transfer function (_store or _retrieve).
+            :type function: function
+            :param transfers: (source, destination) tuples.
+            :type transfers: list
+        """
+
+        if self.connections == 1 or len(transfers) <= 1:
+            for src, dest in transfers:
+                function(src, dest)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.connections, len(transfers))) as executor:
+            futures = [executor.submit(function, src, dest) for src, dest in transfers]
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    # Remaining transfers are useless
+                    for f in futures:
+                        f.cancel()
+                    raise future.exception()
 
     def upload(self, src, dest="."):
         if self._connection is None:
@@ -75,70 +415,114 @@ class FTPStorage(AbstractStorageContext):
         if not os.path.exists(src):
             raise NotFoundError("upload: {} doesn't exist.".format(src))
 
+        # The other connections of the pool don't share the working directory of the main one
+        full_dest = self._absolute(os.path.join(dest, dest_filename))
         try:
             if os.path.isdir(src):
-                full_dest = os.path.join(dest, dest_filename)
                 self._connection.mkd(full_dest)
-                self._recursive_upload(src, full_dest)
+                self._transfer(self._store, self._recursive_upload(src, full_dest))
             else:
-                with open(src, "rb") as f:
-                    self._connection.storbinary('STOR {}'.format(os.path.join(dest, dest_filename)), f)
+                self._store(src, full_dest)
         except Exception as e:
+            self._invalidate(full_dest)
             raise StorageError("upload: FTP module returned an error ({}).".format(e))
+        self._record(full_dest, os.path.isdir(src))
 
     def _recursive_upload(self, current_file, dest):
         """
             Internal recursive upload subroutine.
 
-            When uploading a directory, recursively creates its structure.
+            When uploading a directory, recursively creates its structure, and lists the files to send.
 
             :param current_file: The directory to upload.
             :type current_file: str
-            :param dest: Destination.
+            :param dest: Absolute destination.
             :type dest: str
+            :return: (local path, distant path) tuples of the files to send.
+            :rtype: list
         """
+
+        transfers = []
         files = os.listdir(current_file)
         for f in files:
             subfile = os.path.join(current_file, f)
             next_dest = os.path.join(dest, f)
             if os.path.isdir(subfile):
                 self._connection.mkd(next_dest)
-                self._recursive_upload(subfile, next_dest)
+                transfers.extend(self._recursive_upload(subfile, next_dest))
             else:
-                with open(subfile, 'rb') as fp:
-                    self._connection.storbinary('STOR {}'.format(next_dest), fp)
+                transfers.append((subfile, next_dest))
+        return transfers
 
     def download(self, src, dest="."):
-        #TODO Implement me
-        raise NotImplementedError("download: Method not implemented yet.")
-
         if self._connection is None:
             raise NotConnectedError("download: you're not connected to {}.".format(self.host))
 
         try:
-            pass
+            src_is_dir = self.isdir(src)
+        except NotFoundError:
+            raise NotFoundError("download: {} doesn't exist.".format(src))
+
+        full_src = self._absolute(src)
+        canonical_dest = os.path.abspath(dest)
+
+        # If the destination is an existing directory, we download into it
+        if os.path.isdir(canonical_dest):
+            canonical_dest = os.path.join(canonical_dest, posixpath.basename(full_src))
+
+        # If the destination exists, we raise an exception (otherwise we would override it)
+        if os.path.lexists(canonical_dest):
+            raise UnpermittedOperationError("download: {} already exists.".format(canonical_dest))
+
+        if not os.path.isdir(os.path.dirname(canonical_dest)):
+            raise NotFoundError("download: {} doesn't exist.".format(os.path.dirname(canonical_dest)))
+
+        try:
+            if src_is_dir:
+                os.mkdir(canonical_dest)
+                self._transfer(self._retrieve, self._recursive_download(full_src, canonical_dest))
+            else:
+                self._retrieve(full_src, canonical_dest)
+        except UnpermittedOperationError:
+            raise
         except Exception as e:
             raise StorageError("download: FTP module returned an error ({}).".format(e))
 
+    def _recursive_download(self, current_file, canonical_dest):
+        """
+            Internal recursive download subroutine.
+
+            When downloading a directory, recursively creates its structure, and lists the files to receive.
+
+            :param current_file: Absolute path of the distant directory to download.
+            :type current_file: str
+            :param canonical_dest: Absolute path for the destination.
+            :type canonical_dest: str
+            :return: (distant path, local path) tuples of the files to receive.
+            :rtype: list
+        """
+
+        transfers = []
+        for f, is_dir in list(self._list(current_file).items()):
+            next_canonical_dest = os.path.join(canonical_dest, f)
+            if is_dir:
+                os.mkdir(next_canonical_dest)
+                transfers.extend(self._recursive_download(posixpath.join(current_file, f), next_canonical_dest))
+            else:
+                transfers.append((posixpath.join(current_file, f), next_canonical_dest))
+        return transfers
+
     def listdir(self, path="."):
         if self._connection is None:
             raise NotConnectedError("listdir: you're not connected to {}.".format(self.host))
 
-        last_path = self.getcwd()
-        abs_path = os.path.normpath(os.path.join(last_path, path))
-
         try:
             if not self.isdir(path):
                 return [os.path.basename(path)]
-            self.chdir(abs_path)
-            result = [os.path.basename(f) for f in self._connection.nlst("-a") if not os.path.basename(f) in [".", "..", ""]]
-            self.chdir(last_path)
-            return result
+            return list(self._list(self._absolute(path)))
         except NotFoundError as e:
-            self.chdir(last_path)
             raise NotFoundError("listdir: FTP module returned an error ({}).".format(e))
         except Exception as e:
-            self.chdir(last_path)
             raise StorageError("listdir: FTP module returned an error ({}).".format(e))
 
     def isdir(self, path):
@@ -154,27 +538,138 @@ class FTPStorage(AbstractStorageContext):
         if self._connection is None:
             raise NotConnectedError("isdir: you're not connected to {}.".format(self.host))
 
-        basename, filename = os.path.split(os.path.normpath(os.path.join(self.getcwd(), path)))
-        files = {}
+        basename, filename = os.path.split(self._absolute(path))
 
         # Case where our canonical path is the root
         if filename == "":
             return True
 
         try:
-            list_log = []
-            old_cwd = self._connection.pwd()
-            self._connection.cwd(basename)
-            self._connection.dir("-a", list_log.append)
-            self._connection.cwd(old_cwd)
-            files = {' '.join(line.split()[8:]): line[0] for line in list_log}
+            files = self._list(basename)
+        except NotFoundError:
+            raise NotFoundError("isdir: {} doesn't exist.".format(path))
         except Exception as e:
             raise StorageError("isdir: FTP module returned an error ({}).".format(e))
 
         if not filename in files:
             raise NotFoundError("isdir: {} doesn't exist.".format(path))
 
-        return files[filename] == "d"
+        return files[filename]
+
+    def exists(self, path):
+        """
+            Tests if the path exists.
+
+            :param path: File to test.
+            :type path: str
+            :return: True if the path is an existing file or directory.
+            :rtype: bool
+        """
+
+        try:
+            self.isdir(path)
+            return True
+        except NotFoundError:
+            return False
+
+    def _absolute(self, path):
+        """
+            Returns the absolute (normalized) distant path of a path relative to the working directory.
+
+            :param path: Distant path.
+            :type path: str
+            :return: The absolute path.
+            :rtype: str
+        """
+
+        return posixpath.normpath(posixpath.join(self._cwd, path))
+
+    def _list(self, path):
+        """
+            Lists a directory, from the cache if it has already been listed.
+
+            :param path: Absolute directory path.
+            :type path: str
+            :return: {name: True if it's a directory} dict (not to be modified).
+            :rtype: dict
+
+            :raises: backupper.connect.utils.NotFoundError
+        """
+
+        if path in self._listings:
+            return self._listings[path]
+
+        files = None
+        if self._mlsd:
+            try:
+                files = {name: facts.get("type", "").lower() == "dir" for name, facts in self._connection.mlsd(path, facts=["type"]) if not facts.get("type", "").lower() in ["cdir", "pdir"] and not name in [".", ".."]}
+            except error_perm as e:
+                # 500, 501 or 502: MLSD isn't implemented
+                if str(e).startswith("55"):
+                    raise NotFoundError("_list: {} doesn't exist.".format(path))
+                self._mlsd = False
+
+        if files is None:
+            # LIST output isn't standardized, but every server mimics ls -l
+            list_log = []
+            try:
+                self._connection.cwd(path)
+            except error_perm:
+                raise NotFoundError("_list: {} doesn't exist.".format(path))
+            try:
+                self._connection.dir("-a", list_log.append)
+            finally:
+                self._connection.cwd(self._cwd)
+            files = {' '.join(line.split()[8:]): line[0] == "d" for line in list_log if not ' '.join(line.split()[8:]) in [".", "..", ""]}
+
+        self._listings[path] = files
+        return files
+
+    def _invalidate(self, path):
+        """
+            Forgets the cached listings a modification of a path makes obsolete: its parent, and itself and its subdirectories if it's a directory.
+
+            :param path: Absolute path of the modified file or directory.
+            :type path: str
+        """
+
+        self._listings.pop(posixpath.dirname(path), None)
+        prefix = path.rstrip("/") + "/"
+        for listed in [p for p in self._listings if p == path or p.startswith(prefix)]:
+            del self._listings[listed]
+
+    def forget(self, path):
+        """
+            Forgets the cached listings of a path, because it has been modified through another connection (e.g. by another session of backupper.connect.AsyncFTPStorage): its parent, and itself and its subdirectories if it's a directory.
+
+            Nothing is cached while disconnected, so it does nothing then.
+
+            :param path: Modified file or directory, absolute or relative to the working directory.
+            :type path: str
+        """
+
+        if self._connection is None:
+            return
+        self._invalidate(self._absolute(path))
+
+    def _record(self, path, is_dir):
+        """
+            Updates the cached listings after a successful modification of a path, instead of listing its parent again.
+
+            :param path: Absolute path of the created or removed file or directory.
+            :type path: str
+            :param is_dir: True if a directory has been created, False if a file has been created, None if the path has been removed.
+            :type is_dir: bool
+        """
+
+        parent = self._listings.get(posixpath.dirname(path))
+        self._invalidate(path)
+        if parent is not None:
+            if is_dir is None:
+                parent.pop(posixpath.basename(path), None)
+            else:
+                parent[posixpath.basename(path)] = is_dir
+            self._listings[posixpath.dirname(path)] = parent
 
     def remove(self, path):
         if self._connection is None:
@@ -188,7 +683,9 @@ class FTPStorage(AbstractStorageContext):
             else:
                 self._connection.delete(path)
         except Exception as e:
+            self._invalidate(self._absolute(path))
             raise StorageError("remove: FTP module returned an error ({}).".format(e))
+        self._record(self._absolute(path), None)
 
     def _recursive_remove(self, current_file):
         """
@@ -202,7 +699,10 @@ class FTPStorage(AbstractStorageContext):
         try:
             self._connection.mkd(path)
         except Exception as e:
+            self._invalidate(self._absolute(path))
             raise StorageError("mkdir: FTP module returned an error ({}).".format(e))
+        self._record(self._absolute(path), True)
+        self._listings[self._absolute(path)] = {}
 
     def rename(self, path, new_path):
         if self._connection is None:
@@ -211,7 +711,15 @@ class FTPStorage(AbstractStorageContext):
         try:
             self._connection.rename(path, new_path)
         except Exception as e:
+            self._invalidate(self._absolute(path))
+            self._invalidate(self._absolute(new_path))
             raise StorageError("rename: FTP module returned an error ({}).".format(e))
+        is_dir = self._listings.get(posixpath.dirname(self._absolute(path)), {}).get(posixpath.basename(self._absolute(path)))
+        self._record(self._absolute(path), None)
+        if is_dir is None:
+            self._invalidate(self._absolute(new_path))
+        else:
+            self._record(self._absolute(new_path), is_dir)
 
     def chdir(self, path="/"):
         if self._connection is None:
@@ -221,12 +729,10 @@ class FTPStorage(AbstractStorageContext):
             self._connection.cwd(path)
         except Exception as e:
             raise NotFoundError("chdir: FTP module returned an error ({}).".format(e))
+        self._cwd = self._absolute(path)
 
     def getcwd(self):
         if self._connection is None:
             raise NotConnectedError("getcwd: you're not connected to {}.".format(self.host))
 
-        try:
-            return self._connection.pwd()
-        except Exception as e:
-            raise StorageError("getcwd: FTP module returned an error ({}).".format(e))
+        return self._cwd
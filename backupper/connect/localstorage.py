@@ -0,0 +1,356 @@
+import os
+import errno
+import shutil
+import tempfile
+import concurrent.futures
+
+from .utils import *
+
+__all__ = ["LocalStorage"]
+
+_UNSUPPORTED_COPY_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+"""Errors of copy_file_range and sendfile meaning they can't copy between the given files"""
+
+def _copy_file(src, dest, block_size):
+    """
+        Copies a file's contents, in the kernel if possible.
+
+        copy_file_range is tried first (it can even share extents on filesystems supporting reflinks, or copy server-side on NFS 4.2), then sendfile, then a copy through a buffer of block_size bytes. Each method goes on from where the previous one stopped: some filesystems (procfs, sysfs, some FUSE and network mounts) make the kernel methods copy nothing, or stop before the end of the file, so they're only trusted if they copied at least the size of the source.
+
+        :param src: Source file path.
+        :type src: str
+        :param dest: Destination file path (overwritten).
+        :type dest: str
+        :param block_size: Size of the copied blocks.
+        :type block_size: int
+    """
+
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while True:
+                    copied = os.copy_file_range(fsrc.fileno(), fdest.fileno(), block_size, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                if offset > 0 and offset >= size:
+                    return
+            except OSError as e:
+                if not e.errno in _UNSUPPORTED_COPY_ERRORS:
+                    raise
+
+        if hasattr(os, "sendfile"):
+            try:
+                # sendfile writes at the destination position
+                os.lseek(fdest.fileno(), offset, os.SEEK_SET)
+                while True:
+                    copied = os.sendfile(fdest.fileno(), fsrc.fileno(), offset, block_size)
+                    if copied == 0:
+                        break
+                    offset += copied
+                if offset > 0 and offset >= size:
+                    return
+            except OSError as e:
+                if not e.errno in _UNSUPPORTED_COPY_ERRORS:
+                    raise
+
+        fsrc.seek(offset)
+        fdest.seek(offset)
+        shutil.copyfileobj(fsrc, fdest, block_size)
+
+class LocalStorage(AbstractStorageContext):
+    """
+        Local storage system.
+
+        Stores files in a directory of the local file system, typically a mounted network share (NFS, SMB, etc.). The root of the storage is this directory.
+
+        Files are copied by the kernel when it can (see _copy_file), and the files of a tree are copied by `jobs` threads. A copy is written under a temporary name next to its destination, then renamed, so that an interrupted transfer never leaves a partial file or tree under the destination name.
+    """
+
+    CONNEXION_TYPE = "local"
+
+    def __init__(self, root, jobs=4, block_size=8 * 1024 * 1024):
+        """
+            :param root: Directory of the storage.
+            :type root: str
+            :param jobs: Number of files copied in parallel.
+            :type jobs: int
+            :param block_size: Size of the copied blocks.
+            :type block_size: int
+        """
+
+        if not root:
+            raise ValueError("__init__: please provide a root directory.")
+        if jobs < 1:
+            raise ValueError("__init__: jobs must be at least 1.")
+        self.root = os.path.abspath(root)
+        self.jobs = jobs
+        self.block_size = block_size
+
+        self._cwd = "/"
+        """Storage current working directory"""
+
+        self._connected = False
+        """True if connected"""
+
+    def connect(self):
+        if self._connected:
+            raise AlreadyConnectedError("connect: Already connected.")
+        if not os.path.isdir(self.root):
+            raise UnableToConnectError("connect: {} isn't a directory.".format(self.root))
+        self._connected = True
+
+    def disconnect(self):
+        if not self._connected:
+            raise NotConnectedError("disconnect: Not connected.")
+        self._connected = False
+        self._cwd = "/"
+
+    def _local(self, path):
+        """
+            Returns the local path of a storage path.
+
+            :param path: Absolute or relative storage path.
+            :type path: str
+            :return: The local path (in root).
+            :rtype: str
+        """
+
+        # normpath can't go above /, so the path can't escape root
+        canonical_path = os.path.normpath(os.path.join(self._cwd, path))
+        return os.path.normpath(os.path.join(self.root, canonical_path.lstrip("/")))
+
+    def _destination(self, operation, src, dest, canonical_dest):
+        """
+            Resolves the destination of a transfer: into dest if it's an existing directory, or as dest otherwise.
+
+            :param operation: Method name, for errors.
+            :type operation: str
+            :param src: Source path.
+            :type src: str
+            :param dest: Destination path, for errors.
+            :type dest: str
+            :param canonical_dest: Local path of the destination.
+            :type canonical_dest: str
+            :return: Local path of the transferred file or directory.
+            :rtype: str
+        """
+
+        if os.path.isdir(canonical_dest):
+            canonical_dest = os.path.join(canonical_dest, os.path.basename(os.path.normpath(src)))
+            if os.path.lexists(canonical_dest):
+                raise UnpermittedOperationError("{}: {} already exists.".format(operation, os.path.join(dest, os.path.basename(os.path.normpath(src)))))
+        elif os.path.lexists(canonical_dest):
+            raise UnpermittedOperationError("{}: {} is a file.".format(operation, dest))
+        elif not os.path.isdir(os.path.dirname(canonical_dest)):
+            raise NotFoundError("{}: {} doesn't exist.".format(operation, os.path.normpath(os.path.dirname(dest))))
+        return canonical_dest
+
+    def _copy(self, src, dest):
+        """
+            Copies a file or a tree under a temporary name, then renames it.
+
+            :param src: Local source path.
+            :type src: str
+            :param dest: Local destination path (mustn't exist).
+            :type dest: str
+        """
+
+        parent, name = os.path.split(dest)
+        if os.path.isdir(src):
+            temporary = tempfile.mkdtemp(prefix=".{}.".format(name), suffix=".part", dir=parent)
+            try:
+                self._copy_tree(src, temporary)
+                os.rename(temporary, dest)
+            except:
+                shutil.rmtree(temporary, ignore_errors=True)
+                raise
+        else:
+            fd, temporary = tempfile.mkstemp(prefix=".{}.".format(name), suffix=".part", dir=parent)
+            os.close(fd)
+            try:
+                _copy_file(src, temporary, self.block_size)
+                shutil.copystat(src, temporary)
+                os.rename(temporary, dest)
+            except:
+                os.remove(temporary)
+                raise
+
+    def _copy_tree(self, src, dest):
+        """
+            Copies the contents of a directory, the files being copied in parallel.
+
+            :param src: Local source directory.
+            :type src: str
+            :param dest: Local destination directory (existing and empty).
+            :type dest: str
+        """
+
+        files = []
+        for current_dir, dirs, filenames in os.walk(src):
+            current_dest = os.path.join(dest, os.path.relpath(current_dir, src))
+            for d in dirs:
+                # os.walk doesn't descend into directory symlinks
+                if os.path.islink(os.path.join(current_dir, d)):
+                    os.symlink(os.readlink(os.path.join(current_dir, d)), os.path.join(current_dest, d))
+                else:
+                    os.mkdir(os.path.join(current_dest, d))
+            for f in filenames:
+                if os.path.islink(os.path.join(current_dir, f)):
+                    os.symlink(os.readlink(os.path.join(current_dir, f)), os.path.join(current_dest, f))
+                else:
+                    files.append((os.path.join(current_dir, f), os.path.join(current_dest, f)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for _ in executor.map(lambda transfer: self._copy_member(*transfer), files):
+                pass
+
+        # Directory times are set once their contents are written
+        for current_dir, dirs, _ in os.walk(src, topdown=False):
+            for d in dirs:
+                if not os.path.islink(os.path.join(current_dir, d)):
+                    shutil.copystat(os.path.join(current_dir, d), os.path.join(dest, os.path.relpath(current_dir, src), d))
+        shutil.copystat(src, dest)
+
+    def _copy_member(self, src, dest):
+        """
+            Copies a file of a tree.
+
+            :param src: Local source file.
+            :type src: str
+            :param dest: Local destination file.
+            :type dest: str
+        """
+
+        _copy_file(src, dest, self.block_size)
+        shutil.copystat(src, dest)
+
+    def upload(self, src, dest="."):
+        if not self._connected:
+            raise NotConnectedError("upload: Not connected.")
+
+        if not os.path.exists(src):
+            raise NotFoundError("upload: {} doesn't exist.".format(src))
+
+        canonical_dest = self._destination("upload", src, dest, self._local(dest))
+        try:
+            self._copy(os.path.abspath(src), canonical_dest)
+        except OSError as e:
+            raise StorageError("upload: {}".format(e))
+
+    def download(self, src, dest="."):
+        if not self._connected:
+            raise NotConnectedError("download: Not connected.")
+
+        canonical_src = self._local(src)
+        if not os.path.lexists(canonical_src):
+            raise NotFoundError("download: {} doesn't exist.".format(src))
+
+        canonical_dest = self._destination("download", src, dest, os.path.abspath(dest))
+        try:
+            self._copy(canonical_src, canonical_dest)
+        except OSError as e:
+            raise StorageError("download: {}".format(e))
+
+    def listdir(self, path="."):
+        if not self._connected:
+            raise NotConnectedError("listdir: Not connected.")
+
+        canonical_path = self._local(path)
+        if not os.path.lexists(canonical_path):
+            raise NotFoundError("listdir: {} doesn't exist.".format(path))
+        if not os.path.isdir(canonical_path):
+            raise UnpermittedOperationError("listdir: {} isn't a directory.".format(path))
+        return os.listdir(canonical_path)
+
+    def isdir(self, path):
+        """
+            Tests if the path is an existing directory.
+
+            :param path: File to test.
+            :type path: str
+            :return: True if the path is a directory.
+            :rtype: bool
+        """
+
+        if not self._connected:
+            raise NotConnectedError("isdir: Not connected.")
+
+        canonical_path = self._local(path)
+        if not os.path.lexists(canonical_path):
+            raise NotFoundError("isdir: {} doesn't exist.".format(path))
+        return os.path.isdir(canonical_path)
+
+    def remove(self, path):
+        if not self._connected:
+            raise NotConnectedError("remove: Not connected.")
+
+        canonical_path = self._local(path)
+        if canonical_path == self.root:
+            raise UnpermittedOperationError("remove: can't remove the root of the storage.")
+        if not os.path.lexists(canonical_path):
+            raise NotFoundError("remove: {} doesn't exist.".format(path))
+
+        try:
+            if os.path.isdir(canonical_path) and not os.path.islink(canonical_path):
+                shutil.rmtree(canonical_path)
+            else:
+                os.remove(canonical_path)
+        except OSError as e:
+            raise StorageError("remove: {}".format(e))
+
+    def mkdir(self, path):
+        if not self._connected:
+            raise NotConnectedError("mkdir: Not connected.")
+
+        canonical_path = self._local(path)
+        if os.path.lexists(canonical_path):
+            raise UnpermittedOperationError("mkdir: {} already exists.".format(path))
+        if not os.path.lexists(os.path.dirname(canonical_path)):
+            raise NotFoundError("mkdir: {} doesn't exist.".format(os.path.dirname(path)))
+        if not os.path.isdir(os.path.dirname(canonical_path)):
+            raise UnpermittedOperationError("mkdir: {} is a file.".format(os.path.dirname(path)))
+
+        try:
+            os.mkdir(canonical_path)
+        except OSError as e:
+            raise StorageError("mkdir: {}".format(e))
+
+    def rename(self, path, new_path):
+        if not self._connected:
+            raise NotConnectedError("rename: Not connected.")
+
+        canonical_path = self._local(path)
+        new_canonical_path = self._local(new_path)
+        if not os.path.lexists(canonical_path):
+            raise NotFoundError("rename: {} doesn't exist.".format(path))
+        if not os.path.isdir(os.path.dirname(new_canonical_path)):
+            raise NotFoundError("rename: {} doesn't exist.".format(os.path.dirname(new_path)))
+        if os.path.lexists(new_canonical_path):
+            raise UnpermittedOperationError("rename: {} already exists.".format(new_path))
+        if new_canonical_path.startswith(canonical_path.rstrip("/") + "/"):
+            raise UnpermittedOperationError("rename: can't rename {} into itself.".format(path))
+
+        try:
+            os.rename(canonical_path, new_canonical_path)
+        except OSError as e:
+            raise StorageError("rename: {}".format(e))
+
+    def chdir(self, path="/"):
+        if not self._connected:
+            raise NotConnectedError("chdir: Not connected.")
+
+        canonical_path = self._local(path)
+        if not os.path.lexists(canonical_path):
+            raise NotFoundError("chdir: {} doesn't exist.".format(path))
+        if not os.path.isdir(canonical_path):
+            raise UnpermittedOperationError("chdir: {} isn't a directory.".format(path))
+        self._cwd = os.path.normpath(os.path.join(self._cwd, path))
+
+    def getcwd(self):
+        if not self._connected:
+            raise NotConnectedError("getcwd: Not connected.")
+        return self._cwd
@@ -141,6 +141,16 @@ class AbstractStorageContext(ABC):
             :rtype: str
         """
 
+    def forget(self, path):
+        """
+            Forgets what the storage may have cached about a path, because it has been modified through another connection.
+
+            Storages which don't cache anything have nothing to do.
+
+            :param path: Modified resource.
+            :type path: str
+        """
+
     @classmethod
     def storage_methods(cls):
         """
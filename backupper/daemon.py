@@ -0,0 +1,472 @@
+"""
+    Backup daemon: runs the jobs of a daemon configuration on their schedules, in a single long-running process.
+
+    Each job is a backupper configuration file. Runs are threads of the daemon, so the interpreter, the imported modules, the gnupg.GPG objects (see backupper.archive.get_gpg) and the storage connections are set up once and reused by the next runs, instead of by every run of a cron job. A run needs one of the max_jobs slots, and one of the slots of its kind: jobs compressing, encrypting or deduplicating their artifacts are CPU-bound, the other ones (plain tars, snapshots) are I/O-bound, so that the jobs of one kind can't keep the other ones waiting.
+
+    Configuration files are reloaded when they change (or on SIGHUP), and the daemon stops on SIGTERM or SIGINT, once the running jobs are done.
+"""
+
+import sys
+import os
+import copy
+import json
+import time
+import signal
+import datetime
+import threading
+import multiprocessing
+
+import backupper
+from . import utils
+from . import archive
+from . import report
+from . import upload
+from . import cli
+
+__all__ = ["Job", "Daemon", "main"]
+
+class _JobError(Exception):
+    """
+        Error preventing a job from running, with the exit code backupper would have exited with.
+    """
+
+    def __init__(self, message, exit_code):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+def _log(message):
+    """
+        Writes a timestamped daemon message.
+
+        :param message: The message.
+        :type message: str
+    """
+
+    sys.stdout.write("[{}] {}\n".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), message))
+    sys.stdout.flush()
+
+def _guess_slot(configuration):
+    """
+        Guesses whether a job is CPU-bound or I/O-bound.
+
+        :param configuration: Validated configuration of the job.
+        :type configuration: dict
+        :return: "cpu" or "io".
+        :rtype: str
+    """
+
+    if configuration["encrypt"]:
+        return "cpu"
+    for artifact in configuration["artifacts"]:
+        if artifact["mode"] == "dedup" or (artifact["mode"] == "archive" and artifact["compression"]["codec"] != "none"):
+            return "cpu"
+    return "io"
+
+class Job:
+    """
+        A backup job: a configuration file and its schedule.
+    """
+
+    def __init__(self, configuration_file):
+        """
+            :param configuration_file: Absolute path of the job configuration file.
+            :type configuration_file: str
+        """
+
+        self.configuration_file = configuration_file
+        self.every = None
+        """Seconds between two runs (None if the job runs at given times)"""
+        self.at = []
+        """Times of the day (datetime.time) the job runs at"""
+        self.slot = None
+        """Slot kind forced by the daemon configuration (None to guess it)"""
+        self.report_file = None
+
+        self.next_run = None
+        """datetime.datetime of the next run (None until scheduled)"""
+        self.running = False
+
+        self._configuration = None
+        """Validated configuration, with absolute paths"""
+        self._mtime = None
+        """Modification time of the configuration file when it was loaded"""
+
+        self._storage = None
+        self._storage_node = None
+        """JSON of the "storage" node self._storage was opened from"""
+
+    def update(self, job_node, base_dir):
+        """
+            Applies the schedule of a daemon configuration "jobs" node.
+
+            :param job_node: Validated job node.
+            :type job_node: dict
+            :param base_dir: Daemon configuration file directory.
+            :type base_dir: str
+        """
+
+        every = job_node.get("every")
+        at = sorted(datetime.datetime.strptime(time, "%H:%M").time() for time in job_node.get("at", []))
+        if every != self.every or at != self.at:
+            self.next_run = None
+        self.every = every
+        self.at = at
+        self.slot = job_node.get("slot")
+        self.report_file = os.path.join(base_dir, job_node["report"]) if "report" in job_node else None
+
+    def schedule(self, now):
+        """
+            Sets the next run after now.
+
+            :param now: Current local datetime.
+            :type now: datetime.datetime
+        """
+
+        if self.every is not None:
+            # A never run job runs at once
+            self.next_run = now if self.next_run is None else now + datetime.timedelta(seconds=self.every)
+            return
+        for day in (now.date(), now.date() + datetime.timedelta(days=1)):
+            for time in self.at:
+                run = datetime.datetime.combine(day, time)
+                if run > now:
+                    self.next_run = run
+                    return
+
+    def load(self):
+        """
+            Loads the job configuration, unless it hasn't changed since the last time.
+
+            :return: A copy of the validated configuration, that the run can modify.
+            :rtype: dict
+
+            :raises _JobError: If the configuration can't be loaded.
+        """
+
+        try:
+            mtime = os.stat(self.configuration_file).st_mtime
+        except OSError as e:
+            raise _JobError("yaml parsing: {}".format(e), 2)
+
+        if mtime != self._mtime:
+            try:
+                with open(self.configuration_file, "r") as f:
+                    configuration = utils.load_yaml(f)
+            except Exception as e:
+                raise _JobError("yaml parsing: {}".format(e), 2)
+            try:
+                utils.validate_configuration(configuration)
+            except Exception as e:
+                raise _JobError("configuration validation: {}".format(e), 3)
+            utils.resolve_paths(configuration, os.path.dirname(self.configuration_file))
+
+            # The GPG object is created once, then reused by every run
+            if configuration["encrypt"]:
+                archive.get_gpg(configuration["gnupg"]["home"])
+
+            if self._configuration is not None:
+                _log("{} reloaded.".format(self.configuration_file))
+            self._configuration = configuration
+            self._mtime = mtime
+
+        return copy.deepcopy(self._configuration)
+
+    def storage(self, configuration):
+        """
+            Returns the storage the job uploads to, kept from one run to the next.
+
+            :param configuration: Validated configuration of the run.
+            :type configuration: dict
+            :return: The storage (None if the job doesn't upload).
+            :rtype: backupper.connect.AbstractStorageContext
+        """
+
+        storage_node = json.dumps(configuration["storage"], sort_keys=True)
+        if storage_node != self._storage_node:
+            self.close()
+            if configuration["storage"] is not None:
+                self._storage = upload.open_storage(configuration["storage"])
+            self._storage_node = storage_node
+        return self._storage
+
+    def close(self):
+        """
+            Disconnects the storage of the job.
+        """
+
+        if self._storage is not None:
+            try:
+                self._storage.disconnect()
+            except Exception:
+                pass
+        self._storage = None
+        self._storage_node = None
+
+class Daemon:
+    """
+        Runs the jobs of a daemon configuration file.
+    """
+
+    def __init__(self, configuration_file):
+        """
+            :param configuration_file: Daemon configuration file path.
+            :type configuration_file: str
+        """
+
+        self.configuration_file = os.path.abspath(configuration_file)
+        self.configuration = None
+        self._mtime = None
+
+        self.jobs = {}
+        """Jobs, by configuration file path"""
+
+        self._slots = threading.Condition()
+        self._running = {"cpu": 0, "io": 0}
+        """Numbers of running jobs of each kind (protected by self._slots)"""
+
+        self._threads = []
+        self._emptiers = []
+        """Background trash emptiers started by the runs, reaped by the main loop"""
+        self._emptiers_lock = threading.Lock()
+
+        self._wakeup = threading.Event()
+        """Set to wake the main loop up before the next run"""
+        self._stop = False
+        self._reload = False
+
+    def load(self):
+        """
+            Loads the daemon configuration, unless it hasn't changed since the last time (or a reload has been requested).
+
+            Jobs kept in the new configuration keep their schedule, loaded configuration and storage. On error, the previous configuration stays in use.
+
+            :return: False if the configuration couldn't be loaded.
+            :rtype: bool
+        """
+
+        try:
+            mtime = os.stat(self.configuration_file).st_mtime
+        except OSError as e:
+            _log("Error: yaml parsing: {}".format(e))
+            return False
+        if mtime == self._mtime and not self._reload:
+            return True
+        self._reload = False
+        self._mtime = mtime
+
+        try:
+            with open(self.configuration_file, "r") as f:
+                configuration = utils.load_yaml(f)
+        except Exception as e:
+            _log("Error: yaml parsing: {}".format(e))
+            return False
+        try:
+            utils.validate_daemon_configuration(configuration)
+        except Exception as e:
+            _log("Error: configuration validation: {}".format(e))
+            return False
+
+        base_dir = os.path.dirname(self.configuration_file)
+        jobs = {}
+        for job_node in configuration["jobs"]:
+            configuration_file = os.path.abspath(os.path.join(base_dir, job_node["config"]))
+            job = self.jobs.pop(configuration_file, None) or jobs.get(configuration_file) or Job(configuration_file)
+            job.update(job_node, base_dir)
+            # Job configurations are checked at once, rather than when they first run
+            try:
+                job.load()
+            except _JobError as e:
+                _log("Error: {}: {}".format(configuration_file, e))
+            jobs[configuration_file] = job
+        # Removed jobs still running close their storage once done
+        for job in self.jobs.values():
+            if not job.running:
+                job.close()
+
+        with self._slots:
+            self.configuration = configuration
+            self.jobs = jobs
+            self._slots.notify_all()
+        _log("{} loaded: {} jobs.".format(self.configuration_file, len(jobs)))
+        return True
+
+    def run(self):
+        """
+            Runs the jobs until SIGTERM or SIGINT.
+
+            :return: Exit code: 0, or 3 if the daemon configuration couldn't be loaded at start.
+            :rtype: int
+        """
+
+        def stop(signum, frame):
+            self._stop = True
+            self._wakeup.set()
+
+        def reload(signum, frame):
+            self._reload = True
+            self._wakeup.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, reload)
+
+        if not self.load():
+            return 3
+        _log("backupper {} daemon started (pid {}).".format(backupper.__version__, os.getpid()))
+
+        # Runs start the processes of their artifacts from their threads, so through a fork server (see backupper.cli._map_artifacts). It's started now, while the daemon has a single thread, with backupper.archive imported once for all the processes.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            from multiprocessing import forkserver
+            multiprocessing.get_context("forkserver").set_forkserver_preload(["backupper.archive"])
+            forkserver.ensure_running()
+
+        while not self._stop:
+            self.load()
+            self._reap()
+
+            now = datetime.datetime.now()
+            for job in list(self.jobs.values()):
+                if job.next_run is None:
+                    job.schedule(now)
+                if job.next_run is None or job.next_run > now:
+                    continue
+                if job.running:
+                    _log("{}: still running, skipping this run.".format(job.configuration_file))
+                else:
+                    job.running = True
+                    thread = threading.Thread(target=self._run_job, args=(job,), name=os.path.basename(job.configuration_file))
+                    self._threads.append(thread)
+                    thread.start()
+                job.schedule(now)
+
+            # Sleeps until the next run, and at least every poll_interval to notice changed configurations
+            timeout = self.configuration["poll_interval"]
+            next_runs = [job.next_run for job in self.jobs.values() if job.next_run is not None]
+            if len(next_runs) > 0:
+                timeout = max(0, min(timeout, (min(next_runs) - datetime.datetime.now()).total_seconds()))
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+        _log("Stopping: waiting for {} running jobs.".format(len([thread for thread in self._threads if thread.is_alive()])))
+        for thread in self._threads:
+            thread.join()
+        for job in self.jobs.values():
+            job.close()
+        self._reap()
+        _log("Stopped.")
+        return 0
+
+    def _acquire(self, kind):
+        """
+            Waits for a free slot of a kind, and takes it.
+
+            :param kind: "cpu" or "io".
+            :type kind: str
+        """
+
+        with self._slots:
+            self._slots.wait_for(lambda: sum(self._running.values()) < self.configuration["max_jobs"] and self._running[kind] < self.configuration["{}_slots".format(kind)])
+            self._running[kind] += 1
+
+    def _release(self, kind):
+        """
+            Frees a slot of a kind.
+
+            :param kind: "cpu" or "io".
+            :type kind: str
+        """
+
+        with self._slots:
+            self._running[kind] -= 1
+            self._slots.notify_all()
+
+    def _run_job(self, job):
+        """
+            Runs a backup job (in its own thread).
+
+            :param job: The job.
+            :type job: Job
+        """
+
+        run_metrics = report.Metrics()
+        run_report = {
+            "version": backupper.__version__,
+            "configuration_file": job.configuration_file,
+            "start": datetime.datetime.utcnow().isoformat(),
+            "exit_code": None,
+            "dry_run": False,
+            "artifacts": [],
+        }
+        start = time.perf_counter()
+
+        try:
+            try:
+                configuration = job.load()
+            except _JobError as e:
+                sys.stderr.write("Error: {}\n".format(e))
+                run_report["exit_code"] = e.exit_code
+                return
+
+            kind = job.slot or _guess_slot(configuration)
+            self._acquire(kind)
+            try:
+                _log("{}: starting ({} job).".format(job.configuration_file, kind))
+                # The run keeps the storage connected for the next one
+                try:
+                    storage = job.storage(configuration)
+                except Exception as e:
+                    sys.stderr.write("Error: storage: {}\n".format(e))
+                    run_report["exit_code"] = 8
+                    return
+                backup_datetime = datetime.datetime.utcnow().strftime(cli._DATETIME_FORMAT)
+                # run_backup exits on errors, which only ends this run
+                try:
+                    emptier = cli.run_backup(configuration, backup_datetime, False, run_metrics, run_report, storage)
+                    run_report["exit_code"] = 0
+                except SystemExit as e:
+                    run_report["exit_code"] = e.code
+                    emptier = None
+                except Exception as e:
+                    sys.stderr.write("Error: {}: {}\n".format(job.configuration_file, e))
+                    run_report["exit_code"] = 1
+                    emptier = None
+                if emptier is not None:
+                    with self._emptiers_lock:
+                        self._emptiers.append(emptier)
+            finally:
+                self._release(kind)
+        finally:
+            run_metrics.exit_all()
+            run_report["wall_time"] = time.perf_counter() - start
+            _log("{}: done (exit code {}, {:.1f}s).".format(job.configuration_file, run_report["exit_code"], run_report["wall_time"]))
+            if job.report_file is not None:
+                run_report.update(run_metrics.as_dict())
+                run_report["totals"] = report.total(run_report["artifacts"])
+                try:
+                    report.write_report(job.report_file, run_report)
+                except OSError as e:
+                    sys.stderr.write("Error: report: {}\n".format(e))
+            job.running = False
+            # A job removed from the configuration while running is done with its storage
+            if self.jobs.get(job.configuration_file) is not job:
+                job.close()
+
+    def _reap(self):
+        """
+            Waits for the trash emptiers that are done, so that they don't stay zombies.
+        """
+
+        with self._emptiers_lock:
+            self._emptiers = [emptier for emptier in self._emptiers if emptier.poll() is None]
+
+def main(configuration_file):
+    """
+        Daemon entrypoint (backupper daemon <daemon config>).
+
+        :param configuration_file: Daemon configuration file path.
+        :type configuration_file: str
+    """
+
+    sys.exit(Daemon(configuration_file).run())
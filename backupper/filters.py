@@ -0,0 +1,236 @@
+"""
+    Include and exclude rules of the artifacts.
+
+    Rules are glob patterns, or regular expressions prefixed with "re:", matched against the path of a file relative to its artifact (e.g. "me/.cache" for /home/me/.cache in the /home artifact). A glob without a slash matches the name of a file at any depth ("node_modules", "*.tmp"), a glob with one matches the whole path from the artifact ("me/.git/objects", or "**/.git/objects" at any depth). The exclude rules of an artifact are compiled once into a single regular expression, as are its include rules, so that each file is matched once whatever the number of rules.
+
+    Excluded directories are pruned: their contents aren't even listed.
+"""
+
+import re
+import time
+from stat import S_ISDIR, S_ISREG
+
+__all__ = ["Matcher", "compile_rules", "parse_size", "parse_duration"]
+
+_REGEX_PREFIX = "re:"
+"""Prefix of the rules which are regular expressions rather than globs"""
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+"""Multipliers of the size suffixes"""
+
+_DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+"""Multipliers of the duration suffixes"""
+
+_GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+"""Inline flags at the start of a regular expression, which apply to the whole expression"""
+
+def _scope_flags(regex):
+    """
+        Turns the leading inline flags of a regular expression into a group scoped to it ("(?i)a" becomes "(?i:a)"), so that it can be joined with other expressions.
+
+        :param regex: The regular expression.
+        :type regex: str
+        :return: The expression, without global flags.
+        :rtype: str
+    """
+
+    flags = ""
+    match = _GLOBAL_FLAGS.match(regex)
+    while match is not None:
+        flags += match.group(1)
+        regex = regex[match.end():]
+        match = _GLOBAL_FLAGS.match(regex)
+    if flags == "":
+        return regex
+    # The group ends on a line of its own, in case the verbose flag makes a trailing comment of the last line
+    return "(?{}:{}{})".format(flags, regex, "\n" if "x" in flags else "")
+
+def _glob_to_regex(pattern):
+    """
+        Translates a glob into a regular expression matching a whole relative path.
+
+        * and ? don't match slashes, ** does, and [...] classes are kept ([!...] being negated).
+
+        :param pattern: The glob.
+        :type pattern: str
+        :return: The regular expression.
+        :rtype: str
+    """
+
+    # Names match at any depth, paths from the artifact
+    if "/" in pattern.rstrip("/"):
+        prefix = ""
+        pattern = pattern.lstrip("/")
+    else:
+        prefix = "(?:.*/)?"
+    pattern = pattern.rstrip("/")
+
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        elif c == "*":
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            content = pattern[i + 1:end]
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            regex.append("[{}]".format(content.replace("\\", "\\\\")))
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return "^{}{}$".format(prefix, "".join(regex))
+
+def compile_rules(rules):
+    """
+        Compiles rules into a single regular expression.
+
+        :param rules: Globs, and regular expressions prefixed with "re:".
+        :type rules: list
+        :return: The compiled expression, to be searched in relative paths (None if there are no rules).
+        :rtype: re.Pattern
+
+        :raises re.error: If a regular expression is invalid.
+    """
+
+    if len(rules) == 0:
+        return None
+    regexes = []
+    for rule in rules:
+        if rule.startswith(_REGEX_PREFIX):
+            # Compiled alone first, so that an error tells which rule is wrong
+            regex = rule[len(_REGEX_PREFIX):]
+            re.compile(regex)
+            regex = _scope_flags(regex)
+        else:
+            regex = _glob_to_regex(rule)
+        regexes.append("(?:{})".format(regex))
+    return re.compile("|".join(regexes))
+
+def _parse_quantity(value, units, name):
+    """
+        Parses an integer, or a string of an integer followed by a unit suffix.
+
+        :param value: The value.
+        :type value: int
+        :param units: Multiplier of each suffix.
+        :type units: dict
+        :param name: Name of the quantity, for errors.
+        :type name: str
+        :return: The value, in base units.
+        :rtype: int
+
+        :raises ValueError: If the value can't be parsed.
+    """
+
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+    match = re.match(r'^\s*([0-9]+)\s*([A-Za-z]?)\s*$', value) if isinstance(value, str) else None
+    if match is None or not match.group(2) in units:
+        raise ValueError("{!r} isn't {}: use a positive integer, optionally followed by one of {}.".format(value, name, ", ".join(unit for unit in units if unit != "")))
+    return int(match.group(1)) * units[match.group(2)]
+
+def parse_size(value):
+    """
+        Parses a size: bytes, or a number followed by K, M, G or T (powers of 1024).
+
+        :param value: The size.
+        :type value: int
+        :return: The size in bytes.
+        :rtype: int
+
+        :raises ValueError: If the size can't be parsed.
+    """
+
+    return _parse_quantity(value.upper() if isinstance(value, str) else value, _SIZE_UNITS, "a size")
+
+def parse_duration(value):
+    """
+        Parses a duration: seconds, or a number followed by s, m, h, d or w.
+
+        :param value: The duration.
+        :type value: int
+        :return: The duration in seconds.
+        :rtype: int
+
+        :raises ValueError: If the duration can't be parsed.
+    """
+
+    return _parse_quantity(value, _DURATION_UNITS, "a duration")
+
+class Matcher:
+    """
+        Compiled filters of an artifact.
+    """
+
+    def __init__(self, filters, now=None):
+        """
+            :param filters: Validated "filters" node of the artifact (exclude, include, max_file_size and newer_than).
+            :type filters: dict
+            :param now: Time newer_than is relative to (default: now).
+            :type now: float
+        """
+
+        self._exclude = compile_rules(filters["exclude"])
+        self._include = compile_rules(filters["include"])
+        self._max_file_size = filters["max_file_size"]
+        self._oldest = None
+        """Files modified before this time are skipped"""
+        if filters["newer_than"] is not None:
+            self._oldest = (time.time() if now is None else now) - filters["newer_than"]
+
+    @classmethod
+    def create(cls, filters):
+        """
+            Returns the matcher of a "filters" node, or None if it doesn't filter anything.
+
+            :param filters: Validated "filters" node.
+            :type filters: dict
+            :return: The matcher.
+            :rtype: Matcher
+        """
+
+        if len(filters["exclude"]) == 0 and len(filters["include"]) == 0 and filters["max_file_size"] is None and filters["newer_than"] is None:
+            return None
+        return cls(filters)
+
+    def check(self, path, stat, parent_included):
+        """
+            Tells if a file is kept.
+
+            Directories are kept unless they're excluded, even if they aren't included, as they may contain included files. The contents of an included directory are included.
+
+            :param path: Path of the file relative to the artifact, with slashes.
+            :type path: str
+            :param stat: lstat of the file.
+            :type stat: os.stat_result
+            :param parent_included: True if the directory of the file is included.
+            :type parent_included: bool
+            :return: None if the file is skipped, otherwise whether it's included.
+            :rtype: bool
+        """
+
+        if self._exclude is not None and self._exclude.search(path) is not None:
+            return None
+        included = parent_included or self._include is None or self._include.search(path) is not None
+        if S_ISDIR(stat.st_mode):
+            return included
+        if not included:
+            return None
+        if self._max_file_size is not None and S_ISREG(stat.st_mode) and stat.st_size > self._max_file_size:
+            return None
+        if self._oldest is not None and stat.st_mtime < self._oldest:
+            return None
+        return True
@@ -0,0 +1,222 @@
+"""
+    File manifests used by incremental backups.
+
+    A manifest is a SQLite database stored alongside an artifact archive. It lists the files of the artifact (path, size, mtime, inode, mode) when it was backupped, so that the next backup can only archive what changed. Lookups are done by SQLite on indexed tables, so that huge artifacts never have to fit in memory.
+"""
+
+import os
+import sqlite3
+
+__all__ = ["MANIFEST_EXTENSION", "Manifest", "manifest_path", "parent_backups", "continues_chain"]
+
+MANIFEST_EXTENSION = "manifest"
+"""Extension of manifest files"""
+
+_BATCH_SIZE = 10000
+"""Number of files inserted at once"""
+
+def manifest_path(output_base):
+    """
+        Returns the manifest path of an artifact archive.
+
+        :param output_base: Archive path without its extension (<backup dir>/<artifact>.<datetime>).
+        :type output_base: str
+        :return: The manifest path.
+        :rtype: str
+    """
+
+    return "{}.{}".format(output_base, MANIFEST_EXTENSION)
+
+class Manifest:
+    """
+        An artifact manifest.
+
+        Use Manifest.create to write a new one, and Manifest.open to read an existing one.
+    """
+
+    def __init__(self, path, connection):
+        self.path = path
+        """Manifest file path"""
+
+        self._connection = connection
+
+    @classmethod
+    def create(cls, path, parent=None, chain_length=0):
+        """
+            Creates a new manifest.
+
+            :param path: Manifest file path (it must not exist).
+            :type path: str
+            :param parent: Name of the backup directory this incremental backup is based on (None for a full backup).
+            :type parent: str
+            :param chain_length: Number of incremental backups since the last full one.
+            :type chain_length: int
+            :return: The new manifest.
+            :rtype: backupper.manifest.Manifest
+        """
+
+        if os.path.exists(path):
+            raise FileExistsError("create: {} already exists.".format(path))
+
+        # The archive may be written by another thread than the one which built the manifest
+        connection = sqlite3.connect(path, check_same_thread=False)
+        # The manifest is written once: if we crash, the backup is incomplete anyway
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, mode INTEGER) WITHOUT ROWID")
+        connection.execute("CREATE TABLE changed (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        connection.execute("CREATE TABLE deleted (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", [("parent", parent), ("chain_length", str(chain_length))])
+        return cls(path, connection)
+
+    @classmethod
+    def open(cls, path):
+        """
+            Opens an existing manifest (read only).
+
+            :param path: Manifest file path.
+            :type path: str
+            :return: The manifest.
+            :rtype: backupper.manifest.Manifest
+
+            :raises FileNotFoundError: If the manifest doesn't exist.
+        """
+
+        if not os.path.isfile(path):
+            raise FileNotFoundError("open: {} doesn't exist.".format(path))
+
+        return cls(path, sqlite3.connect("file:{}?mode=ro".format(path), uri=True))
+
+    @property
+    def parent(self):
+        """Name of the backup directory this backup is based on, None if it's a full backup"""
+        return self._meta("parent")
+
+    @property
+    def chain_length(self):
+        """Number of incremental backups since the last full one"""
+        return int(self._meta("chain_length"))
+
+    def _meta(self, key):
+        row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def add_files(self, files):
+        """
+            Records files in the manifest.
+
+            :param files: (path, os.stat_result) tuples.
+            :type files: iterable
+        """
+
+        batch = []
+        for path, stat in files:
+            batch.append((path, stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_mode))
+            if len(batch) >= _BATCH_SIZE:
+                self._connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", batch)
+                batch = []
+        self._connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", batch)
+
+    def diff(self, previous):
+        """
+            Compares this manifest with a previous one, and records the new or changed files and the deleted ones.
+
+            :param previous: Manifest of the previous backup (if None, all files are considered new).
+            :type previous: backupper.manifest.Manifest
+            :return: The number of changed paths and the number of deleted paths.
+            :rtype: tuple
+        """
+
+        if previous is None:
+            self._connection.execute("INSERT INTO changed SELECT path FROM files")
+            self._connection.commit()
+            return self._connection.execute("SELECT COUNT(*) FROM changed").fetchone()[0], 0
+
+        self._connection.commit()
+        self._connection.execute("ATTACH DATABASE ? AS previous", (previous.path,))
+        try:
+            self._connection.execute("""
+                INSERT INTO changed SELECT f.path FROM main.files AS f LEFT JOIN previous.files AS p ON f.path = p.path
+                WHERE p.path IS NULL OR f.size != p.size OR f.mtime != p.mtime OR f.inode != p.inode OR f.mode != p.mode
+            """)
+            self._connection.execute("INSERT INTO deleted SELECT path FROM previous.files WHERE path NOT IN (SELECT path FROM main.files)")
+            self._connection.commit()
+        finally:
+            self._connection.execute("DETACH DATABASE previous")
+
+        changed_count = self._connection.execute("SELECT COUNT(*) FROM changed").fetchone()[0]
+        deleted_count = self._connection.execute("SELECT COUNT(*) FROM deleted").fetchone()[0]
+        return changed_count, deleted_count
+
+    def changed(self):
+        """
+            Iterates over the paths new or changed since the parent backup.
+
+            :return: Paths, sorted.
+            :rtype: iterator
+        """
+
+        return (row[0] for row in self._connection.execute("SELECT path FROM changed ORDER BY path"))
+
+    def deleted(self):
+        """
+            Iterates over the paths deleted since the parent backup.
+
+            :return: Paths, sorted.
+            :rtype: iterator
+        """
+
+        return (row[0] for row in self._connection.execute("SELECT path FROM deleted ORDER BY path"))
+
+    def close(self):
+        if self._connection is None:
+            return
+        self._connection.commit()
+        self._connection.close()
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def parent_backups(backup_dir):
+    """
+        Lists the backups the incremental artifacts of a backup directory are based on.
+
+        :param backup_dir: Backup directory (backup_<datetime>).
+        :type backup_dir: str
+        :return: Names of the parent backup directories.
+        :rtype: set
+    """
+
+    parents = set()
+    for root, _, files in os.walk(backup_dir):
+        for f in files:
+            if f.endswith(".{}".format(MANIFEST_EXTENSION)):
+                with Manifest.open(os.path.join(root, f)) as manifest:
+                    if manifest.parent is not None:
+                        parents.add(manifest.parent)
+    return parents
+
+def continues_chain(backup_dir, full_every):
+    """
+        Tells if the next backup would be based on a backup directory, i.e. if one of its incremental artifacts isn't due for a full backup.
+
+        :param backup_dir: Backup directory (backup_<datetime>).
+        :type backup_dir: str
+        :param full_every: A full backup is done every full_every backups.
+        :type full_every: int
+        :return: True if the next backup would be incremental.
+        :rtype: bool
+    """
+
+    for root, _, files in os.walk(backup_dir):
+        for f in files:
+            if f.endswith(".{}".format(MANIFEST_EXTENSION)):
+                with Manifest.open(os.path.join(root, f)) as manifest:
+                    if manifest.chain_length + 1 < full_every:
+                        return True
+    return False
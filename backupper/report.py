@@ -0,0 +1,204 @@
+"""
+    Run instrumentation: stage timings, byte and file counters, and the JSON run report.
+"""
+
+import json
+import time
+import collections
+import contextlib
+
+__all__ = ["Metrics", "MeteredReader", "MeteredWriter", "metered_iter", "total", "write_report"]
+
+class Metrics:
+    """
+        Time spent in each stage of a pipeline, and counters.
+
+        Stages nest: the time of a stage excludes the time of the stages entered from it (e.g. "tar" excludes "compress", which excludes "write"), so that stage times add up to the measured wall time. A Metrics object must only be used by one thread at a time.
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        """Seconds spent in each stage, in the order they were first entered"""
+
+        self.counters = collections.Counter()
+        """Counters (files, bytes_in, bytes_out...)"""
+
+        self._stack = []
+        self._last = None
+
+    def enter(self, stage):
+        """
+            Enters a stage, pausing the current one.
+
+            enter and exit are cheaper than the stage context manager, for code that runs on each block of data.
+
+            :param stage: Stage name.
+            :type stage: str
+        """
+
+        now = time.perf_counter()
+        if self._stack:
+            self.add_time(self._stack[-1], now - self._last)
+        self._stack.append(stage)
+        self._last = now
+
+    def exit(self):
+        """
+            Exits the current stage, resuming the previous one.
+        """
+
+        now = time.perf_counter()
+        self.add_time(self._stack.pop(), now - self._last)
+        self._last = now
+
+    def exit_all(self):
+        """
+            Exits all the stages still entered (e.g. when a run is interrupted by an exception or sys.exit).
+        """
+
+        while self._stack:
+            self.exit()
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+            Context manager timing a stage.
+
+            :param stage: Stage name.
+            :type stage: str
+        """
+
+        self.enter(stage)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def add_time(self, stage, seconds):
+        """
+            Adds time measured elsewhere (e.g. by another thread) to a stage.
+
+            :param stage: Stage name.
+            :type stage: str
+            :param seconds: Time to add.
+            :type seconds: float
+        """
+
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def as_dict(self):
+        """
+            Returns the metrics as a JSON serializable dict.
+
+            :return: The stages times (seconds) and the counters.
+            :rtype: dict
+        """
+
+        return {"stages": dict(self.stages), "counters": dict(self.counters)}
+
+class MeteredWriter:
+    """
+        Writable file object wrapper, timing its writes as a stage and counting the written bytes.
+
+        Other attributes are the ones of the wrapped file object.
+    """
+
+    def __init__(self, fileobj, metrics, stage, counter):
+        self._fileobj = fileobj
+        self._metrics = metrics
+        self._stage = stage
+        self._counter = counter
+
+    def write(self, data):
+        self._metrics.enter(self._stage)
+        try:
+            written = self._fileobj.write(data)
+        finally:
+            self._metrics.exit()
+        self._metrics.counters[self._counter] += len(data)
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+class MeteredReader:
+    """
+        Readable file object wrapper, timing its reads as a stage and counting the read bytes.
+
+        Other attributes are the ones of the wrapped file object.
+    """
+
+    def __init__(self, fileobj, metrics, stage, counter):
+        self._fileobj = fileobj
+        self._metrics = metrics
+        self._stage = stage
+        self._counter = counter
+
+    def read(self, size=-1):
+        self._metrics.enter(self._stage)
+        try:
+            data = self._fileobj.read(size)
+        finally:
+            self._metrics.exit()
+        self._metrics.counters[self._counter] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+def metered_iter(iterable, metrics, stage):
+    """
+        Iterates over an iterable, timing the production of each item as a stage.
+
+        :param iterable: Iterable to time (e.g. a directory walk).
+        :type iterable: iterable
+        :param metrics: Metrics the time is added to.
+        :type metrics: backupper.report.Metrics
+        :param stage: Stage name.
+        :type stage: str
+        :return: The items of iterable.
+        :rtype: iterator
+    """
+
+    iterator = iter(iterable)
+    while True:
+        metrics.enter(stage)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            metrics.exit()
+        yield item
+
+def total(artifacts_stats):
+    """
+        Sums the stages times and counters of several artifacts.
+
+        :param artifacts_stats: Artifacts statistics, as returned by backupper.archive.backup_artifact.
+        :type artifacts_stats: list
+        :return: The summed stages times (seconds) and counters.
+        :rtype: dict
+    """
+
+    stages = collections.OrderedDict()
+    counters = collections.Counter()
+    for stats in artifacts_stats:
+        for stage, seconds in stats["stages"].items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        counters.update(stats["counters"])
+    return {"stages": dict(stages), "counters": dict(counters)}
+
+def write_report(path, run_report):
+    """
+        Writes a run report as JSON.
+
+        :param path: Report file path.
+        :type path: str
+        :param run_report: The report.
+        :type run_report: dict
+    """
+
+    with open(path, "w") as f:
+        json.dump(run_report, f, indent=4, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,548 @@
+"""
+    Restoring routines used by backupper.cli.main.
+"""
+
+import os
+import time
+import shutil
+import tarfile
+import threading
+import contextlib
+from stat import S_ISDIR, S_ISLNK
+
+from . import archive
+from . import compression
+from . import manifest
+from . import chunkstore
+from . import report
+from . import seekindex
+
+__all__ = ["extract", "list_artifacts", "restore_artifact"]
+
+# Members are extracted as tar would, but never outside of the target directory
+_EXTRACT_OPTIONS = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+"""Options of tarfile.TarFile.extract"""
+
+def extract(archive_path, member, target, metrics, gnupg_home=None):
+    """
+        Extracts a member of an archive, or a directory and all its members.
+
+        If the archive has a seek index, decompression starts at the last restart point before each member, so the time it takes doesn't depend on the archive size. Otherwise, the whole archive is read (and decrypted if needed).
+
+        :param archive_path: Archive path.
+        :type archive_path: str
+        :param member: Name of the member in the archive (<artifact>/<path in the artifact>).
+        :type member: str
+        :param target: Directory the member is extracted to.
+        :type target: str
+        :param metrics: Metrics of the extraction (counts the extracted files and bytes, and the bytes decompressed to reach them).
+        :type metrics: backupper.report.Metrics
+        :param gnupg_home: GnuPG home used to decrypt the archive (None for the gpg default).
+        :type gnupg_home: str
+        :return: The number of extracted members, and True if the seek index was used.
+        :rtype: tuple
+
+        :raises KeyError: If the member isn't in the archive.
+    """
+
+    member = os.path.normpath(member)
+    try:
+        index = seekindex.SeekIndex(seekindex.index_path(archive_path))
+    except FileNotFoundError:
+        index = None
+
+    if index is None:
+        with _open_tar_stream(archive_path, metrics, gnupg_home) as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                tarinfos = (tarinfo for tarinfo in tar if _is_selected(tarinfo.name, member))
+                extracted_count = _extract_members(tar, tarinfos, target, metrics)
+        if extracted_count == 0:
+            raise KeyError("{} isn't in {}.".format(member, archive_path))
+        return extracted_count, False
+
+    with index:
+        selected = index.members(member)
+        if len(selected) == 0:
+            raise KeyError("{} isn't in {}.".format(member, archive_path))
+
+        with open(archive_path, "rb") as f:
+            reader = seekindex.IndexedReader(f, index.codec, index.restart_points())
+            try:
+                # Opening the archive reads the member at the current offset, the next ones are read directly
+                with metrics.stage("seek"):
+                    reader.seek(selected[0][1])
+                    tar = tarfile.TarFile(fileobj=reader)
+
+                def tarinfos():
+                    for i, (_, offset, _) in enumerate(selected):
+                        with metrics.stage("seek"):
+                            if i == 0:
+                                tarinfo = tar.next()
+                            else:
+                                reader.seek(offset)
+                                tarinfo = tarfile.TarInfo.fromtarfile(tar)
+                            if tarinfo.islnk():
+                                tarinfo = _resolve_hardlink(tar, tarinfo, index, reader, target)
+                        yield tarinfo
+
+                with tar:
+                    extracted_count = _extract_members(tar, tarinfos(), target, metrics)
+            finally:
+                metrics.counters["bytes_skipped"] += reader.skipped_bytes
+    return extracted_count, True
+
+def list_artifacts(backup, backup_datetime):
+    """
+        Lists the artifacts of a backup directory.
+
+        Archives and recipes are recognized by their name (<artifact>.<datetime>.<extension>). A directory without any of them is a snapshot.
+
+        :param backup: Backup directory (backup_<datetime>).
+        :type backup: str
+        :param backup_datetime: Formatted datetime of the backup.
+        :type backup_datetime: str
+        :return: Artifact nodes: their "name" (path in the backup directory structure, without datetime nor extension), "mode" ("archive", "dedup" or "snapshot") and "output" path, sorted by name.
+        :rtype: list
+    """
+
+    artifacts = []
+    _scan_backup(backup, "", backup_datetime, artifacts)
+    return sorted(artifacts, key=lambda artifact: artifact["name"])
+
+def _scan_backup(directory, relative_directory, backup_datetime, artifacts):
+    """
+        Adds the artifacts of a directory of a backup to a list.
+
+        :param directory: Directory to scan.
+        :type directory: str
+        :param relative_directory: Path of the directory in the backup.
+        :type relative_directory: str
+        :param backup_datetime: Formatted datetime of the backup.
+        :type backup_datetime: str
+        :param artifacts: List the artifacts are added to.
+        :type artifacts: list
+        :return: True if an archive or a recipe has been found in the directory.
+        :rtype: bool
+    """
+
+    found = False
+    snapshots = []
+    with os.scandir(directory) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        name = os.path.join(relative_directory, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            if _scan_backup(entry.path, name, backup_datetime, artifacts):
+                found = True
+            else:
+                snapshots.append({"name": name, "mode": "snapshot", "output": entry.path})
+        elif entry.is_file(follow_symlinks=False):
+            split_output = _split_output(entry.name, backup_datetime)
+            if split_output is not None:
+                found = True
+                artifacts.append({"name": os.path.join(relative_directory, split_output[0]), "mode": "dedup" if split_output[1] is None else "archive", "output": entry.path})
+
+    # Directories holding archives are just the backup directory structure
+    if found or relative_directory == "":
+        artifacts.extend(snapshots)
+    return found
+
+def _split_output(file_name, backup_datetime):
+    """
+        Parses the name of an archive or a recipe.
+
+        :param file_name: File name.
+        :type file_name: str
+        :param backup_datetime: Formatted datetime of the backup.
+        :type backup_datetime: str
+        :return: The artifact name, the codec (None for a recipe) and True if the archive is encrypted, or None if the file isn't an archive nor a recipe.
+        :rtype: tuple
+    """
+
+    suffixes = [(".{}.{}".format(backup_datetime, chunkstore.RECIPE_EXTENSION), None, False)]
+    for codec in compression.CODECS:
+        suffix = ".{}.{}".format(backup_datetime, compression.CODECS[codec]["extension"])
+        suffixes.extend([(suffix, codec, False), ("{}.gpg".format(suffix), codec, True)])
+    for suffix, codec, encrypted in suffixes:
+        if file_name.endswith(suffix) and len(file_name) > len(suffix):
+            return file_name[:-len(suffix)], codec, encrypted
+    return None
+
+def _archive_format(path):
+    """
+        Guesses the format of an archive from its extension.
+
+        :param path: Archive path.
+        :type path: str
+        :return: The codec, and True if the archive is encrypted.
+        :rtype: tuple
+
+        :raises ValueError: If the extension isn't the one of an archive.
+    """
+
+    encrypted = path.endswith(".gpg")
+    if encrypted:
+        path = path[:-len(".gpg")]
+    # Longest extensions first, as "tar" ends the other ones
+    for codec in sorted(compression.CODECS, key=lambda codec: -len(compression.CODECS[codec]["extension"])):
+        if path.endswith(".{}".format(compression.CODECS[codec]["extension"])):
+            return codec, encrypted
+    raise ValueError("{} isn't an archive.".format(path))
+
+def restore_artifact(artifact, backup, target, gnupg_home=None):
+    """
+        Restores a single artifact.
+
+        Incremental archives are restored along with the archives they're based on, from the full one: each archive is extracted over the previous ones, then the files deleted since its parent backup are removed.
+
+        Like backupper.archive.backup_artifact, this function doesn't write anything on the standard outputs nor exits, so that artifacts can be restored in a process pool.
+
+        :param artifact: Artifact node, as returned by list_artifacts.
+        :type artifact: dict
+        :param backup: Backup directory (backup_<datetime>).
+        :type backup: str
+        :param target: Directory the backup is restored to (the artifact is restored to <target>/<artifact name>).
+        :type target: str
+        :param gnupg_home: GnuPG home used to decrypt the archives (None for the gpg default).
+        :type gnupg_home: str
+        :return: A list of (stream name, message) tuples ("stdout" or "stderr"), an exit code (0 if the main loop can go on) and the artifact statistics (stages times, counters, restored archives and wall time).
+        :rtype: tuple
+    """
+
+    metrics = report.Metrics()
+    messages = []
+    exit_code = 0
+    start = time.perf_counter()
+    # Archives contain the artifact directory itself, so they're extracted in its parent directory
+    destination = os.path.join(target, os.path.dirname(artifact["name"]))
+    outputs = [artifact["output"]]
+
+    try:
+        os.makedirs(destination, exist_ok=True)
+        if artifact["mode"] == "snapshot":
+            _copy_snapshot(artifact["output"], os.path.join(target, artifact["name"]), metrics)
+        else:
+            chain = _incremental_chain(artifact["output"], backup)
+            outputs = [output for output, _ in chain]
+            store = chunkstore.ChunkStore(os.path.dirname(backup))
+            for output, manifest_path in chain:
+                with _open_tar_stream(output, metrics, gnupg_home, store) as stream:
+                    with tarfile.open(fileobj=stream, mode="r|") as tar:
+                        _extract_members(tar, tar, destination, metrics)
+                if manifest_path is not None:
+                    with metrics.stage("delete"):
+                        _remove_deleted(manifest_path, destination, metrics)
+    except Exception as e:
+        messages.append(("stderr", "Error: restore: {}: {}\n".format(artifact["name"], e)))
+        exit_code = 7
+    metrics.exit_all()
+
+    wall_time = time.perf_counter() - start
+    if exit_code == 0:
+        restored_size = metrics.counters["bytes_out"]
+        messages.append(("stdout", "{} restored from {} ({} files, {:.1f} MiB in {:.2f}s, {:.1f} MiB/s).\n".format(os.path.join(target, artifact["name"]), ", ".join(os.path.basename(output) for output in outputs), metrics.counters["files"], restored_size / 1024 / 1024, wall_time, restored_size / 1024 / 1024 / wall_time if wall_time > 0 else 0.0)))
+
+    stats = metrics.as_dict()
+    stats.update({
+        "artifact": artifact["name"],
+        "mode": artifact["mode"],
+        "outputs": [os.path.abspath(output) for output in outputs],
+        "exit_code": exit_code,
+        "wall_time": wall_time,
+    })
+    return messages, exit_code, stats
+
+def _incremental_chain(output, backup):
+    """
+        Lists the archives an incremental archive is based on.
+
+        :param output: Archive or recipe path.
+        :type output: str
+        :param backup: Backup directory of the archive (backup_<datetime>).
+        :type backup: str
+        :return: (archive path, manifest path) tuples, from the full archive to the given one (the manifest path is None if the artifact wasn't backupped incrementally).
+        :rtype: list
+
+        :raises FileNotFoundError: If an archive of the chain is missing.
+    """
+
+    backup_dir = os.path.dirname(backup)
+    backup_datetime = _backup_datetime(backup)
+    relative_output = os.path.relpath(output, backup)
+    name, _, _ = _split_output(os.path.basename(relative_output), backup_datetime)
+    name = os.path.join(os.path.dirname(relative_output), name)
+
+    chain = []
+    while True:
+        manifest_path = manifest.manifest_path("{}.{}".format(os.path.join(backup, name), backup_datetime))
+        if not os.path.isfile(manifest_path):
+            chain.insert(0, (output, None))
+            return chain
+        chain.insert(0, (output, manifest_path))
+        with manifest.Manifest.open(manifest_path) as artifact_manifest:
+            parent = artifact_manifest.parent
+        if parent is None:
+            return chain
+
+        # The parent backup may have used another codec
+        backup = os.path.join(backup_dir, parent)
+        backup_datetime = _backup_datetime(backup)
+        parent_directory = os.path.join(backup, os.path.dirname(name))
+        candidates = []
+        if os.path.isdir(parent_directory):
+            candidates = [f for f in os.listdir(parent_directory) if (_split_output(f, backup_datetime) or [None])[0] == os.path.basename(name)]
+        if len(candidates) == 0:
+            raise FileNotFoundError("{} is based on {}, which doesn't have this artifact.".format(output, backup))
+        output = os.path.join(parent_directory, candidates[0])
+
+def _backup_datetime(backup):
+    """
+        Returns the formatted datetime of a backup directory.
+
+        :param backup: Backup directory (backup_<datetime>).
+        :type backup: str
+        :return: The datetime.
+        :rtype: str
+    """
+
+    return os.path.basename(backup)[len("backup_"):]
+
+@contextlib.contextmanager
+def _open_tar_stream(path, metrics, gnupg_home=None, store=None):
+    """
+        Opens the tar stream of an archive or a recipe, decrypting and decompressing it on the fly.
+
+        An encrypted archive is decrypted by gpg into a pipe, which is read as it's written: no plaintext archive is ever written on disk.
+
+        :param path: Archive or recipe path.
+        :type path: str
+        :param metrics: Metrics the reads are timed in.
+        :type metrics: backupper.report.Metrics
+        :param gnupg_home: GnuPG home used to decrypt the archive (None for the gpg default).
+        :type gnupg_home: str
+        :param store: Chunk store of the recipe (recipes can't be read without it).
+        :type store: backupper.chunkstore.ChunkStore
+        :return: A readable file object, over the uncompressed tar stream.
+        :rtype: file object
+    """
+
+    if path.endswith(".{}".format(chunkstore.RECIPE_EXTENSION)):
+        if store is None:
+            raise ValueError("{} is a recipe, restore its backup instead.".format(path))
+        yield report.MeteredReader(chunkstore.RecipeReader(store, path), metrics, "dedup", "bytes_in")
+        return
+
+    codec, encrypted = _archive_format(path)
+    if not encrypted:
+        with open(path, "rb") as f:
+            yield report.MeteredReader(compression.open_decompressor(report.MeteredReader(f, metrics, "read", "bytes_in"), codec), metrics, "decompress", "bytes_tar")
+        return
+
+    with _decrypt(path, gnupg_home) as pipe:
+        yield report.MeteredReader(compression.open_decompressor(report.MeteredReader(pipe, metrics, "decrypt", "bytes_in"), codec), metrics, "decompress", "bytes_tar")
+
+@contextlib.contextmanager
+def _decrypt(path, gnupg_home):
+    """
+        Decrypts a file into a pipe.
+
+        gpg output is handed to a writer thread chunk by chunk (see gnupg.GPG.on_data), instead of being buffered in memory by python-gnupg.
+
+        :param path: Encrypted file path.
+        :type path: str
+        :param gnupg_home: GnuPG home (None for the gpg default).
+        :type gnupg_home: str
+        :return: The read end of the pipe.
+        :rtype: file object
+
+        :raises Exception: If gnupg failed.
+    """
+
+    gpg = archive.get_gpg(gnupg_home)
+    read_fd, write_fd = os.pipe()
+    decrypt_status = []
+    decrypt_errors = []
+
+    def decrypt():
+        broken = []
+        pipe = os.fdopen(write_fd, "wb")
+        def on_data(data):
+            # Once the reader is gone, the rest of the output is drained, so that gpg can exit
+            if data and not broken:
+                try:
+                    pipe.write(data)
+                except OSError:
+                    broken.append(True)
+            return False
+        try:
+            gpg.on_data = on_data
+            with open(path, "rb") as f:
+                decrypt_status.append(gpg.decrypt_file(f))
+        except Exception as e:
+            decrypt_errors.append(e)
+        finally:
+            gpg.on_data = None
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    decrypter = threading.Thread(target=decrypt)
+    decrypter.start()
+    try:
+        with os.fdopen(read_fd, "rb") as pipe:
+            yield pipe
+    finally:
+        # Once the read end is closed, the decrypter can't block anymore. A gpg failure explains why the stream couldn't be read, so it takes precedence.
+        decrypter.join()
+        if decrypt_errors:
+            raise decrypt_errors[0]
+        if not decrypt_status[0].ok:
+            raise Exception("gnupg returned a non ok status ({}).".format(decrypt_status[0].status))
+
+def _remove_deleted(manifest_path, destination, metrics):
+    """
+        Removes the files an incremental backup lists as deleted since its parent backup.
+
+        :param manifest_path: Manifest path.
+        :type manifest_path: str
+        :param destination: Directory the archive has been extracted to.
+        :type destination: str
+        :param metrics: Metrics counting the removed files.
+        :type metrics: backupper.report.Metrics
+    """
+
+    with manifest.Manifest.open(manifest_path) as artifact_manifest:
+        for path in artifact_manifest.deleted():
+            path = os.path.join(destination, path)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                # Already removed along with its directory
+                continue
+            metrics.counters["deleted_files"] += 1
+
+def _copy_snapshot(snapshot, destination, metrics):
+    """
+        Copies a snapshot.
+
+        :param snapshot: Snapshot path.
+        :type snapshot: str
+        :param destination: Path of the copy.
+        :type destination: str
+        :param metrics: Metrics of the artifact.
+        :type metrics: backupper.report.Metrics
+    """
+
+    directories = []
+    root = os.path.dirname(snapshot)
+    destination_root = os.path.dirname(destination)
+    for arcname, stat in report.metered_iter(archive._walk_artifact(snapshot), metrics, "walk"):
+        source = os.path.join(root, arcname)
+        copy = os.path.join(destination_root, arcname)
+        with metrics.stage("copy"):
+            if S_ISDIR(stat.st_mode):
+                os.makedirs(copy, exist_ok=True)
+                directories.append((source, copy))
+            else:
+                if os.path.lexists(copy):
+                    os.remove(copy)
+                if S_ISLNK(stat.st_mode):
+                    os.symlink(os.readlink(source), copy)
+                else:
+                    shutil.copy2(source, copy, follow_symlinks=False)
+                    metrics.counters["bytes_in"] += stat.st_size
+                    metrics.counters["bytes_out"] += stat.st_size
+        metrics.counters["files"] += 1
+
+    with metrics.stage("copy"):
+        for source, copy in reversed(directories):
+            shutil.copystat(source, copy, follow_symlinks=False)
+
+def _is_selected(name, member):
+    """
+        Tests if an archive member is the requested member, or in the requested directory.
+
+        :param name: Name of the archive member.
+        :type name: str
+        :param member: Requested member.
+        :type member: str
+        :return: True if the archive member must be extracted.
+        :rtype: bool
+    """
+
+    return name == member or name.startswith("{}/".format(member))
+
+def _resolve_hardlink(tar, tarinfo, index, reader, target):
+    """
+        Returns what must be extracted for a hardlink.
+
+        tarfile links a hardlink to its target if the target has already been extracted. Otherwise, it would look for the target by reading the whole archive: the target contents are extracted under the hardlink name instead.
+
+        :param tar: The archive.
+        :type tar: tarfile.TarFile
+        :param tarinfo: The hardlink.
+        :type tarinfo: tarfile.TarInfo
+        :param index: Seek index of the archive.
+        :type index: backupper.seekindex.SeekIndex
+        :param reader: Reader of the archive.
+        :type reader: backupper.seekindex.IndexedReader
+        :param target: Directory the members are extracted to.
+        :type target: str
+        :return: The hardlink, or its target renamed.
+        :rtype: tarfile.TarInfo
+    """
+
+    if os.path.lexists(os.path.join(target, tarinfo.linkname)):
+        return tarinfo
+    link_target = [offset for name, offset, _ in index.members(tarinfo.linkname) if name == tarinfo.linkname]
+    if len(link_target) == 0:
+        return tarinfo
+    reader.seek(link_target[0])
+    target_tarinfo = tarfile.TarInfo.fromtarfile(tar)
+    target_tarinfo.name = tarinfo.name
+    return target_tarinfo
+
+def _extract_members(tar, tarinfos, target, metrics):
+    """
+        Extracts archive members, then sets the attributes of the extracted directories (like tarfile.TarFile.extractall).
+
+        :param tar: The archive.
+        :type tar: tarfile.TarFile
+        :param tarinfos: Members to extract.
+        :type tarinfos: iterable
+        :param target: Directory the members are extracted to.
+        :type target: str
+        :param metrics: Metrics of the extraction.
+        :type metrics: backupper.report.Metrics
+        :return: The number of extracted members.
+        :rtype: int
+    """
+
+    extracted_count = 0
+    directories = []
+    for tarinfo in tarinfos:
+        with metrics.stage("extract"):
+            # Directories attributes are set once their contents are extracted
+            if tarinfo.isdir():
+                directories.append(tarinfo)
+            tar.extract(tarinfo, target, set_attrs=not tarinfo.isdir(), **_EXTRACT_OPTIONS)
+        extracted_count += 1
+        metrics.counters["files"] += 1
+        if tarinfo.isreg():
+            metrics.counters["bytes_out"] += tarinfo.size
+
+    with metrics.stage("extract"):
+        for tarinfo in sorted(directories, key=lambda tarinfo: tarinfo.name, reverse=True):
+            path = os.path.join(target, tarinfo.name)
+            try:
+                tar.chown(tarinfo, path, False)
+                tar.utime(tarinfo, path)
+                tar.chmod(tarinfo, path)
+            except tarfile.ExtractError:
+                # Like tarfile.TarFile.extractall, with its default errorlevel
+                pass
+    return extracted_count
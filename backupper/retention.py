@@ -0,0 +1,148 @@
+"""
+    Cleaning policy: which old backups are kept.
+
+    Backups are indexed once, sorted by datetime, so that each rule of the policy is a binary search for its time window (current day, current week from Monday, current month) and a slice. The policy doesn't touch the file system, so it can also be replayed on synthetic backup datetimes with simulate.
+"""
+
+import bisect
+import datetime
+import functools
+
+__all__ = ["POLICY_RULES", "BackupIndex", "select", "simulate", "timestamps"]
+
+POLICY_RULES = ["most_recents", "first_daily", "first_weekly", "first_monthly"]
+"""Rules of a cleaning policy"""
+
+class BackupIndex:
+    """
+        Backups sorted by datetime.
+    """
+
+    def __init__(self, backups):
+        """
+            :param backups: (datetime, backup) tuples, in any order. A backup can be any hashable object (usually its path).
+            :type backups: iterable
+        """
+
+        backups = sorted(backups)
+
+        self.datetimes = [backup_datetime for backup_datetime, _ in backups]
+        """Backups datetimes, sorted"""
+
+        self.backups = [backup for _, backup in backups]
+        """Backups, in the same order as datetimes"""
+
+    @classmethod
+    def from_sorted(cls, datetimes, backups):
+        """
+            Builds an index from already sorted backups, without sorting them again.
+
+            :param datetimes: Backups datetimes, sorted.
+            :type datetimes: list
+            :param backups: Backups, in the same order as datetimes.
+            :type backups: list
+            :return: The index.
+            :rtype: backupper.retention.BackupIndex
+        """
+
+        index = cls([])
+        index.datetimes = datetimes
+        index.backups = backups
+        return index
+
+    def __len__(self):
+        return len(self.backups)
+
+    def window(self, start, end):
+        """
+            Returns the backups of a time window.
+
+            :param start: Start of the window (included).
+            :type start: datetime.datetime
+            :param end: End of the window (excluded).
+            :type end: datetime.datetime
+            :return: The backups, sorted by datetime.
+            :rtype: list
+        """
+
+        return self.backups[bisect.bisect_left(self.datetimes, start):bisect.bisect_left(self.datetimes, end)]
+
+def select(index, policy, now):
+    """
+        Selects the backups each rule of a cleaning policy keeps.
+
+        :param index: The old backups (the current one excluded).
+        :type index: backupper.retention.BackupIndex
+        :param policy: The "cleaning_policy" node of the configuration (every rule is set, 0 disabling it).
+        :type policy: dict
+        :param now: Datetime of the current backup.
+        :type now: datetime.datetime
+        :return: The set of kept backups of each rule, indexed by rule name.
+        :rtype: dict
+    """
+
+    day, week, month = _windows(now.date())
+    return {
+        "most_recents": set(index.backups[max(0, len(index) - policy["most_recents"]):]),
+        "first_daily": set(index.window(*day)[:policy["first_daily"]]),
+        "first_weekly": set(index.window(*week)[:policy["first_weekly"]]),
+        "first_monthly": set(index.window(*month)[:policy["first_monthly"]]),
+    }
+
+@functools.lru_cache(maxsize=32)
+def _windows(date):
+    """
+        Returns the time windows of the current day, week (from Monday) and month.
+
+        Cached, as a simulation asks for the same day many times in a row.
+
+        :param date: Current date.
+        :type date: datetime.date
+        :return: (start, end) tuples of the day, week and month windows.
+        :rtype: tuple
+    """
+
+    today = datetime.datetime.combine(date, datetime.time())
+    monday = today - datetime.timedelta(days=today.weekday())
+    first_of_month = today.replace(day=1)
+    first_of_next_month = (first_of_month + datetime.timedelta(days=32)).replace(day=1)
+    return (today, today + datetime.timedelta(days=1)), (monday, monday + datetime.timedelta(days=7)), (first_of_month, first_of_next_month)
+
+def simulate(policy, datetimes):
+    """
+        Replays a backup schedule: a backup is made at each datetime, then the cleaning policy is applied, as backupper does.
+
+        :param policy: The "cleaning_policy" node of the configuration (every rule is set, 0 disabling it).
+        :type policy: dict
+        :param datetimes: Datetimes of the backups, sorted.
+        :type datetimes: iterable
+        :return: The datetimes of the backups left after the last run, sorted.
+        :rtype: list
+    """
+
+    # Backups are their own datetimes, and stay sorted from one run to the next
+    backups = []
+    for now in datetimes:
+        kept = set().union(*select(BackupIndex.from_sorted(backups, backups), policy, now).values())
+        backups = [backup for backup in backups if backup in kept]
+        backups.append(now)
+    return backups
+
+def timestamps(start, end, step):
+    """
+        Generates regular backup datetimes, to be replayed by simulate.
+
+        :param start: First datetime.
+        :type start: datetime.datetime
+        :param end: End datetime (excluded).
+        :type end: datetime.datetime
+        :param step: Time between two backups.
+        :type step: datetime.timedelta
+        :return: The datetimes.
+        :rtype: iterator
+    """
+
+    current = start
+    while current < end:
+        yield current
+        current += step
@@ -0,0 +1,172 @@
+"""
+    Resource budget shared by the backups of a multi-job run.
+
+    Backups run at once as long as the budget allows them: their compressors (compression threads and gpg processes) and open files are counted against global limits, and each device they read from or write to can only be used by device_jobs backups at once, so that backups of different disks run in parallel while backups of the same disk don't make it seek between them.
+"""
+
+import os
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ["ResourceBudget", "default_budget", "device_id"]
+
+_OPEN_FILES_PER_WORKER = 8
+"""Files an artifact worker may hold open at once (artifact file, output, seek index, manifest, gpg pipes...)"""
+
+def default_budget():
+    """
+        Returns the budget used when none is configured: a compressor per CPU, half the open files limit, and one backup per device.
+
+        :return: The "compressors", "open_files" and "device_jobs" of the budget.
+        :rtype: dict
+    """
+
+    open_files = 512
+    if resource is not None:
+        soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft_limit != resource.RLIM_INFINITY:
+            open_files = max(soft_limit // 2, _OPEN_FILES_PER_WORKER)
+    return {"compressors": os.cpu_count() or 1, "open_files": open_files, "device_jobs": 1}
+
+def device_id(path):
+    """
+        Identifies the disk a path is stored on.
+
+        Partitions are identified by their disk (read from /sys on Linux), as they share its heads. Paths that don't exist yet (e.g. a new backup_dir) are on the device of their nearest existing parent.
+
+        :param path: File or directory path.
+        :type path: str
+        :return: The "major:minor" device number.
+        :rtype: str
+    """
+
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    st_dev = os.stat(path).st_dev
+    device = "{}:{}".format(os.major(st_dev), os.minor(st_dev))
+
+    try:
+        block_device = os.path.realpath("/sys/dev/block/{}".format(device))
+        if os.path.exists(os.path.join(block_device, "partition")):
+            with open(os.path.join(os.path.dirname(block_device), "dev"), "r") as f:
+                device = f.read().strip()
+    except OSError:
+        pass
+    return device
+
+def _artifact_compressors(artifact, encrypt):
+    """
+        Counts the compressors archiving an artifact keeps busy.
+
+        :param artifact: Validated artifact node.
+        :type artifact: dict
+        :param encrypt: True if the backup is encrypted.
+        :type encrypt: bool
+        :return: The number of compressors.
+        :rtype: int
+    """
+
+    if artifact["mode"] == "snapshot":
+        return 0
+    if artifact["mode"] == "dedup":
+        return 1
+    compressors = artifact["compression"]["threads"] if artifact["compression"]["codec"] != "none" else 0
+    return compressors + (1 if encrypt else 0)
+
+class ResourceBudget:
+    """
+        Global limits of the resources used by the backups running at once.
+
+        A backup acquires all its resources at once, or waits until they're all available, so that waiting backups don't hold resources other backups could use.
+    """
+
+    def __init__(self, compressors, open_files, device_jobs):
+        """
+            :param compressors: Maximum number of compressors (compression threads and gpg processes) running at once.
+            :type compressors: int
+            :param open_files: Maximum number of open files.
+            :type open_files: int
+            :param device_jobs: Maximum number of backups using the same device at once.
+            :type device_jobs: int
+        """
+
+        self.capacities = {"compressors": compressors, "open_files": open_files}
+        self.device_jobs = device_jobs
+
+        self._available = dict(self.capacities)
+        """Available units of each resource ("device:<id>" resources are only added once used)"""
+        self._condition = threading.Condition()
+
+    def needs(self, configuration):
+        """
+            Computes the resources a backup needs.
+
+            If archiving `jobs` artifacts at once needs more than the whole budget, the "jobs" of the configuration is lowered until it fits, or to 1 (the backup then takes the whole budget).
+
+            :param configuration: Validated configuration of the backup, with absolute paths (see backupper.utils.resolve_paths).
+            :type configuration: dict
+            :return: The units needed, by resource.
+            :rtype: dict
+        """
+
+        artifacts = configuration["artifacts"]
+        compressors_per_artifact = sorted((_artifact_compressors(artifact, configuration["encrypt"]) for artifact in artifacts), reverse=True)
+        while True:
+            workers = min(configuration["jobs"], len(artifacts))
+            # The most demanding artifacts may be archived together
+            compressors = sum(compressors_per_artifact[:workers])
+            open_files = workers * _OPEN_FILES_PER_WORKER
+            if configuration["jobs"] == 1 or (compressors <= self.capacities["compressors"] and open_files <= self.capacities["open_files"]):
+                break
+            configuration["jobs"] -= 1
+
+        needs = {
+            "compressors": min(compressors, self.capacities["compressors"]),
+            "open_files": min(open_files, self.capacities["open_files"]),
+        }
+        for path in [configuration["backup_dir"]] + [artifact["path"] for artifact in artifacts]:
+            needs["device:{}".format(device_id(path))] = 1
+        return needs
+
+    def _fits(self, needs):
+        """
+            Tells if resources are available (self._condition must be held).
+
+            :param needs: Units needed, by resource.
+            :type needs: dict
+            :return: True if all of them are available.
+            :rtype: bool
+        """
+
+        return all(self._available.get(resource_name, self.device_jobs) >= units for resource_name, units in needs.items())
+
+    def acquire(self, needs):
+        """
+            Waits until resources are available, and takes them.
+
+            :param needs: Units needed, by resource (as returned by needs).
+            :type needs: dict
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(needs))
+            for resource_name, units in needs.items():
+                self._available[resource_name] = self._available.get(resource_name, self.device_jobs) - units
+
+    def release(self, needs):
+        """
+            Gives resources back.
+
+            :param needs: Units taken by acquire.
+            :type needs: dict
+        """
+
+        with self._condition:
+            for resource_name, units in needs.items():
+                self._available[resource_name] += units
+            self._condition.notify_all()
@@ -0,0 +1,270 @@
+"""
+    Seek indexes of artifacts archives.
+
+    A seek index is a SQLite database stored alongside an archive (<archive>.index). It lists the offset of each member in the tar stream, and the restart points of the compressed stream: offsets where decompression can start from scratch, with their position in the tar stream. Reading a member is then a matter of decompressing from the last restart point before it, instead of from the beginning of the archive.
+
+    Only archives written by a seekable codec (see backupper.compression.CODECS) have restart points: gzip archives are written as blocks compressed independently (see backupper.compression.ParallelGzipWriter), so unlike zran there is no window to save along with each restart point.
+"""
+
+import bisect
+import sqlite3
+import zlib
+
+__all__ = ["INDEX_EXTENSION", "SeekIndex", "SeekIndexWriter", "IndexedReader", "index_path"]
+
+INDEX_EXTENSION = "index"
+"""Extension of seek index files"""
+
+_BATCH_SIZE = 10000
+"""Number of members inserted at once"""
+
+_READ_SIZE = 64 * 1024
+"""Size of the reads in the compressed archive"""
+
+def index_path(archive):
+    """
+        Returns the seek index path of an archive.
+
+        :param archive: Archive path.
+        :type archive: str
+        :return: The seek index path.
+        :rtype: str
+    """
+
+    return "{}.{}".format(archive, INDEX_EXTENSION)
+
+class SeekIndexWriter:
+    """
+        Seek index of an archive being written.
+    """
+
+    def __init__(self, path, codec):
+        """
+            :param path: Seek index file path.
+            :type path: str
+            :param codec: Codec of the archive (a seekable backupper.compression.CODECS key).
+            :type codec: str
+        """
+
+        self.path = path
+        """Seek index file path"""
+
+        # The archive may be written by another thread than the one which created the index
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # The index is written once: if we crash, the archive is incomplete anyway
+        self._connection.execute("PRAGMA journal_mode = OFF")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS members (name TEXT PRIMARY KEY, offset INTEGER, size INTEGER) WITHOUT ROWID")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS restart_points (uncompressed INTEGER PRIMARY KEY, compressed INTEGER)")
+        self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('codec', ?)", (codec,))
+        self._batch = []
+
+    def add_member(self, name, offset, size):
+        """
+            Records a member.
+
+            :param name: Name of the member in the archive.
+            :type name: str
+            :param offset: Offset of its header in the tar stream.
+            :type offset: int
+            :param size: Size of its contents.
+            :type size: int
+        """
+
+        self._batch.append((name, offset, size))
+        if len(self._batch) >= _BATCH_SIZE:
+            self._flush()
+
+    def add_restart_points(self, restart_points):
+        """
+            Records the restart points of the compressed stream, once it's written.
+
+            :param restart_points: (uncompressed offset, compressed offset) tuples.
+            :type restart_points: list
+        """
+
+        self._connection.executemany("INSERT OR REPLACE INTO restart_points VALUES (?, ?)", restart_points)
+
+    def _flush(self):
+        self._connection.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?)", self._batch)
+        self._batch = []
+
+    def close(self):
+        if self._connection is None:
+            return
+        self._flush()
+        self._connection.commit()
+        self._connection.close()
+        self._connection = None
+
+class SeekIndex:
+    """
+        Seek index of an existing archive (read only).
+    """
+
+    def __init__(self, path):
+        """
+            :param path: Seek index file path.
+            :type path: str
+
+            :raises FileNotFoundError: If the index doesn't exist.
+        """
+
+        self.path = path
+        """Seek index file path"""
+
+        # sqlite3.connect would create a missing database
+        with open(path, "rb"):
+            pass
+        self._connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+
+        self.codec = dict(self._connection.execute("SELECT key, value FROM meta"))["codec"]
+        """Codec of the archive"""
+
+    def members(self, name):
+        """
+            Finds a member, or a directory and all its members.
+
+            :param name: Name of the member in the archive.
+            :type name: str
+            :return: (name, offset, size) tuples, sorted by offset.
+            :rtype: list
+        """
+
+        # The members of a directory are the names between "<name>/" and "<name>0" ("0" follows "/")
+        return self._connection.execute("SELECT name, offset, size FROM members WHERE name = ? OR (name >= ? AND name < ?) ORDER BY offset", (name, "{}/".format(name), "{}0".format(name))).fetchall()
+
+    def restart_points(self):
+        """
+            Returns the restart points of the archive.
+
+            :return: The uncompressed offsets, sorted, and the compressed offsets, in the same order.
+            :rtype: tuple
+        """
+
+        rows = self._connection.execute("SELECT uncompressed, compressed FROM restart_points ORDER BY uncompressed").fetchall()
+        return [uncompressed for uncompressed, _ in rows], [compressed for _, compressed in rows]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class IndexedReader:
+    """
+        Readable and seekable file object over the tar stream of an indexed archive.
+
+        Seeking backwards, or far enough forwards to pass a restart point, restarts decompression at the last restart point before the new offset. Shorter seeks forward decompress and discard the data in between. Uncompressed archives are just seeked.
+    """
+
+    def __init__(self, fileobj, codec, restart_points):
+        """
+            :param fileobj: Compressed archive, opened in binary mode.
+            :type fileobj: file object
+            :param codec: Codec of the archive (a seekable backupper.compression.CODECS key).
+            :type codec: str
+            :param restart_points: The uncompressed and compressed offsets of the restart points, as returned by SeekIndex.restart_points.
+            :type restart_points: tuple
+        """
+
+        self._fileobj = fileobj
+        self._codec = codec
+        self._uncompressed_offsets, self._compressed_offsets = restart_points
+        self._decompressor = None
+        self._buffer = bytearray()
+        self._position = 0
+        self._eof = False
+
+        self.skipped_bytes = 0
+        """Number of bytes decompressed to reach the requested offsets, then discarded"""
+
+        self._restart(0)
+
+    def _restart(self, restart_point):
+        """
+            Restarts decompression at a restart point.
+
+            :param restart_point: Index of the restart point.
+            :type restart_point: int
+        """
+
+        self._fileobj.seek(self._compressed_offsets[restart_point])
+        self._position = self._uncompressed_offsets[restart_point]
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if self._codec == "gzip" else None
+        self._buffer = bytearray()
+        self._eof = False
+
+    def _fill(self, size):
+        """
+            Decompresses data until the buffer holds size bytes, or the stream ends.
+
+            :param size: Buffer size to reach.
+            :type size: int
+        """
+
+        while len(self._buffer) < size and not self._eof:
+            if self._decompressor is None:
+                data = self._fileobj.read(max(_READ_SIZE, size - len(self._buffer)))
+                self._eof = len(data) == 0
+            else:
+                compressed = self._decompressor.unconsumed_tail or self._fileobj.read(_READ_SIZE)
+                data = self._decompressor.decompress(compressed, _READ_SIZE)
+                # The gzip trailer follows the last block
+                self._eof = self._decompressor.eof or len(compressed) == 0
+            self._buffer.extend(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                data = self.read(_READ_SIZE)
+                if not data:
+                    return b"".join(chunks)
+                chunks.append(data)
+
+        self._fill(size)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence != 0:
+            raise ValueError("seek: only absolute and relative seeks are supported.")
+
+        if self._codec == "none":
+            self._fileobj.seek(offset)
+            self._position = offset
+            self._buffer = bytearray()
+            self._eof = False
+            return offset
+
+        restart_point = bisect.bisect_right(self._uncompressed_offsets, offset) - 1
+        if offset < self._position or self._uncompressed_offsets[restart_point] > self._position:
+            self._restart(restart_point)
+
+        # The rest of the way is decompressed
+        while self._position < offset:
+            data = self.read(min(offset - self._position, _READ_SIZE))
+            if not data:
+                break
+            self.skipped_bytes += len(data)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
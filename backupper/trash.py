@@ -0,0 +1,239 @@
+"""
+    Trash of a backup directory.
+
+    Deleting a big backup (especially a snapshot, with one file per artifact file) can take longer than the backup itself. Expired backups are rather renamed into the trash, which is instantaneous and makes them disappear from the backups list at once, then the trash is emptied: by threads (unlinking releases the GIL), or by a low priority process which outlives the run.
+
+    The trash can be emptied by hand with python3 -m backupper.trash <backup_dir> [jobs]. Files that can't be deleted are reported on stderr, which the background process appends to the trash log of the backup directory.
+"""
+
+import sys
+import os
+import stat
+import errno
+import shutil
+import tempfile
+import subprocess
+import concurrent.futures
+
+__all__ = ["TRASH_DIR", "TRASH_LOG", "trash_path", "has_entries", "move_to_trash", "empty_trash", "spawn_emptier"]
+
+TRASH_DIR = ".trash"
+"""Name of the trash, in backup_dir"""
+
+TRASH_LOG = ".trash.log"
+"""Name of the log of the background emptiers, in backup_dir"""
+
+_TASKS_PER_JOB = 8
+"""Trees are split until each thread has about this number of subtrees to delete"""
+
+def trash_path(backup_dir):
+    """
+        Returns the trash path of a backup directory.
+
+        :param backup_dir: Directory containing the backups.
+        :type backup_dir: str
+        :return: The trash path.
+        :rtype: str
+    """
+
+    return os.path.join(backup_dir, TRASH_DIR)
+
+def has_entries(backup_dir):
+    """
+        Tells if the trash of a backup directory has something to delete.
+
+        :param backup_dir: Directory containing the backups.
+        :type backup_dir: str
+        :return: True if the trash isn't empty.
+        :rtype: bool
+    """
+
+    try:
+        with os.scandir(trash_path(backup_dir)) as entries:
+            return next(entries, None) is not None
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+def move_to_trash(backup_dir, backup):
+    """
+        Moves a backup into the trash.
+
+        The trash is in backup_dir, so the move is an atomic rename. Backups keep their name in the trash, followed by a random suffix (a backup of the same name may be in the trash already).
+
+        :param backup_dir: Directory containing the backups.
+        :type backup_dir: str
+        :param backup: Backup to move.
+        :type backup: str
+        :return: The path of the backup in the trash.
+        :rtype: str
+    """
+
+    trash = trash_path(backup_dir)
+    os.makedirs(trash, exist_ok=True)
+    # A directory can be renamed over an empty one
+    destination = tempfile.mkdtemp(prefix="{}.".format(os.path.basename(backup)), dir=trash)
+    os.rename(backup, destination)
+    return destination
+
+def empty_trash(backup_dir, jobs=4):
+    """
+        Deletes the contents of the trash, on several threads.
+
+        Files that can't be deleted are reported on stderr, and left in the trash for the next emptier.
+
+        :param backup_dir: Directory containing the backups.
+        :type backup_dir: str
+        :param jobs: Number of threads.
+        :type jobs: int
+        :return: The number of trash entries, and the number of errors.
+        :rtype: tuple
+    """
+
+    trash = trash_path(backup_dir)
+    try:
+        entries = [os.path.join(trash, f) for f in os.listdir(trash)]
+    except FileNotFoundError:
+        return 0, 0
+
+    subtrees, directories = _split_trees(entries, jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        errors = [error for errors in executor.map(_remove, subtrees) for error in errors]
+    # Subtrees are gone, their parents are empty
+    for directory in reversed(directories):
+        try:
+            os.rmdir(directory)
+        except OSError as e:
+            # Unless some of their contents couldn't be deleted, which is already reported
+            if not e.errno in [errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST]:
+                errors.append(str(e))
+    for error in errors:
+        sys.stderr.write("Error: trash: {}\n".format(error))
+    return len(entries), len(errors)
+
+def _split_trees(entries, jobs):
+    """
+        Splits trees into subtrees that can be deleted in parallel.
+
+        Directories are replaced by their contents, level by level, until there are enough subtrees to keep all the threads busy (or nothing is left to split).
+
+        :param entries: Trees to split.
+        :type entries: list
+        :param jobs: Number of threads.
+        :type jobs: int
+        :return: The subtrees, and the split directories (parents first), which are empty once the subtrees are deleted.
+        :rtype: tuple
+    """
+
+    subtrees = entries
+    directories = []
+    while len(subtrees) < _TASKS_PER_JOB * jobs:
+        split = [path for path in subtrees if os.path.isdir(path) and not os.path.islink(path)]
+        if len(split) == 0:
+            break
+        directories.extend(split)
+        split_set = set(split)
+        subtrees = [path for path in subtrees if not path in split_set]
+        for path in split:
+            # Directories deleted meanwhile (e.g. by another emptier) are skipped, like in _remove
+            try:
+                _make_writable(path)
+                subtrees.extend(os.path.join(path, f) for f in os.listdir(path))
+            except FileNotFoundError:
+                pass
+    return subtrees, directories
+
+def _make_writable(directory):
+    """
+        Lets the owner list a directory and delete its entries (snapshots keep the permissions of the artifacts, read-only directories included).
+
+        :param directory: Directory path.
+        :type directory: str
+    """
+
+    mode = os.lstat(directory).st_mode
+    if mode & stat.S_IRWXU != stat.S_IRWXU:
+        os.chmod(directory, mode | stat.S_IRWXU)
+
+def _remove(path):
+    """
+        Deletes a file or a tree.
+
+        Files already deleted (e.g. by another emptier) are ignored.
+
+        :param path: File or directory path.
+        :type path: str
+        :return: The errors, one per file that couldn't be deleted.
+        :rtype: list
+    """
+
+    errors = []
+
+    def onerror(function, failed_path, exc_info):
+        if issubclass(exc_info[0], FileNotFoundError):
+            return
+        # Entries of a read-only directory can be deleted once it's made writable
+        if issubclass(exc_info[0], PermissionError) and function in (os.unlink, os.rmdir, os.scandir, os.open):
+            try:
+                _make_writable(os.path.dirname(failed_path))
+                if function is os.unlink:
+                    os.unlink(failed_path)
+                    return
+                if function is os.rmdir:
+                    os.rmdir(failed_path)
+                    return
+                # The directory itself couldn't be listed: its contents are deleted by a new walk
+                _make_writable(failed_path)
+                errors.extend(_remove(failed_path))
+                return
+            except OSError as e:
+                errors.append(str(e))
+                return
+        errors.append(str(exc_info[1]))
+
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, onerror=onerror)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                onerror(os.unlink, path, sys.exc_info())
+    except OSError as e:
+        errors.append(str(e))
+    return errors
+
+def spawn_emptier(backup_dir, jobs=4):
+    """
+        Empties the trash in a background process, which keeps running once backupper exits.
+
+        The process runs with the lowest CPU priority (and so the lowest best-effort I/O priority, for I/O schedulers deriving it from the CPU one), with the same module search path as this one (backupper may not be installed), and its errors are appended to the trash log of the backup directory.
+
+        :param backup_dir: Directory containing the backups.
+        :type backup_dir: str
+        :param jobs: Number of threads of the process.
+        :type jobs: int
+        :return: The process.
+        :rtype: subprocess.Popen
+    """
+
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(os.path.abspath(path) for path in sys.path if path != "")
+    with open(os.path.join(backup_dir, TRASH_LOG), "a") as log:
+        return subprocess.Popen([sys.executable, "-m", "backupper.trash", os.path.abspath(backup_dir), str(jobs)], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log, env=environment, start_new_session=True)
+
+def main():
+    """
+        Background emptier entrypoint.
+    """
+
+    if not 2 <= len(sys.argv) <= 3:
+        sys.stderr.write("Usage: python3 -m backupper.trash <backup_dir> [jobs]\n")
+        sys.exit(1)
+
+    if hasattr(os, "nice"):
+        os.nice(19)
+    _, error_count = empty_trash(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else 4)
+    sys.exit(1 if error_count > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+    Upload of the backups to a storage (see backupper.connect).
+
+    Each artifact is uploaded as soon as it's archived, by a thread, while the next artifacts are being archived. Archived artifacts wait for their upload in a bounded queue: when the storage is slower than archiving, adding an artifact to a full queue blocks until an upload is done, instead of the backlog growing for the whole run.
+"""
+
+import os
+import sys
+import queue
+import inspect
+import posixpath
+import threading
+import collections
+
+from . import compression
+from . import chunkstore
+from . import manifest
+from . import seekindex
+
+__all__ = ["Uploader", "open_storage", "check_storage_options", "artifact_outputs"]
+
+def open_storage(storage_configuration):
+    """
+        Instantiates the storage of a configuration (not connected yet).
+
+        :param storage_configuration: The validated "storage" node of the configuration.
+        :type storage_configuration: dict
+        :return: The storage.
+        :rtype: backupper.connect.AbstractStorageContext
+    """
+
+    # Storages (asyncio, ftplib, ssl...) are slow to import, and only needed by configurations using them
+    from . import connect
+
+    return connect.AbstractStorageContext.storage_methods()[storage_configuration["type"]](**storage_configuration["options"])
+
+def check_storage_options(storage_type, options):
+    """
+        Checks that options can be given to a storage constructor.
+
+        :param storage_type: CONNEXION_TYPE of the storage.
+        :type storage_type: str
+        :param options: Constructor keyword arguments.
+        :type options: dict
+
+        :raises TypeError: If the options don't match the constructor arguments.
+    """
+
+    from . import connect
+
+    inspect.signature(connect.AbstractStorageContext.storage_methods()[storage_type]).bind(**options)
+
+def artifact_outputs(stats):
+    """
+        Lists what has been written in the backup directory for an artifact: its output, and the seek index and manifest next to it.
+
+        :param stats: Artifact statistics, as returned by backupper.archive.backup_artifact.
+        :type stats: dict
+        :return: Absolute paths of the files and directories (empty if nothing was written).
+        :rtype: list
+    """
+
+    output = stats["output"]
+    if output is None:
+        return []
+
+    outputs = [output]
+    if os.path.isfile(seekindex.index_path(output)):
+        outputs.append(seekindex.index_path(output))
+
+    # The manifest is named after the output, without its extensions
+    output_base = output
+    if output_base.endswith(".gpg"):
+        output_base = output_base[:-len(".gpg")]
+    for extension in [compression.CODECS[stats["codec"]]["extension"], chunkstore.RECIPE_EXTENSION]:
+        if output_base.endswith(".{}".format(extension)):
+            output_base = output_base[:-len(extension) - 1]
+            break
+    if os.path.isfile(manifest.manifest_path(output_base)):
+        outputs.append(manifest.manifest_path(output_base))
+    return outputs
+
+class Uploader:
+    """
+        Uploads the outputs of the artifacts of a backup, in a thread.
+    """
+
+    def __init__(self, storage, backup_dir, remote_dir, queue_size, keep_connected=False):
+        """
+            :param storage: Storage to upload to (the uploader connects it if needed).
+            :type storage: backupper.connect.AbstractStorageContext
+            :param backup_dir: Local backup directory (backup_<datetime>), outputs are uploaded relatively to it.
+            :type backup_dir: str
+            :param remote_dir: Distant directory the backup directory is uploaded into.
+            :type remote_dir: str
+            :param queue_size: Maximum number of artifacts waiting for their upload.
+            :type queue_size: int
+            :param keep_connected: If True, the storage stays connected once the uploads are done (unless one failed), to be reused by the next backups.
+            :type keep_connected: bool
+        """
+
+        self._storage = storage
+        self._backup_dir = os.path.abspath(backup_dir)
+        self._remote_backup_dir = posixpath.join(remote_dir, os.path.basename(self._backup_dir))
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="uploader", daemon=True)
+        self._aborted = False
+        self._keep_connected = keep_connected
+
+        self._directories = set()
+        """Distant directories known to exist"""
+
+        self.errors = []
+        """Upload errors (the first one stops the uploads)"""
+
+        self.counters = collections.Counter()
+        """Numbers of uploaded_outputs and bytes_uploaded"""
+
+    def start(self):
+        """
+            Starts the upload thread.
+        """
+
+        self._thread.start()
+
+    def put(self, outputs):
+        """
+            Queues the outputs of an artifact, waiting if the queue is full.
+
+            :param outputs: Absolute paths of the files and directories written for the artifact, in the backup directory.
+            :type outputs: list
+        """
+
+        if len(outputs) > 0:
+            self._queue.put(outputs)
+
+    def close(self, abort=False):
+        """
+            Waits for the queued artifacts to be uploaded, and stops the upload thread.
+
+            :param abort: If True, the queued artifacts aren't uploaded (the current upload still has to finish).
+            :type abort: bool
+        """
+
+        self._aborted = abort
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        """
+            Upload thread main loop.
+        """
+
+        from . import connect
+
+        # A connection kept from a previous backup may have been closed by the server since
+        reused = False
+        try:
+            self._storage.connect()
+        except connect.AlreadyConnectedError:
+            reused = True
+        except Exception as e:
+            self.errors.append("connect: {}".format(e))
+
+        while True:
+            outputs = self._queue.get()
+            if outputs is None:
+                break
+            # Once an upload failed, the queue is only consumed so that put doesn't block
+            if self._aborted or len(self.errors) > 0:
+                continue
+            for output in outputs:
+                try:
+                    self._upload(output)
+                except Exception as e:
+                    if not reused:
+                        self.errors.append("{}: {}".format(output, e))
+                        break
+                    # The reused connection gets one chance to be renewed
+                    reused = False
+                    try:
+                        self._reconnect()
+                        self._upload(output)
+                    except Exception as e:
+                        self.errors.append("{}: {}".format(output, e))
+                        break
+                reused = False
+
+        if not self._keep_connected or len(self.errors) > 0:
+            try:
+                self._storage.disconnect()
+            except Exception:
+                pass
+
+    def _reconnect(self):
+        """
+            Closes the connection to the storage, and opens a new one.
+        """
+
+        try:
+            self._storage.disconnect()
+        except Exception:
+            pass
+        self._directories = set()
+        self._storage.connect()
+
+    def _upload(self, output):
+        """
+            Uploads an output, creating its distant parent directories.
+
+            :param output: Absolute path of the output.
+            :type output: str
+        """
+
+        remote_output = posixpath.join(self._remote_backup_dir, *os.path.relpath(output, self._backup_dir).split(os.sep))
+        self._makedirs(posixpath.dirname(remote_output))
+        self._storage.upload(output, remote_output)
+
+        self.counters["uploaded_outputs"] += 1
+        if os.path.isdir(output):
+            self.counters["bytes_uploaded"] += sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(output) for f in files)
+        else:
+            self.counters["bytes_uploaded"] += os.path.getsize(output)
+        sys.stdout.write("{} uploaded.\n".format(output))
+
+    def _makedirs(self, path):
+        """
+            Creates a distant directory and its missing parents.
+
+            :param path: Distant directory path.
+            :type path: str
+        """
+
+        from . import connect
+
+        if path in self._directories or path in ["", ".", "/"]:
+            return
+        self._makedirs(posixpath.dirname(path))
+        try:
+            self._storage.listdir(path)
+        except connect.NotFoundError:
+            self._storage.mkdir(path)
+        self._directories.add(path)
@@ -5,8 +5,9 @@
 import backupper
 
 import os
+import datetime
 
-__all__ = ["get_help", "validate_configuration"]
+__all__ = ["get_help", "load_yaml", "yaml_parser", "validate_configuration", "validate_environment", "resolve_paths", "validate_jobs_configuration", "validate_daemon_configuration"]
 
 def get_help(command_name, configuration_file):
     """
@@ -22,16 +23,56 @@ def get_help(command_name, configuration_file):
         .. seealso:: backupper.cli.main
     """
 
-    help_string = """Usage: {} [OPTIONS...]
+    help_string = """Usage: {} [OPTIONS...] [COMMAND]
 
+Commands:
+  backup\t\t\t\tBackups the artifacts and cleans the old backups (default).
+  list\t\t\t\tLists the backups recorded in the catalog.
+  find <path>\t\t\tLists the backups containing a file (path or glob pattern), from the catalog.
+  extract <archive> <member>\tExtracts a file or a directory from an archive, using its seek index if it has one.
+  restore <backup>\t\tRestores all the artifacts of a backup (path, or name in the backup directory).
+  daemon <daemon config>\tRuns the backup jobs of a daemon configuration file on their schedules, until SIGTERM.
+
+Options:
   -h, --help\t\t\tDisplays the current help and exits.
-  -f, --config-file\t\tSpecifies an alternative YAML config file (default: {}).
+  -f, --config-file\t\tSpecifies an alternative YAML config file (default: {}). Given several times, the backups of all the files run at once, within a global resource budget.
   -b, --backup-dir\t\tSpecifies an alternative backup directory (overrides the one set in the YAML config file).
   -d, --delete_old_backups\tIf true, will delete old backups (overrides the one set in the YAML config file).
+  -j, --jobs\t\t\tNumber of artifacts archived or restored in parallel (overrides the one set in the YAML config file).
+  -n, --dry-run\t\t\tDoesn't backup nor delete anything, but displays which old backups the cleaning policy would delete.
+  -t, --target\t\t\tDirectory extract and restore write to (default: current directory).
+  --report\t\t\tWrites a JSON run report (stage timings and counters of each artifact) to the given file.
+  --profile\t\t\tWrites a cProfile dump of the run (main process only) to the given file.
+  --startup-profile\t\tDisplays the time spent importing backupper and loading the configuration.
 """.format(command_name, configuration_file)
 
     return help_string
 
+def load_yaml(stream):
+    """
+        Parses a YAML document, with the libyaml C parser if PyYAML has been built with it.
+
+        Configuration files only hold plain values, so they're parsed with the safe loader. yaml is slow to import, so it's only imported once a configuration is parsed.
+
+        :param stream: YAML document (or a file object reading it).
+        :type stream: bytes
+        :return: The parsed document.
+    """
+
+    import yaml
+    return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+def yaml_parser():
+    """
+        Returns the name of the YAML parser load_yaml uses.
+
+        :return: "libyaml" or "python".
+        :rtype: str
+    """
+
+    import yaml
+    return "libyaml" if hasattr(yaml, "CSafeLoader") else "python"
+
 def validate_configuration(configuration):
     """
         Validates a configuration (usually loaded from a yml file).
@@ -53,10 +94,20 @@ def validate_configuration(configuration):
     elif not isinstance(configuration["artifacts"], list):
         raise Exception("Please provide a list of paths in the \"artifacts\" node.")
     else:
+        valid_artifact_options = ["path", "compression", "mode", "filters"]
+        artifacts = []
         for element in configuration["artifacts"]:
-            if not isinstance(element, str):
-                raise Exception("In \"artifacts\": {} isn't a string.".format(element))
-            configuration["artifacts"] = list(map(os.path.expanduser, configuration["artifacts"]))
+            # An artifact is either a path, or a node with a path and its own options
+            if isinstance(element, str):
+                element = {"path": element}
+            elif not (isinstance(element, dict) and isinstance(element.get("path"), str)):
+                raise Exception("In \"artifacts\": {} should be a string or a list of nodes with a \"path\".".format(element))
+            for key in element:
+                if not key in valid_artifact_options:
+                    raise Exception("In \"artifacts\": \"{}\" isn't a valid option for {}.".format(key, element["path"]))
+            element["path"] = os.path.expanduser(element["path"])
+            artifacts.append(element)
+        configuration["artifacts"] = artifacts
 
     # delete_old_backups
     if not "delete_old_backups" in configuration:
@@ -88,6 +139,104 @@ def validate_configuration(configuration):
     if not isinstance(configuration["backup_dir"], str):
         raise Exception("\"backup_dir\" should be a string.")
 
+    # jobs
+    if not "jobs" in configuration:
+        configuration["jobs"] = 1
+    elif not (isinstance(configuration["jobs"], int) and not isinstance(configuration["jobs"], bool) and configuration["jobs"] > 0):
+        raise Exception("\"jobs\" should be a strictly positive integer.")
+
+    # compression (the codecs modules are only imported if the configuration has to be validated)
+    from . import compression
+    if not "compression" in configuration or configuration["compression"] is None:
+        configuration["compression"] = {}
+    configuration["compression"] = _validate_compression(configuration["compression"], "compression", {"codec": compression.DEFAULT_CODEC, "level": None})
+    for artifact in configuration["artifacts"]:
+        if not "compression" in artifact or artifact["compression"] is None:
+            artifact["compression"] = dict(configuration["compression"])
+        else:
+            artifact["compression"] = _validate_compression(artifact["compression"], "compression\" of \"{}".format(artifact["path"]), configuration["compression"])
+
+    # filters
+    if not "filters" in configuration or configuration["filters"] is None:
+        configuration["filters"] = {}
+    configuration["filters"] = _validate_filters(configuration["filters"], "filters", {"exclude": [], "include": [], "max_file_size": None, "newer_than": None})
+    for artifact in configuration["artifacts"]:
+        if not "filters" in artifact or artifact["filters"] is None:
+            artifact["filters"] = dict(configuration["filters"])
+        else:
+            artifact["filters"] = _validate_filters(artifact["filters"], "filters\" of \"{}".format(artifact["path"]), configuration["filters"])
+
+    # incremental
+    default_incremental_options = {"enabled": False, "full_every": 7}
+    if not "incremental" in configuration or configuration["incremental"] is None:
+        configuration["incremental"] = {}
+    elif not isinstance(configuration["incremental"], dict):
+        raise Exception("\"incremental\" should be a list of nodes.")
+    for key in configuration["incremental"]:
+        if key == "enabled":
+            if not isinstance(configuration["incremental"][key], bool):
+                raise Exception("\"{}\" should be a boolean.".format(key))
+        elif key == "full_every":
+            if not (isinstance(configuration["incremental"][key], int) and not isinstance(configuration["incremental"][key], bool) and configuration["incremental"][key] > 0):
+                raise Exception("\"{}\" should be a strictly positive integer.".format(key))
+        else:
+            raise Exception("\"{}\" isn't a valid option for \"incremental\".".format(key))
+    for key in default_incremental_options:
+        if not key in configuration["incremental"]:
+            configuration["incremental"][key] = default_incremental_options[key]
+
+    # trash
+    default_trash_options = {"enabled": False, "background": True, "jobs": 4}
+    if not "trash" in configuration or configuration["trash"] is None:
+        configuration["trash"] = {}
+    elif not isinstance(configuration["trash"], dict):
+        raise Exception("\"trash\" should be a list of nodes.")
+    for key in configuration["trash"]:
+        if key in ["enabled", "background"]:
+            if not isinstance(configuration["trash"][key], bool):
+                raise Exception("\"{}\" should be a boolean.".format(key))
+        elif key == "jobs":
+            if not (isinstance(configuration["trash"][key], int) and not isinstance(configuration["trash"][key], bool) and configuration["trash"][key] > 0):
+                raise Exception("\"{}\" should be a strictly positive integer.".format(key))
+        else:
+            raise Exception("\"{}\" isn't a valid option for \"trash\".".format(key))
+    for key in default_trash_options:
+        if not key in configuration["trash"]:
+            configuration["trash"][key] = default_trash_options[key]
+
+    # catalog (it costs I/O and CPU time on every run, so it has to be enabled)
+    default_catalog_options = {"enabled": False, "checksums": False}
+    if not "catalog" in configuration or configuration["catalog"] is None:
+        configuration["catalog"] = {}
+    elif not isinstance(configuration["catalog"], dict):
+        raise Exception("\"catalog\" should be a list of nodes.")
+    for key in configuration["catalog"]:
+        if key in default_catalog_options:
+            if not isinstance(configuration["catalog"][key], bool):
+                raise Exception("\"{}\" should be a boolean.".format(key))
+        else:
+            raise Exception("\"{}\" isn't a valid option for \"catalog\".".format(key))
+    for key in default_catalog_options:
+        if not key in configuration["catalog"]:
+            configuration["catalog"][key] = default_catalog_options[key]
+
+    # seek_index (it changes the gzip output and adds a file per archive, so it has to be enabled)
+    if not "seek_index" in configuration:
+        configuration["seek_index"] = False
+    elif not isinstance(configuration["seek_index"], bool):
+        raise Exception("\"seek_index\" should be a boolean.")
+
+    # mode
+    valid_modes = ["archive", "dedup", "snapshot"]
+    if not "mode" in configuration:
+        configuration["mode"] = "archive"
+    for node, node_name in [(configuration, "mode")] + [(artifact, "mode\" of \"{}".format(artifact["path"])) for artifact in configuration["artifacts"]]:
+        if "mode" in node and not node["mode"] in valid_modes:
+            raise Exception("\"{}\" should be one of {}.".format(node_name, ", ".join(valid_modes)))
+    for artifact in configuration["artifacts"]:
+        if not "mode" in artifact:
+            artifact["mode"] = configuration["mode"]
+
     # encrypt
     if not "encrypt" in configuration:
         configuration["encrypt"] = False
@@ -121,6 +270,291 @@ def validate_configuration(configuration):
             for key in default_gnupg_options:
                 if not key in configuration["gnupg"]:
                     configuration["gnupg"][key] = default_gnupg_options[key]
+        for artifact in configuration["artifacts"]:
+            if artifact["mode"] in ["dedup", "snapshot"]:
+                raise Exception("\"{}\" mode can't be encrypted (in \"{}\").".format(artifact["mode"], artifact["path"]))
+
+    # storage
+    if not "storage" in configuration or configuration["storage"] is None:
+        configuration["storage"] = None
+    elif not isinstance(configuration["storage"], dict):
+        raise Exception("\"storage\" should be a list of nodes.")
+    else:
+        # Storages (asyncio, ftplib, ssl...) are slow to import, and only needed by configurations using them
+        from . import connect
+        from . import upload
+        storage_types = sorted(connect.AbstractStorageContext.storage_methods())
+        default_storage_options = {"options": {}, "path": ".", "queue_size": 2}
+        if not "type" in configuration["storage"]:
+            raise Exception("Missing \"type\" in \"storage\".")
+        for key in configuration["storage"]:
+            if key == "type":
+                if not configuration["storage"][key] in storage_types:
+                    raise Exception("\"type\" of \"storage\" should be one of {}.".format(", ".join(storage_types)))
+            elif key == "options":
+                if not isinstance(configuration["storage"][key], dict):
+                    raise Exception("\"options\" of \"storage\" should be a list of nodes.")
+            elif key == "path":
+                if not isinstance(configuration["storage"][key], str):
+                    raise Exception("\"{}\" should be a string.".format(key))
+            elif key == "queue_size":
+                if not (isinstance(configuration["storage"][key], int) and not isinstance(configuration["storage"][key], bool) and configuration["storage"][key] > 0):
+                    raise Exception("\"{}\" should be a strictly positive integer.".format(key))
+            else:
+                raise Exception("\"{}\" isn't a valid option for \"storage\".".format(key))
+        for key in default_storage_options:
+            if not key in configuration["storage"]:
+                configuration["storage"][key] = default_storage_options[key]
+        try:
+            upload.check_storage_options(configuration["storage"]["type"], configuration["storage"]["options"])
+        except TypeError as e:
+            raise Exception("In \"options\" of \"storage\": {}.".format(e))
+        # Recipes are useless without the chunk store, which is shared by all the backups
+        for artifact in configuration["artifacts"]:
+            if artifact["mode"] == "dedup":
+                raise Exception("\"dedup\" mode can't be uploaded to a \"storage\" (in \"{}\").".format(artifact["path"]))
+
+def validate_environment(configuration):
+    """
+        Checks that the modules a validated configuration needs are still installed (e.g. for a configuration read from the configuration cache, validated by a previous run).
+
+        :param configuration: Validated configuration.
+        :type configuration: dict
+
+        :raises Exception: If a module is missing.
+    """
+
+    from . import compression
+
+    nodes = [("compression", configuration["compression"])] + [("compression\" of \"{}".format(artifact["path"]), artifact["compression"]) for artifact in configuration["artifacts"]]
+    for node_name, node in nodes:
+        if not compression.is_available(node["codec"]):
+            raise Exception("In \"{}\": the \"{}\" codec requires the {} module.".format(node_name, node["codec"], compression.CODECS[node["codec"]]["module"]))
+
+def resolve_paths(configuration, base_dir):
+    """
+        Makes the paths of a validated configuration absolute.
+
+        backupper.cli.main changes the working directory to the configuration file directory instead, which a process running several configurations at once can't do.
+
+        :param configuration: Validated configuration.
+        :type configuration: dict
+        :param base_dir: Directory the relative paths are relative to (usually the configuration file directory).
+        :type base_dir: str
+    """
+
+    configuration["backup_dir"] = os.path.abspath(os.path.join(base_dir, configuration["backup_dir"]))
+    for artifact in configuration["artifacts"]:
+        artifact["path"] = os.path.abspath(os.path.join(base_dir, artifact["path"]))
+    if configuration["encrypt"]:
+        configuration["gnupg"]["home"] = os.path.abspath(os.path.join(base_dir, configuration["gnupg"]["home"]))
+
+def validate_jobs_configuration(configuration):
+    """
+        Validates a configuration listing several backups (a "backups" node), run at once within a resource budget.
+
+        :param configuration: A dictionary storing the configuration attributes (usually loaded from yaml.load).
+        :type configuration: dict
+
+        :raises Exception: If an error is encountered during the validation, an Exception is raised, describing the issue.
+        .. seealso:: backupper.scheduler
+    """
+
+    for key in configuration:
+        if not key in ["backups", "budget"]:
+            raise Exception("\"{}\" isn't a valid option along with \"backups\".".format(key))
+
+    # backups
+    if not (isinstance(configuration["backups"], list) and len(configuration["backups"]) > 0):
+        raise Exception("Please provide a list of configuration files or nodes in the \"backups\" node.")
+    for backup in configuration["backups"]:
+        if not isinstance(backup, (str, dict)):
+            raise Exception("In \"backups\": {} should be a configuration file path or a configuration node.".format(backup))
+
+    # budget
+    from . import scheduler
+    default_budget = scheduler.default_budget()
+    if not "budget" in configuration or configuration["budget"] is None:
+        configuration["budget"] = {}
+    elif not isinstance(configuration["budget"], dict):
+        raise Exception("\"budget\" should be a list of nodes.")
+    for key in configuration["budget"]:
+        if not key in default_budget:
+            raise Exception("\"{}\" isn't a valid \"budget\" option.".format(key))
+        if not (isinstance(configuration["budget"][key], int) and not isinstance(configuration["budget"][key], bool) and configuration["budget"][key] > 0):
+            raise Exception("In \"budget\": \"{}\" should be a strictly positive integer.".format(key))
+    for key in default_budget:
+        if not key in configuration["budget"]:
+            configuration["budget"][key] = default_budget[key]
+
+def validate_daemon_configuration(configuration):
+    """
+        Validates a daemon configuration (usually loaded from a yml file).
+
+        :param configuration: A dictionary storing the daemon configuration attributes (usually loaded from yaml.load).
+        :type configuration: dict
+
+        :raises Exception: If an error is encountered during the validation, an Exception is raised, describing the issue.
+        .. seealso:: backupper.daemon
+    """
+
+    # No empty configuration file
+    if not isinstance(configuration, dict):
+        raise Exception("Empty or malformed configuration.")
+
+    # jobs
+    if not "jobs" in configuration:
+        raise Exception("Missing \"jobs\" node.")
+    elif not (isinstance(configuration["jobs"], list) and len(configuration["jobs"]) > 0):
+        raise Exception("Please provide a list of jobs in the \"jobs\" node.")
+    valid_job_options = ["config", "every", "at", "slot", "report"]
+    for job in configuration["jobs"]:
+        if not (isinstance(job, dict) and isinstance(job.get("config"), str)):
+            raise Exception("In \"jobs\": {} should be a node with a \"config\".".format(job))
+        for key in job:
+            if not key in valid_job_options:
+                raise Exception("In \"jobs\": \"{}\" isn't a valid option for {}.".format(key, job["config"]))
+        if ("every" in job) == ("at" in job):
+            raise Exception("In \"jobs\": {} should have either an \"every\" or an \"at\" schedule.".format(job["config"]))
+        if "every" in job and not (isinstance(job["every"], int) and not isinstance(job["every"], bool) and job["every"] > 0):
+            raise Exception("In \"jobs\": \"every\" of {} should be a strictly positive integer (seconds).".format(job["config"]))
+        if "at" in job:
+            if isinstance(job["at"], str):
+                job["at"] = [job["at"]]
+            if not (isinstance(job["at"], list) and len(job["at"]) > 0 and all(isinstance(time, str) for time in job["at"])):
+                raise Exception("In \"jobs\": \"at\" of {} should be a time or a list of times (HH:MM).".format(job["config"]))
+            for time in job["at"]:
+                try:
+                    datetime.datetime.strptime(time, "%H:%M")
+                except ValueError:
+                    raise Exception("In \"jobs\": \"{}\" of {} isn't a HH:MM time.".format(time, job["config"]))
+        if "slot" in job and not job["slot"] in ["cpu", "io"]:
+            raise Exception("In \"jobs\": \"slot\" of {} should be one of cpu, io.".format(job["config"]))
+        if "report" in job and not isinstance(job["report"], str):
+            raise Exception("In \"jobs\": \"report\" of {} should be a string.".format(job["config"]))
+
+    # max_jobs, cpu_slots, io_slots, poll_interval
+    default_daemon_options = {"max_jobs": 4, "cpu_slots": 2, "io_slots": 2, "poll_interval": 10}
+    for key in configuration:
+        if key in default_daemon_options:
+            if not (isinstance(configuration[key], int) and not isinstance(configuration[key], bool) and configuration[key] > 0):
+                raise Exception("\"{}\" should be a strictly positive integer.".format(key))
+        elif key != "jobs":
+            raise Exception("\"{}\" isn't a valid daemon option.".format(key))
+    for key in default_daemon_options:
+        if not key in configuration:
+            configuration[key] = default_daemon_options[key]
+
+def _validate_compression(node, node_name, default):
+    """
+        Validates a "compression" node, either the global one or an artifact one.
+
+        :param node: The "compression" node.
+        :type node: dict
+        :param node_name: Name of the node, used in error messages.
+        :type node_name: str
+        :param default: Compression options used if the node doesn't override them.
+        :type default: dict
+        :return: The normalized node, with a "codec", a "level" and a number of "threads".
+        :rtype: dict
+
+        :raises Exception: If the node isn't valid.
+    """
+
+    from . import compression
+
+    if not isinstance(node, dict):
+        raise Exception("\"{}\" should be a list of nodes.".format(node_name))
+    for key in node:
+        if not key in ["codec", "level", "threads"]:
+            raise Exception("\"{}\" isn't a valid option for \"{}\".".format(key, node_name))
+
+    codec = node.get("codec", default["codec"])
+    if not codec in compression.CODECS:
+        raise Exception("In \"{}\": \"codec\" should be one of {}.".format(node_name, ", ".join(sorted(compression.CODECS))))
+    if not compression.is_available(codec):
+        raise Exception("In \"{}\": the \"{}\" codec requires the {} module.".format(node_name, codec, compression.CODECS[codec]["module"]))
+
+    # A level is only inherited along with the codec it was set for
+    levels = compression.CODECS[codec]["levels"]
+    if "level" in node:
+        level = node["level"]
+        if levels is None:
+            raise Exception("In \"{}\": the \"{}\" codec doesn't take a \"level\".".format(node_name, codec))
+        if not (isinstance(level, int) and not isinstance(level, bool) and levels[0] <= level <= levels[1]):
+            raise Exception("In \"{}\": \"level\" should be an integer between {} and {}.".format(node_name, levels[0], levels[1]))
+    elif codec == default["codec"] and default["level"] is not None:
+        level = default["level"]
+    else:
+        level = compression.CODECS[codec]["default_level"]
+
+    # threads are inherited as long as the codec can use them
+    if "threads" in node:
+        threads = node["threads"]
+        if not (isinstance(threads, int) and not isinstance(threads, bool) and threads > 0):
+            raise Exception("In \"{}\": \"threads\" should be a strictly positive integer.".format(node_name))
+        if threads > 1 and not compression.CODECS[codec]["threads"]:
+            raise Exception("In \"{}\": the \"{}\" codec can't use several \"threads\".".format(node_name, codec))
+    elif compression.CODECS[codec]["threads"]:
+        threads = default.get("threads", 1)
+    else:
+        threads = 1
+
+    return {"codec": codec, "level": level, "threads": threads}
+
+def _validate_filters(node, node_name, default):
+    """
+        Validates a "filters" node, either the global one or an artifact one.
+
+        :param node: The "filters" node.
+        :type node: dict
+        :param node_name: Name of the node, used in error messages.
+        :type node_name: str
+        :param default: Filters used if the node doesn't override them.
+        :type default: dict
+        :return: The normalized node, with "exclude" and "include" lists, a "max_file_size" in bytes and a "newer_than" in seconds (None if unset).
+        :rtype: dict
+
+        :raises Exception: If the node isn't valid.
+    """
+
+    # re is only imported if the configuration has to be validated
+    import re
+    from . import filters
+
+    if not isinstance(node, dict):
+        raise Exception("\"{}\" should be a list of nodes.".format(node_name))
+    for key in node:
+        if not key in ["exclude", "include", "max_file_size", "newer_than"]:
+            raise Exception("\"{}\" isn't a valid option for \"{}\".".format(key, node_name))
+
+    validated = dict(default)
+    for key in ["exclude", "include"]:
+        if not key in node:
+            continue
+        rules = node[key]
+        if isinstance(rules, str):
+            rules = [rules]
+        if not (isinstance(rules, list) and all(isinstance(rule, str) and rule != "" for rule in rules)):
+            raise Exception("In \"{}\": \"{}\" should be a glob or a list of globs (or of regular expressions prefixed with re:).".format(node_name, key))
+        for rule in rules:
+            try:
+                filters.compile_rules([rule])
+            except re.error as e:
+                raise Exception("In \"{}\": \"{}\" isn't a valid regular expression ({}).".format(node_name, rule, e))
+        validated[key] = rules
+
+    for key, parse in [("max_file_size", filters.parse_size), ("newer_than", filters.parse_duration)]:
+        if key in node:
+            if node[key] is None:
+                validated[key] = None
+                continue
+            try:
+                validated[key] = parse(node[key])
+            except ValueError as e:
+                raise Exception("In \"{}\": \"{}\": {}".format(node_name, key, e))
+
+    return validated
 
 def get_version():
     return "backupper version {}".format(backupper.__version__)
@@ -0,0 +1,5 @@
+"""
+    backupper benchmark suite.
+
+    Generates synthetic artifact trees, runs the backupper pipeline on them and reports throughput as JSON. See bin/backupper-bench -h.
+"""
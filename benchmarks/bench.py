@@ -0,0 +1,260 @@
+"""
+    backupper-bench entrypoint.
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import getopt
+import datetime
+import platform
+import tempfile
+import subprocess
+
+import yaml
+
+import backupper
+from . import datasets
+
+__all__ = ["main"]
+
+def main():
+    """
+        Benchmark entrypoint.
+    """
+
+    command_name = os.path.basename(sys.argv[0])
+    output_file = None
+    scale = 0.1
+    dataset_names = sorted(datasets.DATASETS)
+    jobs = 1
+    codec = "gzip"
+    old_backups_count = 1000
+    keep = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:s:d:j:c:n:k", ["help", "output=", "scale=", "datasets=", "jobs=", "codec=", "old-backups=", "keep"])
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                sys.stdout.write(_get_help(command_name))
+                sys.exit(0)
+            if opt in ("-o", "--output"):
+                output_file = arg
+            if opt in ("-s", "--scale"):
+                scale = float(arg)
+            if opt in ("-d", "--datasets"):
+                dataset_names = arg.split(",")
+                for name in dataset_names:
+                    if not name in datasets.DATASETS:
+                        raise getopt.GetoptError("unknown dataset {}".format(name))
+            if opt in ("-j", "--jobs"):
+                jobs = int(arg)
+            if opt in ("-c", "--codec"):
+                codec = arg
+            if opt in ("-n", "--old-backups"):
+                old_backups_count = int(arg)
+            if opt in ("-k", "--keep"):
+                keep = True
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("Error: command line arguments: {}\n".format(e))
+        sys.stderr.write("Try {} -h for help.\n".format(command_name))
+        sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix="backupper-bench-")
+    report = {
+        "backupper_version": backupper.__version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": scale,
+        "jobs": jobs,
+        "codec": codec,
+        "datasets": {},
+    }
+
+    try:
+        sys.stderr.write("Creating a throwaway GnuPG home.\n")
+        gnupg_home, keyid = _create_gnupg_home(os.path.join(workdir, "gnupg"))
+
+        for name in dataset_names:
+            sys.stderr.write("Generating {}.\n".format(name))
+            dataset_root = os.path.join(workdir, "data", name)
+            files_count, total_size = datasets.generate(name, dataset_root, scale)
+            result = {"files": files_count, "bytes": total_size, "stages": {}}
+
+            # Each top-level entry of the dataset is an artifact, so that jobs can be used
+            configuration = {
+                "artifacts": sorted(os.path.join(dataset_root, f) for f in os.listdir(dataset_root)),
+                "compression": {"codec": codec},
+                "jobs": jobs,
+            }
+            for stage, encrypt in [("archive", False), ("archive_encrypt", True)]:
+                sys.stderr.write("Running {} on {}.\n".format(stage, name))
+                stage_configuration = dict(configuration, backup_dir=os.path.join(workdir, "backups", name, stage), encrypt=encrypt)
+                if encrypt:
+                    stage_configuration["gnupg"] = {"home": gnupg_home, "keyid": keyid}
+                result["stages"][stage] = _run_backupper(workdir, "{}-{}".format(name, stage), stage_configuration, files_count, total_size)
+            report["datasets"][name] = result
+
+        sys.stderr.write("Running clean on {} old backups.\n".format(old_backups_count))
+        report["clean"] = _bench_cleaning(workdir, old_backups_count)
+    finally:
+        if keep:
+            sys.stderr.write("Benchmark files kept in {}.\n".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if output_file is None:
+        sys.stdout.write("{}\n".format(output))
+    else:
+        with open(output_file, "w") as f:
+            f.write("{}\n".format(output))
+
+    sys.exit(0)
+
+def _get_help(command_name):
+    """
+        Returns the benchmark help string.
+
+        :param command_name: Name of the cli call (usually sys.argv[0]).
+        :type command_name: str
+        :return: The formatted help string ready to be displayed.
+        :rtype: str
+    """
+
+    return """Usage: {} [OPTIONS...]
+
+Runs the backupper pipeline on synthetic artifacts, with and without encryption, then the cleaning policy on many old backups, and prints a JSON report.
+
+  -h, --help\t\t\tDisplays the current help and exits.
+  -o, --output\t\t\tWrites the JSON report to a file instead of the standard output.
+  -s, --scale\t\t\tSize factor of the datasets (default: 0.1).
+  -d, --datasets\t\tComma-separated datasets to run (default: {}).
+  -j, --jobs\t\t\tNumber of backupper jobs (default: 1).
+  -c, --codec\t\t\tCompression codec (default: gzip).
+  -n, --old-backups\t\tNumber of old backups the cleaning policy is run on (default: 1000).
+  -k, --keep\t\t\tKeeps the benchmark files.
+""".format(command_name, ",".join(sorted(datasets.DATASETS)))
+
+def _create_gnupg_home(gnupg_home):
+    """
+        Creates a GnuPG home with an unprotected key, so that encryption can be benchmarked without touching the user keyring.
+
+        :param gnupg_home: GnuPG home to create.
+        :type gnupg_home: str
+        :return: The GnuPG home and the key identifier.
+        :rtype: tuple
+    """
+
+    import gnupg
+
+    os.makedirs(gnupg_home, mode=0o700)
+    gpg = gnupg.GPG(gnupghome=gnupg_home)
+    keyid = "bench@backupper.invalid"
+    key = gpg.gen_key(gpg.gen_key_input(key_type="RSA", key_length=2048, name_email=keyid, no_protection=True))
+    if not key.fingerprint:
+        raise RuntimeError("GnuPG key generation failed ({}).".format(key.stderr))
+    return gnupg_home, keyid
+
+def _run_backupper(workdir, run_name, configuration, files_count, total_size):
+    """
+        Runs backupper in a child process, and measures it.
+
+        :param workdir: Benchmark working directory.
+        :type workdir: str
+        :param run_name: Name of the run (used to name its configuration file).
+        :type run_name: str
+        :param configuration: backupper configuration.
+        :type configuration: dict
+        :param files_count: Number of files in the artifacts.
+        :type files_count: int
+        :param total_size: Size of the artifacts in bytes.
+        :type total_size: int
+        :return: The measures: exit code, wall, user and system times (seconds), time per run and artifact stage (from the backupper run report), throughput, peak RSS (KiB) and output size.
+        :rtype: dict
+    """
+
+    configuration_file = os.path.join(workdir, "{}.yml".format(run_name))
+    report_file = os.path.join(workdir, "{}.json".format(run_name))
+    with open(configuration_file, "w") as f:
+        yaml.safe_dump(configuration, f)
+
+    # The child imports the same backupper as we do
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(backupper.__file__)))] + [p for p in [environment.get("PYTHONPATH")] if p])
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "backupper", "-f", configuration_file, "--report", report_file], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment)
+    stderr = process.stderr.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+
+    output_size = 0
+    for current_dir, _, files in os.walk(configuration["backup_dir"]):
+        for f in files:
+            output_size += os.path.getsize(os.path.join(current_dir, f))
+
+    # The run report breaks the time down per stage: the run ones, and the artifacts ones (summed over the artifacts, which may run in parallel)
+    run_stages = {}
+    artifact_stages = {}
+    if os.path.isfile(report_file):
+        with open(report_file, "r") as f:
+            run_report = json.load(f)
+        run_stages = run_report["stages"]
+        artifact_stages = run_report["totals"]["stages"]
+
+    return {
+        "exit_code": process.returncode,
+        "stages": run_stages,
+        "artifact_stages": artifact_stages,
+        "stderr": stderr.decode(errors="replace"),
+        "wall_time": wall_time,
+        "user_time": rusage.ru_utime,
+        "system_time": rusage.ru_stime,
+        "peak_rss_kib": rusage.ru_maxrss,
+        "mib_per_s": total_size / 1024 / 1024 / wall_time,
+        "files_per_s": files_count / wall_time,
+        "output_bytes": output_size,
+        "ratio": output_size / total_size if total_size else None,
+    }
+
+def _bench_cleaning(workdir, old_backups_count):
+    """
+        Measures the cleaning policy on many old (hourly) backups.
+
+        :param workdir: Benchmark working directory.
+        :type workdir: str
+        :param old_backups_count: Number of old backups.
+        :type old_backups_count: int
+        :return: The backupper run measures, with the number of backups before and after the run.
+        :rtype: dict
+    """
+
+    backup_dir = os.path.join(workdir, "backups", "clean")
+    now = datetime.datetime.utcnow()
+    for i in range(1, old_backups_count + 1):
+        old_backup = os.path.join(backup_dir, "backup_{}".format((now - datetime.timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%S")))
+        os.makedirs(old_backup)
+        with open(os.path.join(old_backup, "artifact.tar.gz"), "wb") as f:
+            f.write(os.urandom(1024))
+
+    artifact = os.path.join(workdir, "clean_artifact")
+    with open(artifact, "w") as f:
+        f.write("backupper\n")
+
+    configuration = {
+        "artifacts": [artifact],
+        "backup_dir": backup_dir,
+        "delete_old_backups": True,
+        "cleaning_policy": {"most_recents": 24, "first_daily": 1, "first_weekly": 7, "first_monthly": 12},
+    }
+    result = _run_backupper(workdir, "clean", configuration, 1, 1)
+    result["backups_before"] = old_backups_count + 1
+    result["backups_after"] = len(os.listdir(backup_dir))
+    for key in ["mib_per_s", "files_per_s", "ratio"]:
+        del result[key]
+    return result
@@ -0,0 +1,91 @@
+"""
+    Synthetic artifact trees used by the benchmarks.
+"""
+
+import os
+import random
+
+__all__ = ["DATASETS", "generate"]
+
+_WORDS = [b"backup", b"artifact", b"archive", b"policy", b"daily", b"weekly", b"monthly", b"gnupg", b"tarball", b"storage", b"restore", b"cleaning"]
+"""Vocabulary of the compressible files"""
+
+def _compressible(rng, size):
+    """
+        Returns text-like data (compresses well, but not trivially).
+
+        :param rng: Random generator.
+        :type rng: random.Random
+        :param size: Size of the data.
+        :type size: int
+        :return: The data.
+        :rtype: bytes
+    """
+
+    data = bytearray()
+    while len(data) < size:
+        data.extend(b" ".join(rng.choice(_WORDS) for _ in range(64)))
+        data.extend(b"%d\n" % rng.getrandbits(32))
+    return bytes(data[:size])
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _many_small_files(root, scale, rng):
+    for i in range(max(1, int(20000 * scale))):
+        _write(os.path.join(root, "dir{:03d}".format(i % 200), "file{:06d}.txt".format(i)), _compressible(rng, rng.randint(512, 8192)))
+
+def _few_huge_files(root, scale, rng):
+    block = _compressible(rng, 1024 * 1024)
+    for i in range(2):
+        with open(os.path.join(root, "huge{}.log".format(i)), "wb") as f:
+            for _ in range(max(1, int(128 * scale))):
+                f.write(block)
+
+def _incompressible(root, scale, rng):
+    for i in range(max(1, int(64 * scale))):
+        _write(os.path.join(root, "random{:03d}.bin".format(i)), os.urandom(1024 * 1024))
+
+def _deep_tree(root, scale, rng):
+    for branch in range(max(1, int(20 * scale))):
+        path = os.path.join(root, "branch{:03d}".format(branch))
+        for depth in range(50):
+            path = os.path.join(path, "level{:02d}".format(depth))
+            _write(os.path.join(path, "leaf.txt"), _compressible(rng, 2048))
+
+DATASETS = {
+    "many_small_files": _many_small_files,
+    "few_huge_files": _few_huge_files,
+    "incompressible": _incompressible,
+    "deep_tree": _deep_tree,
+}
+"""Dataset generators, indexed by name. At scale 1: 20000 files of 0.5 to 8 KiB, 2 files of 128 MiB, 64 MiB of random data, and 20 branches 50 directories deep."""
+
+def generate(name, root, scale=1.0, seed=0):
+    """
+        Generates a dataset.
+
+        :param name: Dataset name (a DATASETS key).
+        :type name: str
+        :param root: Directory the dataset is created in (it must not exist).
+        :type root: str
+        :param scale: Size factor.
+        :type scale: float
+        :param seed: Random seed (compressible data is reproducible, random data isn't).
+        :type seed: int
+        :return: The number of files and their total size in bytes.
+        :rtype: tuple
+    """
+
+    os.makedirs(root)
+    DATASETS[name](root, scale, random.Random(seed))
+
+    files_count = 0
+    total_size = 0
+    for current_dir, _, files in os.walk(root):
+        for f in files:
+            files_count += 1
+            total_size += os.path.getsize(os.path.join(current_dir, f))
+    return files_count, total_size
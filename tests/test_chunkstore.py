@@ -0,0 +1,92 @@
+import os
+import random
+import tempfile
+import unittest
+
+from backupper import chunkstore
+
+def _split(data):
+    chunks = []
+    start = 0
+    for end in chunkstore.split_chunks(data, True):
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+def _random_bytes(size):
+    return random.Random(0).getrandbits(8 * size).to_bytes(size, "little")
+
+def _text(size):
+    generator = random.Random(0)
+    words = ["".join(generator.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(generator.randint(1, 10))) for _ in range(5000)]
+    lines = []
+    length = 0
+    while length < size:
+        lines.append(" ".join(generator.choice(words) for _ in range(generator.randint(5, 15))))
+        length += len(lines[-1]) + 1
+    return "\n".join(lines).encode()
+
+class SplitChunksTest(unittest.TestCase):
+    def test_gear_low_bytes(self):
+        data = _random_bytes(4096)
+        low_bytes = chunkstore._gear_low_bytes(data)
+        for position in range(31, len(data)):
+            self.assertEqual(low_bytes[position], chunkstore._gear_hash(data, position) & 0xFF)
+
+    def test_bounds(self):
+        for data in [_random_bytes(2 * 1024 * 1024), bytes(2 * 1024 * 1024), _text(2 * 1024 * 1024)]:
+            chunks = _split(data)
+            self.assertEqual(b"".join(chunks), data)
+            for chunk in chunks[:-1]:
+                self.assertGreaterEqual(len(chunk), chunkstore.MIN_CHUNK_SIZE)
+                self.assertLessEqual(len(chunk), chunkstore.MAX_CHUNK_SIZE)
+
+    def test_insertion(self):
+        # A one-byte insertion only changes the chunk around it
+        data = _text(4 * 1024 * 1024)
+        chunks = set(_split(data))
+        for position in [0, len(data) // 2]:
+            changed_chunks = _split(data[:position] + b"!" + data[position:])
+            kept_chunks = sum(1 for chunk in changed_chunks if chunk in chunks)
+            self.assertGreaterEqual(len(chunks), 16)
+            self.assertGreaterEqual(kept_chunks, len(changed_chunks) - 2)
+
+    def test_buffering(self):
+        # Boundaries don't depend on how the data is buffered
+        data = _text(2 * 1024 * 1024)
+        boundaries = chunkstore.split_chunks(data, True)
+        start = 0
+        buffer_boundaries = []
+        for end in [300000, 1000000, len(data)]:
+            buffer = data[start:end]
+            buffer_start = start
+            for boundary in chunkstore.split_chunks(buffer, end == len(data)):
+                buffer_boundaries.append(buffer_start + boundary)
+                start = buffer_start + boundary
+        self.assertEqual(buffer_boundaries, boundaries)
+
+class ChunkStoreTest(unittest.TestCase):
+    def test_reclaim(self):
+        # Chunks added by an aborted recipe are deleted by the cleanup, but not the ones another recipe uses
+        with tempfile.TemporaryDirectory() as backup_dir:
+            store = chunkstore.ChunkStore(backup_dir)
+            data = _random_bytes(2 * 1024 * 1024)
+            chunk_writer = chunkstore.ChunkWriter(store, os.path.join(backup_dir, "a.tar.recipe"))
+            chunk_writer.write(data[:1024 * 1024])
+            chunk_writer.close()
+            kept_chunks = set(chunkstore._read_digests(os.path.join(backup_dir, "a.tar.recipe")))
+
+            chunk_writer = chunkstore.ChunkWriter(store, os.path.join(backup_dir, "b.tar.recipe"))
+            chunk_writer.write(data)
+            chunk_writer.cut()
+            chunk_writer.abort()
+            aborted_chunks = set(chunkstore._read_digests(os.path.join(backup_dir, "b.tar.recipe"))) - kept_chunks
+            self.assertGreater(len(aborted_chunks), 0)
+
+            self.assertEqual(store.reclaim(), len(aborted_chunks))
+            for digest in kept_chunks:
+                self.assertTrue(os.path.isfile(store.chunk_path(digest)))
+            for digest in aborted_chunks:
+                self.assertFalse(os.path.exists(store.chunk_path(digest)))
+            self.assertEqual(store.reclaim(), 0)
+            store.close()
@@ -0,0 +1,44 @@
+import os
+import unittest
+
+from backupper import filters
+
+class CompileRulesTest(unittest.TestCase):
+    def test_globs(self):
+        rules = filters.compile_rules(["node_modules", "*.tmp", "me/.git/objects", "**/cache"])
+        for path in ["node_modules", "a/b/node_modules", "x.tmp", "a/x.tmp", "me/.git/objects", "a/b/cache"]:
+            self.assertIsNotNone(rules.search(path), path)
+        for path in ["node_modules2", "a/x.tmp/y", "a/me/.git/objects", "cached"]:
+            self.assertIsNone(rules.search(path), path)
+
+    def test_inline_flags(self):
+        # Leading global flags are valid alone, and must stay valid once joined with other rules
+        for rules in [["re:(?i)\\.jpg$"], ["*.tmp", "re:(?i)\\.jpg$", "re:\\.png$"]]:
+            rules = filters.compile_rules(rules)
+            self.assertIsNotNone(rules.search("photos/A.JPG"))
+            self.assertIsNotNone(rules.search("photos/a.jpg"))
+            self.assertIsNone(rules.search("photos/a.PNG"))
+
+        rules = filters.compile_rules(["re:(?i)(?s)a.b", "re:(?x) c d # comment", "re:^e"])
+        self.assertIsNotNone(rules.search("A\nB"))
+        self.assertIsNotNone(rules.search("cd"))
+        self.assertIsNotNone(rules.search("e"))
+        self.assertIsNone(rules.search("E"))
+
+class MatcherTest(unittest.TestCase):
+    def test_check(self):
+        matcher = filters.Matcher({"exclude": ["*.tmp"], "include": ["docs"], "max_file_size": 10, "newer_than": 60}, now=1000)
+        directory = os.stat_result((0o40755, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+        def regular_file(size, mtime):
+            return os.stat_result((0o100644, 0, 0, 0, 0, 0, size, 0, mtime, 0))
+
+        self.assertTrue(matcher.check("docs", directory, False))
+        self.assertFalse(matcher.check("src", directory, False))
+        self.assertTrue(matcher.check("docs/a", regular_file(1, 999), True))
+        self.assertIsNone(matcher.check("src/a", regular_file(1, 999), False))
+        self.assertIsNone(matcher.check("docs/a.tmp", regular_file(1, 999), True))
+        self.assertIsNone(matcher.check("docs/big", regular_file(11, 999), True))
+        self.assertIsNone(matcher.check("docs/old", regular_file(1, 900), True))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,278 @@
+import os
+import shutil
+import ftplib
+import logging
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, DTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    FTPHandler = None
+    DTPHandler = object
+
+from backupper.connect import FTPStorage, UnpermittedOperationError
+from backupper.connect import ftpstorage
+
+class _KillingDTPHandler(DTPHandler):
+    """
+        Data channel closed by the server in the middle of the first transfer going past kill_after bytes.
+    """
+
+    kill_after = None
+
+    def use_sendfile(self):
+        # sendfile() bypasses send
+        return False
+
+    def _check(self):
+        if self.kill_after is not None and self.get_transmitted_bytes() >= self.kill_after:
+            type(self).kill_after = None
+            self._resp = ("426 Connection killed; transfer aborted.", logging.debug)
+            self.close()
+
+    def send(self, data):
+        result = super().send(data)
+        self._check()
+        return result
+
+    def handle_read(self):
+        super().handle_read()
+        if not self._closed:
+            self._check()
+
+    handle_read_event = handle_read
+
+class _Server(threading.Thread):
+    """
+        pyftpdlib server, serving a directory on a free local port in a thread.
+    """
+
+    def __init__(self, root, handler):
+        super().__init__(daemon=True)
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("user", "passwd", root, perm="elradfmwMT")
+        handler.authorizer = authorizer
+        self.server = FTPServer(("127.0.0.1", 0), handler)
+        self.port = self.server.address[1]
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.server.serve_forever(timeout=0.05, blocking=False, handle_exit=False)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.server.close_all()
+
+def _make_tree(root):
+    """
+        Creates a directory tree of files of various sizes.
+
+        :return: {relative path: contents} dict of the files.
+        :rtype: dict
+    """
+
+    files = {}
+    for directory in ["", "a", os.path.join("a", "b"), "c"]:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+        for i in range(8):
+            path = os.path.join(directory, "file{}".format(i))
+            files[path] = os.urandom(i * 37000)
+            with open(os.path.join(root, path), "wb") as f:
+                f.write(files[path])
+    return files
+
+def _read_tree(root):
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            with open(os.path.join(directory, name), "rb") as f:
+                files[os.path.relpath(os.path.join(directory, name), root)] = f.read()
+    return files
+
+@unittest.skipIf(FTPHandler is None, "pyftpdlib isn't installed")
+class FTPStorageTest(unittest.TestCase):
+    handler = None
+    """FTPHandler subclass of the server (a new one for each test class, as the authorizer is set on it)"""
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+
+    def setUp(self):
+        self.server_root = tempfile.mkdtemp()
+        self.local_root = tempfile.mkdtemp()
+        self.server = _Server(self.server_root, type("Handler", (self.handler or FTPHandler,), {}))
+        self.server.start()
+        # FTPStorage connects to the default port
+        port_patch = unittest.mock.patch.object(ftplib.FTP, "port", self.server.port)
+        port_patch.start()
+        self.addCleanup(port_patch.stop)
+        self.storage = FTPStorage("127.0.0.1", "user", "passwd", connections=3, block_size=8192, retries=2)
+        self.storage.connect()
+
+    def tearDown(self):
+        self.storage.disconnect()
+        self.server.stop()
+        shutil.rmtree(self.server_root)
+        shutil.rmtree(self.local_root)
+
+    def _spy(self, method):
+        """
+            Records the calls of an ftplib.FTP method.
+
+            :return: The rest argument of each call (the offset of transfers).
+            :rtype: list
+        """
+
+        offsets = []
+        original = getattr(ftplib.FTP, method)
+        def spy(connection, *args, **kwargs):
+            offsets.append(kwargs.get("rest"))
+            return original(connection, *args, **kwargs)
+        method_patch = unittest.mock.patch.object(ftplib.FTP, method, spy)
+        method_patch.start()
+        self.addCleanup(method_patch.stop)
+        return offsets
+
+    def test_pooled_transfers(self):
+        files = _make_tree(os.path.join(self.local_root, "tree"))
+        self.storage.upload(os.path.join(self.local_root, "tree"), "/")
+        self.assertEqual(_read_tree(os.path.join(self.server_root, "tree")), files)
+        self.assertGreater(self.storage._opened, 1)
+        self.assertLessEqual(self.storage._opened, 3)
+
+        self.storage.download("/tree", os.path.join(self.local_root, "downloaded"))
+        self.assertEqual(_read_tree(os.path.join(self.local_root, "downloaded")), files)
+        self.assertLessEqual(self.storage._opened, 3)
+
+class FTPStorageResumeTest(FTPStorageTest):
+    handler = type("Handler", (FTPHandler,), {"dtp_handler": type("KillingDTPHandler", (_KillingDTPHandler,), {})}) if FTPHandler is not None else None
+
+    def setUp(self):
+        super().setUp()
+        delay_patch = unittest.mock.patch.object(ftpstorage, "_RETRY_DELAY", 0)
+        delay_patch.start()
+        self.addCleanup(delay_patch.stop)
+        self.data = os.urandom(600000)
+        self.handler.dtp_handler.kill_after = 100000
+
+    def test_resumed_download(self):
+        with open(os.path.join(self.server_root, "big"), "wb") as f:
+            f.write(self.data)
+        offsets = self._spy("retrbinary")
+        dest = os.path.join(self.local_root, "big")
+        self.storage.download("/big", dest)
+        self.assertEqual(len(offsets), 2)
+        self.assertIsNone(offsets[0])
+        self.assertGreater(offsets[1], 0)
+        self.assertEqual(os.path.getsize(dest), len(self.data))
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(dest + ".part"))
+
+    def test_resumed_upload(self):
+        src = os.path.join(self.local_root, "big")
+        with open(src, "wb") as f:
+            f.write(self.data)
+        offsets = self._spy("storbinary")
+        self.storage.upload(src, "/")
+        self.assertEqual(len(offsets), 2)
+        self.assertIsNone(offsets[0])
+        self.assertGreater(offsets[1], 0)
+        self.assertEqual(os.path.getsize(os.path.join(self.server_root, "big")), len(self.data))
+        with open(os.path.join(self.server_root, "big"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_existing_destination(self):
+        self.handler.dtp_handler.kill_after = None
+        with open(os.path.join(self.server_root, "file"), "wb") as f:
+            f.write(self.data)
+        # Neither the destination nor a partial file of another download are overwritten
+        for existing in ["file", "file.part"]:
+            path = os.path.join(self.local_root, existing)
+            with open(path, "wb") as f:
+                f.write(b"local")
+            with self.assertRaises(UnpermittedOperationError):
+                self.storage.download("/file", os.path.join(self.local_root, "file"))
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"local")
+            os.remove(path)
+        self.storage.download("/file", os.path.join(self.local_root, "file"))
+        self.assertEqual(os.path.getsize(os.path.join(self.local_root, "file")), len(self.data))
+
+class FTPStorageListingTest(FTPStorageTest):
+    mlsd = True
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.server_root, "dir", "sub"))
+        for path in ["file", "with space", os.path.join("dir", "file")]:
+            with open(os.path.join(self.server_root, path), "wb") as f:
+                f.write(b"data")
+        self.listings = self._spy("mlsd" if self.mlsd else "dir")
+
+    def _check_server(self, path):
+        # Compares the cached listing with a fresh one (whose requests aren't counted)
+        cached_files = sorted(self.storage.listdir(path))
+        listings = len(self.listings)
+        fresh_storage = FTPStorage("127.0.0.1", "user", "passwd")
+        fresh_storage.connect()
+        try:
+            self.assertEqual(cached_files, sorted(fresh_storage.listdir(path)))
+        finally:
+            fresh_storage.disconnect()
+            del self.listings[listings:]
+
+    def test_cache(self):
+        self.assertEqual(sorted(self.storage.listdir("/")), ["dir", "file", "with space"])
+        self.assertEqual(self.storage._mlsd, self.mlsd)
+        self.assertEqual(len(self.listings), 1)
+        self.assertTrue(self.storage.isdir("dir"))
+        self.assertFalse(self.storage.isdir("/with space"))
+        self.assertFalse(self.storage.exists("/missing"))
+        self.assertEqual(sorted(self.storage.listdir("/")), ["dir", "file", "with space"])
+        self.assertEqual(len(self.listings), 1)
+
+        self.storage.chdir("dir")
+        self.assertEqual(sorted(self.storage.listdir(".")), ["file", "sub"])
+        self.assertTrue(self.storage.isdir("sub"))
+        self.assertEqual(len(self.listings), 2)
+
+    def test_invalidation(self):
+        self.storage.listdir("/dir")
+        self.storage.mkdir("/dir/new")
+        self.assertTrue(self.storage.isdir("/dir/new"))
+        self.assertEqual(self.storage.listdir("/dir/new"), [])
+        self._check_server("/dir")
+
+        self.storage.rename("/dir/new", "/dir/renamed")
+        self.assertFalse(self.storage.exists("/dir/new"))
+        self.assertTrue(self.storage.isdir("/dir/renamed"))
+        self._check_server("/dir")
+
+        self.storage.rename("/dir/file", "/moved")
+        self.assertEqual(sorted(self.storage.listdir("/")), ["dir", "file", "moved", "with space"])
+        self._check_server("/")
+        self._check_server("/dir")
+
+        self.storage.remove("/moved")
+        self.assertFalse(self.storage.exists("/moved"))
+        self._check_server("/")
+
+        # Only /dir and / have been listed (a new directory is known to be empty)
+        self.assertEqual(len(self.listings), 2)
+
+class FTPStorageLISTTest(FTPStorageListingTest):
+    """
+        Listings of a server which doesn't support MLSD.
+    """
+
+    handler = type("Handler", (FTPHandler,), {"proto_cmds": {command: info for command, info in FTPHandler.proto_cmds.items() if command != "MLSD"}}) if FTPHandler is not None else None
+    mlsd = False